@@ -1,180 +1,246 @@
-import os
-import datetime
+import json
+import atexit
+import logging
 import flask
-from flask import Flask, render_template, request, jsonify, send_from_directory
-from langchain_core.messages import SystemMessage, HumanMessage
-import sqlite3
+from flask import Flask, render_template, request, jsonify, session
 
-from src import initialize_llm, parse_results
+from src import start_components, db, metrics, reservations, emergencies, tracing, availability, workers
+from src.history import append_to_history, get_store as history_store, close_store as close_history_store
+from src.sessions import SessionStore, SharedSessionStore, direct_turn, run_turn, stream_turn
 from config import *
 
 
+tracing.configure_logging()
+logger = logging.getLogger(__name__)
+
 # Start Flask app
 app = Flask(__name__)
+# Shared by the workers of a multi-worker server, also when each worker loads the app (hypercorn)
+app.secret_key = SECRET_KEY or workers.shared_secret_key(SECRET_KEY_PATH)
+
+# Load the LLM, intent router and answer cache in the background, so that the server answers health and readiness
+# checks (and reservation requests) right away
+startup = start_components(USER_NAME, HOST, k=K, max_tokens=MAX_TOKENS, temp=T)
+
+# Per-session conversation state, shared by the workers of a multi-worker server
+sessions = SessionStore(max_sessions=SESSION_MAX, ttl=SESSION_TTL) if WORKERS == 1 else \
+    SharedSessionStore(SESSION_DB_PATH, SESSION_LOCK_FOLDER, max_sessions=SESSION_MAX, ttl=SESSION_TTL, lock_stripes=SESSION_LOCK_STRIPES)
+
+
+def shutdown():
+    # Write queued chat history, release pooled DB connections and save cached answers (in the workers of a
+    # multi-worker server, since the master's cache is the one loaded at startup)
+    close_history_store()
+    db.close_pool()
+    if startup.ready and startup['answer_cache'] is not None and not workers.in_master(): startup['answer_cache'].save()
 
-# Initialize LLM
-agent = initialize_llm(USER_NAME, HOST, k=K, max_tokens=MAX_TOKENS, temp=T)
-chat_history = []
+atexit.register(shutdown)
 
 
+def not_ready():
+    return jsonify({"response": "The Assistant is starting up, please try again in a few moments."}), 503, {'Retry-After': '5'}
+
+def get_session():
+    # Session id is kept in a signed cookie, conversation state on the server
+    if 'sid' not in session: session['sid'] = SessionStore.new_id()
+    return sessions.get(session['sid'], USER_NAME)
+
 @app.route("/")
 def index():
     return render_template('index.html')
 
 @app.route("/msg", methods=["POST"])
 def chat():
-    # Retrieve message
+    if not startup.ready: return not_ready()
+    agent, router, answer_cache = startup['agent'], startup['router'], startup['answer_cache']
+
+    # Retrieve message and conversation
     msg = request.form["msg"]
-    print("Received: {}".format(msg))
+    user_session = get_session()
+    logger.debug("Received: {}".format(msg))
     
     # Register new message in user's chat history
-    append_to_history(msg, 'user')
-    
-    # Add new message to chat history
-    global chat_history
-    chat_history.append(HumanMessage(content=msg))
-    if len(chat_history) > CHAT_BUFFER: chat_history = chat_history[-CHAT_BUFFER:]
+    append_to_history(user_session.user_name, msg, 'user')
     
-    # Invoke chat agent to answer query
-    result=agent.invoke({"messages": chat_history})
-    #result = {"messages": chat_history + [SystemMessage(content="Hello World!")]}
-    print("Response: {}".format(result))
-    
-    # Return agent's response and update chat history accordingly
-    chat_history, response = parse_results(result)
-    if len(chat_history) > CHAT_BUFFER: chat_history = chat_history[-CHAT_BUFFER:]
+    # Answer directly if the request maps to a single tool call or a similar question was already answered,
+    # otherwise invoke chat agent to answer query, within the user's conversation
+    with tracing.trace('chat'):
+        response = direct_turn(user_session, msg, router=router, cache=answer_cache)
+        if response is None:
+            response = run_turn(user_session, msg, agent, cache=answer_cache)
+    logger.debug("Response: {}".format(response))
     
     # Register new message in user's chat history
-    append_to_history(response, 'bot')
+    append_to_history(user_session.user_name, response, 'bot')
     
     return response
 
-def append_to_history(text, source):
-    file_path = os.path.join(CHAT_HISTORY_FOLDER, USER_NAME.lower() + '.txt')
-    t = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, 'a') as f:
-        f.write("[{}] {}: {}\n\n".format(t, source, text))
-    
-
-def retrieve_appointment(slot_id):
-    # Open connection to DB
-    db = sqlite3.connect('assets/database/medassist.db')
-    cur = db.cursor()
-    
-    # Prepare query to retrieve time slot information
-    query = """
-            SELECT doctor, time_slot, patient
-            FROM appointments
-            WHERE id = ?
-        """
-    
-    # Execute query and fetch result
-    result = cur.execute(query, (slot_id,))
-    return result.fetchone()
-
+@app.route("/stream", methods=["POST"])
+def stream():
+    if not startup.ready: return not_ready()
+    agent, router, answer_cache = startup['agent'], startup['router'], startup['answer_cache']
 
-def set_appointment(patient, slot_id):
-    # Open connection to DB
-    db = sqlite3.connect('assets/database/medassist.db')
-    cur = db.cursor()
-    
-    # Prepare query to retrieve time slot information
-    query = """
-            UPDATE appointments
-            SET patient = ?
-            WHERE id = ?
-        """
+    # Retrieve message and conversation
+    msg = request.form["msg"]
+    user_session = get_session()
+    logger.debug("Received: {}".format(msg))
     
-    # Execute query
-    cur.execute(query, (patient, slot_id,))
-    db.commit()
+    # Register new message in user's chat history
+    append_to_history(user_session.user_name, msg, 'user')
+    
+    # Stream tool progress and LLM tokens as Server-Sent Events, while the agent answers the query. The trace records
+    # the time to first token and the response time.
+    def generate():
+        with tracing.trace('stream'):
+            # Answer directly if the request maps to a single tool call or a similar question was already answered
+            response = direct_turn(user_session, msg, router=router, cache=answer_cache)
+            events = [('done', response)] if response is not None else stream_turn(user_session, msg, agent, cache=answer_cache)
+            for event, data in events:
+                if event == 'done':
+                    logger.debug("Response: {}".format(data))
+                    append_to_history(user_session.user_name, data, 'bot')
+                yield "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+    
+    return flask.Response(flask.stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route("/health", methods=["GET"])
+def health():
+    # The server is up, even if components are still loading
+    return jsonify({"status": "ok"})
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    # Components are loaded, with the duration of each startup phase
+    return jsonify(startup.status()), 200 if startup.ready else 503
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    body, content_type = metrics.render()
+    return flask.Response(body, content_type=content_type)
+
+@app.route("/debug/traces", methods=["GET"])
+def traces():
+    # Spans of the last requests, most recent first, for the staff
+    if not emergencies.is_staff(request.headers.get('Authorization')): return flask.abort(403)
+    limit = request.args.get('limit', TRACE_BUFFER, type=int)
+    return jsonify({"traces": [t.to_dict() for t in reversed(tracing.recent_traces)][:limit]})
+
+@app.route("/debug/profile", methods=["GET"])
+def profile():
+    # Sample the stacks of the server for a few seconds, as collapsed stacks for flame graph tools (opt-in)
+    if tracing.profiler is None: return flask.abort(404)
+    if not emergencies.is_staff(request.headers.get('Authorization')): return flask.abort(403)
+    stacks = tracing.profiler.profile(request.args.get('seconds', 10., type=float))
+    if stacks is None: return flask.abort(409)
+    return flask.Response(stacks, mimetype='text/plain')
 
 @app.route("/history", methods=["GET"])
 def history():
-    return send_from_directory(CHAT_HISTORY_FOLDER, USER_NAME.lower() + '.txt')
+    # Stream the export of the user's chat history, page by page, optionally within a time range
+    user_name = get_session().user_name
+    chunks = history_store().export(user_name, start=request.args.get('start'), end=request.args.get('end'))
+    return flask.Response(chunks, mimetype='text/plain', headers={'Content-Disposition': 'attachment; filename={}.txt'.format(user_name.lower())})
+
+@app.route("/history/messages", methods=["GET"])
+def history_messages():
+    # Page of the user's chat history, starting after the message id given by `after`
+    messages = history_store().read(get_session().user_name, after=request.args.get('after', 0, type=int), start=request.args.get('start'),
+                                     end=request.args.get('end'), limit=min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), HISTORY_PAGE_SIZE))
+    return jsonify({"messages": messages, "next": messages[-1]['id'] if len(messages) > 0 else None})
+
+@app.route("/availability", methods=["GET"])
+def available_slots():
+    # Page of free time slots of a doctor, or first free time slots of a specialization, between two dates (included)
+    doctor, specialization = request.args.get('doctor'), request.args.get('specialization')
+    if (doctor is None) == (specialization is None): return flask.abort(400)
+    try:
+        start, end = availability.date_range(request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        return flask.abort(400)
+    limit = max(1, min(request.args.get('limit', AVAILABILITY_PAGE_SIZE, type=int), AVAILABILITY_PAGE_SIZE))
+    slots = availability.list_available(doctor, start=start, end=end, after=request.args.get('after', type=int), limit=limit) if doctor is not None \
+            else availability.next_available(specialization, limit, start=start, end=end)
+    return jsonify({"slots": slots, "next": slots[-1]['id'] if doctor is not None and len(slots) == limit else None})
+
+@app.route("/emergencies", methods=["GET"])
+def list_emergencies():
+    # Page of emergencies for the staff, filtered by color-code and time range, starting after the id given by `after`
+    if not emergencies.is_staff(request.headers.get('Authorization')): return flask.abort(403)
+    try:
+        codes = emergencies.parse_codes(request.args.getlist('code'))
+    except ValueError:
+        return flask.abort(400)
+    limit = min(request.args.get('limit', EMERGENCY_PAGE_SIZE, type=int), EMERGENCY_PAGE_SIZE)
+    events = emergencies.list_emergencies(codes, start=request.args.get('start'), end=request.args.get('end'), after=request.args.get('after', type=int), limit=limit)
+    return jsonify({"emergencies": events, "next": events[-1]['id'] if len(events) == limit else None})
+
+@app.route("/emergencies/stream", methods=["GET"])
+def stream_emergencies():
+    # Push new emergencies (RED and YELLOW by default) as Server-Sent Events, resuming after the Last-Event-ID header
+    if not emergencies.is_staff(request.headers.get('Authorization')): return flask.abort(403)
+    try:
+        codes = emergencies.parse_codes(request.args.getlist('code'), default=EMERGENCY_ALERT_CODES)
+    except ValueError:
+        return flask.abort(400)
+    after = request.args.get('after', type=int)
+    if after is None: after = request.headers.get('Last-Event-ID', type=int)
+    
+    def generate():
+        for events in emergencies.follow(codes, after=after, poll=EMERGENCY_POLL_INTERVAL if WORKERS > 1 else None):
+            yield ''.join(emergencies.format_sse(e) for e in events) or emergencies.format_sse(None)
+    
+    return flask.Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route("/emergencies/dashboard", methods=["GET"])
+def emergencies_dashboard():
+    return render_template('emergencies.html')
 
 @app.route("/res", methods=["GET"])
 def reserve():
     # Retrieve slot id
     slot_id = int(request.args.get('id'))
-    print("Slot id: {}".format(slot_id))
-    
-    # Retrieve time slot details
-    row = retrieve_appointment(slot_id)
-    
-    # If no results were found, raise error
-    if row is None:
-        return flask.abort(404)
-    
-    # Parse result
-    doctor, time_slot, patient = row
-    slot_status = "reserved" if patient is not None else "available"
+    logger.debug("Slot id: {}".format(slot_id))
     
-    # Check that patient is authorized to access the required information
-    if slot_status == "reserved" and patient.lower() != USER_NAME.lower():
-        return flask.abort(401)
+    # Retrieve time slot details, checking that patient is authorized to access them
+    status, details = reservations.slot_details(get_session().user_name, slot_id)
+    if status != 200:
+        return flask.abort(status)
     
-    return render_template('reservation.html', slot_id=slot_id, doctor=doctor, time_slot=time_slot, slot_status=slot_status)
+    return render_template('reservation.html', **details)
 
 @app.route("/setReservation", methods=["POST"])
 def setReservation():
     # Retrieve request information
     target_slot_id = int(request.form['slot_id'])
+    version = request.form.get('version', None, type=int)
+    user_name = get_session().user_name
     
-    print("Requested reservation for time slot {}, from user {}".format(target_slot_id, USER_NAME))
-    
-    # Retrieve time slot information
-    row = retrieve_appointment(target_slot_id)
-    
-    # If no results were found, return error
-    if row is None:
-        return jsonify({"response": "Unable to process request.", "slot_status": "reserved"})
-    print("Slot details: {}".format(row))
-    
-    # Parse result
-    doctor, time_slot, patient = row
-    slot_status = "reserved" if patient is not None else "available"
-    
-    # Check if user is authorized to manage reservation
-    if slot_status == "reserved" and USER_NAME.lower() != patient.lower():
-        return jsonify({"response": "Unable to process request.", "slot_status": "reserved"})
-    
-    # If slot not already reserved, make reservation
-    if slot_status == "available":
-        set_appointment(USER_NAME, target_slot_id)
-    
-    return jsonify({"response": "Reservation successful", "slot_status": "reserved"})
+    logger.info("Requested reservation for time slot {}, from user {}".format(target_slot_id, user_name))
+    return jsonify(reservations.reserve(user_name, target_slot_id, version))
 
 
 @app.route("/cancelReservation", methods=["POST"])
 def cancelReservation():
     # Retrieve request information
     target_slot_id = int(request.form['slot_id'])
+    version = request.form.get('version', None, type=int)
+    user_name = get_session().user_name
     
-    print("Reservation cancel requested for time slot {}, from user {}".format(target_slot_id, USER_NAME))
-    
-    # Retrieve time slot information
-    row = retrieve_appointment(target_slot_id)
-    
-    # If no results were found, return error
-    if row is None:
-        return jsonify({"response": "Unable to process request.", "slot_status": "reserved"})
-    print("Slot details: {}".format(row))
-    
-    # Parse result
-    doctor, time_slot, patient = row
-    slot_status = "reserved" if patient is not None else "available"
-    
-    # Check if user is authorized to manage reservation
-    if slot_status == "reserved" and USER_NAME.lower() != patient.lower():
-        return jsonify({"response": "Unable to process request.", "slot_status": "reserved"})
-        
-    # Cancel reservation, if necessary
-    if slot_status == "reserved":
-        set_appointment(None, target_slot_id)
+    logger.info("Reservation cancel requested for time slot {}, from user {}".format(target_slot_id, user_name))
+    return jsonify(reservations.cancel(user_name, target_slot_id, version))
+
+
+@app.route("/batchReservation", methods=["POST"])
+def batchReservation():
+    # Retrieve request information: {"action": "reserve" | "cancel", "slot_ids": [...], "atomic": false}
+    try:
+        action, slot_ids, atomic = reservations.parse_batch(request.get_json(silent=True))
+    except ValueError:
+        return flask.abort(400)
+    user_name = get_session().user_name
     
-    return jsonify({"response": "Cancellation successful", "slot_status": "available"})
+    logger.info("Batch {} requested for time slots {}, from user {}".format(action, slot_ids, user_name))
+    return jsonify({"results": reservations.update_batch(action, user_name, slot_ids, atomic=atomic)})
 
 
 if __name__ == '__main__':
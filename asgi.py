@@ -0,0 +1,302 @@
+import json
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from quart import Quart, render_template, request, jsonify, session, abort, Response
+
+from src import start_components, db, metrics, reservations, emergencies, tracing, availability, workers
+from src.admission import AdmissionQueue, QueueFull
+from src.history import append_to_history, get_store as history_store, close_store as close_history_store
+from src.sessions import SessionStore, SharedSessionStore, adirect_turn, arun_turn, astream_turn
+from config import *
+
+
+tracing.configure_logging()
+logger = logging.getLogger(__name__)
+
+# Start Quart app, served by an ASGI server (e.g. `hypercorn asgi:app`)
+app = Quart(__name__)
+# Shared by the workers of a multi-worker server, also when each worker loads the app (hypercorn)
+app.secret_key = SECRET_KEY or workers.shared_secret_key(SECRET_KEY_PATH)
+# Answers can take minutes on constrained hardware
+app.config['RESPONSE_TIMEOUT'] = None
+
+# Load the LLM, intent router and answer cache in the background, so that the server answers health and readiness
+# checks (and reservation requests) right away
+startup = start_components(USER_NAME, HOST, k=K, max_tokens=MAX_TOKENS, temp=T)
+
+# Per-session conversation state, shared by the workers of a multi-worker server
+sessions = SessionStore(max_sessions=SESSION_MAX, ttl=SESSION_TTL) if WORKERS == 1 else \
+    SharedSessionStore(SESSION_DB_PATH, SESSION_LOCK_FOLDER, max_sessions=SESSION_MAX, ttl=SESSION_TTL, lock_stripes=SESSION_LOCK_STRIPES)
+
+# Requests waiting for, or being served by, the local LLM
+admission = None
+
+
+@app.before_serving
+async def start_serving():
+    global admission
+    # Blocking work (SQLite queries, embeddings, file I/O) runs in a bounded thread pool, which is also the one used by
+    # langchain for synchronous tools
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_THREADS))
+    admission = AdmissionQueue(concurrency=LLM_CONCURRENCY, max_waiting=LLM_QUEUE_SIZE)
+
+@app.after_serving
+async def stop_serving():
+    # Write queued chat history, release pooled DB connections and save cached answers
+    await asyncio.to_thread(close_history_store)
+    await asyncio.to_thread(db.close_pool)
+    if startup.ready and startup['answer_cache'] is not None: await asyncio.to_thread(startup['answer_cache'].save)
+
+@app.errorhandler(QueueFull)
+async def busy(e):
+    logger.warning("Rejected request, {} requests ahead".format(e.position))
+    response = jsonify({"response": "The Assistant is busy, please try again in a few moments.", "queue_position": e.position})
+    return response, 429, {'Retry-After': str(5 * e.position)}
+
+
+def not_ready():
+    return jsonify({"response": "The Assistant is starting up, please try again in a few moments."}), 503, {'Retry-After': '5'}
+
+async def get_session():
+    # Session id is kept in a signed cookie, conversation state on the server. The store of multi-worker servers reads
+    # SQLite and takes file locks, so that it is called off the event loop.
+    if 'sid' not in session: session['sid'] = SessionStore.new_id()
+    return await asyncio.to_thread(sessions.get, session['sid'], USER_NAME)
+
+@app.route("/")
+async def index():
+    return await render_template('index.html')
+
+@app.route("/msg", methods=["POST"])
+async def chat():
+    if not startup.ready: return not_ready()
+    agent, router, answer_cache = startup['agent'], startup['router'], startup['answer_cache']
+
+    # Retrieve message and conversation
+    msg = (await request.form)["msg"]
+    user_session = await get_session()
+    logger.debug("Received: {}".format(msg))
+
+    # Register new message in user's chat history
+    append_to_history(user_session.user_name, msg, 'user')
+
+    # Answer directly if the request maps to a single tool call or a similar question was already answered,
+    # otherwise invoke chat agent to answer query, within the user's conversation, once the LLM is available
+    with tracing.trace('chat'):
+        response = await adirect_turn(user_session, msg, router=router, cache=answer_cache)
+        if response is None:
+            async with admission.slot():
+                response = await arun_turn(user_session, msg, agent, cache=answer_cache)
+    logger.debug("Response: {}".format(response))
+
+    # Register new message in user's chat history
+    append_to_history(user_session.user_name, response, 'bot')
+
+    return response
+
+@app.route("/stream", methods=["POST"])
+async def stream():
+    if not startup.ready: return not_ready()
+    agent, router, answer_cache = startup['agent'], startup['router'], startup['answer_cache']
+
+    # Retrieve message and conversation
+    msg = (await request.form)["msg"]
+    user_session = await get_session()
+    logger.debug("Received: {}".format(msg))
+    trace = tracing.Trace('stream')
+
+    # Register new message in user's chat history
+    append_to_history(user_session.user_name, msg, 'user')
+
+    # Answer directly if the request maps to a single tool call or a similar question was already answered, without
+    # waiting for the LLM
+    with tracing.activate(trace):
+        response = await adirect_turn(user_session, msg, router=router, cache=answer_cache)
+    if response is not None:
+        tracing.finish(trace)
+        logger.debug("Response: {}".format(response))
+        append_to_history(user_session.user_name, response, 'bot')
+        return Response("event: done\ndata: {}\n\n".format(json.dumps(response)), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    # Reject the request right away if too many are waiting, otherwise tell the client its position in the queue
+    position = admission.position()
+    if position > admission.max_waiting:
+        raise QueueFull(position)
+
+    # Stream tool progress and LLM tokens as Server-Sent Events, while the agent answers the query. The trace records
+    # the time to first token and the response time, including the time spent in the queue.
+    async def generate():
+        if position > 0:
+            yield "event: queued\ndata: {}\n\n".format(json.dumps(position))
+        try:
+            with tracing.activate(trace):
+                async with admission.slot():
+                    async for event, data in astream_turn(user_session, msg, agent, cache=answer_cache):
+                        if event == 'done':
+                            logger.debug("Response: {}".format(data))
+                            append_to_history(user_session.user_name, data, 'bot')
+                        yield "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+        except QueueFull:
+            # The queue filled up between the check above and the start of the stream
+            yield "event: done\ndata: {}\n\n".format(json.dumps("The Assistant is busy, please try again in a few moments."))
+        finally:
+            tracing.finish(trace)
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route("/health", methods=["GET"])
+async def health():
+    # The server is up, even if components are still loading
+    return jsonify({"status": "ok"})
+
+@app.route("/ready", methods=["GET"])
+async def ready():
+    # Components are loaded, with the duration of each startup phase
+    return jsonify(startup.status()), 200 if startup.ready else 503
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+@app.route("/debug/traces", methods=["GET"])
+async def traces():
+    # Spans of the last requests, most recent first, for the staff
+    if not emergencies.is_staff(request.headers.get('Authorization')): abort(403)
+    limit = request.args.get('limit', TRACE_BUFFER, type=int)
+    return jsonify({"traces": [t.to_dict() for t in reversed(tracing.recent_traces)][:limit]})
+
+@app.route("/debug/profile", methods=["GET"])
+async def profile():
+    # Sample the stacks of the server for a few seconds, as collapsed stacks for flame graph tools (opt-in)
+    if tracing.profiler is None: abort(404)
+    if not emergencies.is_staff(request.headers.get('Authorization')): abort(403)
+    stacks = await asyncio.to_thread(tracing.profiler.profile, request.args.get('seconds', 10., type=float))
+    if stacks is None: abort(409)
+    return Response(stacks, mimetype='text/plain')
+
+@app.route("/history", methods=["GET"])
+async def history():
+    # Stream the export of the user's chat history, page by page, optionally within a time range
+    user_name = (await get_session()).user_name
+    chunks = history_store().export(user_name, start=request.args.get('start'), end=request.args.get('end'))
+
+    async def generate():
+        # Pages are read in the thread pool
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None: break
+            yield chunk
+
+    return Response(generate(), mimetype='text/plain', headers={'Content-Disposition': 'attachment; filename={}.txt'.format(user_name.lower())})
+
+@app.route("/history/messages", methods=["GET"])
+async def history_messages():
+    # Page of the user's chat history, starting after the message id given by `after`
+    user_name = (await get_session()).user_name
+    messages = await asyncio.to_thread(history_store().read, user_name, after=request.args.get('after', 0, type=int), start=request.args.get('start'),
+                                       end=request.args.get('end'), limit=min(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), HISTORY_PAGE_SIZE))
+    return jsonify({"messages": messages, "next": messages[-1]['id'] if len(messages) > 0 else None})
+
+@app.route("/availability", methods=["GET"])
+async def available_slots():
+    # Page of free time slots of a doctor, or first free time slots of a specialization, between two dates (included)
+    doctor, specialization = request.args.get('doctor'), request.args.get('specialization')
+    if (doctor is None) == (specialization is None): abort(400)
+    try:
+        start, end = availability.date_range(request.args.get('start'), request.args.get('end'))
+    except ValueError:
+        abort(400)
+    limit = max(1, min(request.args.get('limit', AVAILABILITY_PAGE_SIZE, type=int), AVAILABILITY_PAGE_SIZE))
+    slots = await asyncio.to_thread(availability.list_available, doctor, start=start, end=end, after=request.args.get('after', type=int), limit=limit) \
+            if doctor is not None else await asyncio.to_thread(availability.next_available, specialization, limit, start=start, end=end)
+    return jsonify({"slots": slots, "next": slots[-1]['id'] if doctor is not None and len(slots) == limit else None})
+
+@app.route("/emergencies", methods=["GET"])
+async def list_emergencies():
+    # Page of emergencies for the staff, filtered by color-code and time range, starting after the id given by `after`
+    if not emergencies.is_staff(request.headers.get('Authorization')): abort(403)
+    try:
+        codes = emergencies.parse_codes(request.args.getlist('code'))
+    except ValueError:
+        abort(400)
+    limit = min(request.args.get('limit', EMERGENCY_PAGE_SIZE, type=int), EMERGENCY_PAGE_SIZE)
+    events = await asyncio.to_thread(emergencies.list_emergencies, codes, start=request.args.get('start'), end=request.args.get('end'),
+                                     after=request.args.get('after', type=int), limit=limit)
+    return jsonify({"emergencies": events, "next": events[-1]['id'] if len(events) == limit else None})
+
+@app.route("/emergencies/stream", methods=["GET"])
+async def stream_emergencies():
+    # Push new emergencies (RED and YELLOW by default) as Server-Sent Events, resuming after the Last-Event-ID header
+    if not emergencies.is_staff(request.headers.get('Authorization')): abort(403)
+    try:
+        codes = emergencies.parse_codes(request.args.getlist('code'), default=EMERGENCY_ALERT_CODES)
+    except ValueError:
+        abort(400)
+    after = request.args.get('after', type=int)
+    if after is None: after = request.headers.get('Last-Event-ID', type=int)
+
+    async def generate():
+        async for events in emergencies.afollow(codes, after=after, poll=EMERGENCY_POLL_INTERVAL if WORKERS > 1 else None):
+            yield ''.join(emergencies.format_sse(e) for e in events) or emergencies.format_sse(None)
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route("/emergencies/dashboard", methods=["GET"])
+async def emergencies_dashboard():
+    return await render_template('emergencies.html')
+
+@app.route("/res", methods=["GET"])
+async def reserve():
+    # Retrieve slot id
+    slot_id = int(request.args.get('id'))
+    logger.debug("Slot id: {}".format(slot_id))
+
+    # Retrieve time slot details, checking that patient is authorized to access them
+    user_name = (await get_session()).user_name
+    status, details = await asyncio.to_thread(reservations.slot_details, user_name, slot_id)
+    if status != 200:
+        abort(status)
+
+    return await render_template('reservation.html', **details)
+
+@app.route("/setReservation", methods=["POST"])
+async def setReservation():
+    # Retrieve request information
+    form = await request.form
+    target_slot_id = int(form['slot_id'])
+    version = form.get('version', None, type=int)
+    user_name = (await get_session()).user_name
+
+    logger.info("Requested reservation for time slot {}, from user {}".format(target_slot_id, user_name))
+    return jsonify(await asyncio.to_thread(reservations.reserve, user_name, target_slot_id, version))
+
+
+@app.route("/cancelReservation", methods=["POST"])
+async def cancelReservation():
+    # Retrieve request information
+    form = await request.form
+    target_slot_id = int(form['slot_id'])
+    version = form.get('version', None, type=int)
+    user_name = (await get_session()).user_name
+
+    logger.info("Reservation cancel requested for time slot {}, from user {}".format(target_slot_id, user_name))
+    return jsonify(await asyncio.to_thread(reservations.cancel, user_name, target_slot_id, version))
+
+
+@app.route("/batchReservation", methods=["POST"])
+async def batchReservation():
+    # Retrieve request information: {"action": "reserve" | "cancel", "slot_ids": [...], "atomic": false}
+    try:
+        action, slot_ids, atomic = reservations.parse_batch(await request.get_json(silent=True))
+    except ValueError:
+        abort(400)
+    user_name = (await get_session()).user_name
+
+    logger.info("Batch {} requested for time slots {}, from user {}".format(action, slot_ids, user_name))
+    return jsonify({"results": await asyncio.to_thread(reservations.update_batch, action, user_name, slot_ids, atomic)})
+
+
+if __name__ == '__main__':
+    app.run(host=HOST, port=PORT, debug=False)
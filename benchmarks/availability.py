@@ -0,0 +1,97 @@
+import os
+import time
+import random
+import sqlite3
+import argparse
+import datetime
+import tempfile
+import numpy as np
+
+from src import db, availability
+from src.create_db import create_schema, insert_doctors, insert_calendar, EMERGENCIES_SCHEMA
+from benchmarks import synthetic
+from config import *
+
+
+# Previous lookup: every free time slot of the doctor, found by scanning the appointments for `patient is null`
+SELECT_ALL_AVAILABLE_APPOINTMENTS = """
+			SELECT a.id, a.time_slot, d.name
+			FROM doctors d CROSS JOIN appointments a ON a.doctor_id = d.id
+			WHERE d.name_key >= ? and d.name_key < ? and a.patient is null
+			ORDER BY a.time_slot
+		"""
+
+
+def create_calendar_db(path, n_doctors, start, weeks, booked, seed):
+	conn = sqlite3.connect(path)
+	cur = conn.cursor()
+	create_schema(cur)
+	create_schema(cur, EMERGENCIES_SCHEMA)
+	doctor_ids = insert_doctors(cur, synthetic.doctors(n_doctors, seed))
+	conn.commit()
+	t0 = time.perf_counter()
+	n_slots = insert_calendar(conn, sorted(doctor_ids.values()), start, weeks, booked=booked, seed=seed)
+	elapsed = time.perf_counter() - t0
+	conn.close()
+	return list(doctor_ids), n_slots, elapsed
+
+def measure(fn, args_list):
+	# Latency of each call in ms, and mean number of rows returned
+	latencies, rows = [], []
+	for args in args_list:
+		t0 = time.perf_counter()
+		rows.append(len(fn(*args)))
+		latencies.append((time.perf_counter() - t0) * 1000)
+	return np.array(latencies), np.mean(rows)
+
+def report(name, latencies, rows):
+	print("{:<28} {:>9.3f} {:>9.3f} {:>9.1f}".format(name, np.percentile(latencies, 50), np.percentile(latencies, 95), rows))
+
+def benchmark(n_doctors, weeks, booked, queries, seed):
+	# Calendars from the next Monday, since lookups start from the current time
+	start = datetime.date.today() + datetime.timedelta(days=7 - datetime.date.today().weekday())
+	rng = random.Random(seed)
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'calendar.db')
+		names, n_slots, elapsed = create_calendar_db(path, n_doctors, start, weeks, booked, seed)
+		print("Doctors: {}, weeks: {}, time slots: {} ({:.0f} MB), booked: {:.0%}".format(n_doctors, weeks, n_slots, os.path.getsize(path) / 2**20, booked))
+		print("Calendar insert: {:.2f} s ({:.0f} slots/s, one transaction)".format(elapsed, n_slots / elapsed))
+
+		# Random doctors, specializations and windows of a week within the calendar
+		doctors = [rng.choice(names) for _ in range(queries)]
+		specializations = [rng.choice(synthetic.SPECIALIZATIONS) for _ in range(queries)]
+		windows = [availability.date_range(d.isoformat(), (d + datetime.timedelta(days=6)).isoformat())
+		           for d in (start + datetime.timedelta(weeks=rng.randrange(weeks)) for _ in range(queries))]
+
+		conn = sqlite3.connect(path, check_same_thread=False)
+		db.open_pool(path)
+		print("{:<28} {:>9} {:>9} {:>9}".format('query', 'p50 (ms)', 'p95 (ms)', 'rows'))
+		def all_available(doctor):
+			return conn.execute(SELECT_ALL_AVAILABLE_APPOINTMENTS, db.prefix_range(db.normalize_key(doctor))).fetchall()
+		report('all free slots (previous)', *measure(all_available, [(d,) for d in doctors]))
+		report('first page', *measure(lambda d: availability.list_available(d, limit=AVAILABILITY_TOOL_SLOTS), [(d,) for d in doctors]))
+		report('week window page', *measure(lambda d, w: availability.list_available(d, start=w[0], end=w[1], limit=AVAILABILITY_TOOL_SLOTS), zip(doctors, windows)))
+		page = [availability.list_available(d, limit=AVAILABILITY_TOOL_SLOTS) for d in doctors]
+		report('next page (keyset)', *measure(lambda d, p: availability.list_available(d, after=p[-1]['id'], limit=AVAILABILITY_TOOL_SLOTS), [(d, p) for d, p in zip(doctors, page) if len(p) > 0]))
+		report('next N per specialization', *measure(lambda s: availability.next_available(s, AVAILABILITY_TOOL_SLOTS), [(s,) for s in specializations]))
+
+		# Same lookups without the partial index of free slots
+		conn.execute("DROP INDEX idx_appointments_free")
+		conn.commit()
+		db.open_pool(path)
+		report('first page, no index', *measure(lambda d: availability.list_available(d, limit=AVAILABILITY_TOOL_SLOTS), [(d,) for d in doctors]))
+		report('next N, no index', *measure(lambda s: availability.next_available(s, AVAILABILITY_TOOL_SLOTS), [(s,) for s in specializations[:max(1, queries // 10)]]))
+		db.close_pool()
+		conn.close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Bulk insert of generated calendars, and latency of the availability queries with and without the partial index of free slots.")
+	parser.add_argument('--doctors', type=int, default=2000)
+	parser.add_argument('--weeks', type=int, default=12, help="Weeks of generated calendar per doctor.")
+	parser.add_argument('--booked', type=float, default=0.3, help="Fraction of time slots already reserved.")
+	parser.add_argument('--queries', type=int, default=500)
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	benchmark(args.doctors, args.weeks, args.booked, args.queries, args.seed)
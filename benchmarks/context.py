@@ -0,0 +1,135 @@
+import time
+import datetime
+import random
+import argparse
+import numpy as np
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage
+from langchain_core.tools import StructuredTool
+from langgraph.prebuilt import create_react_agent
+
+from benchmarks import synthetic
+from src import tracing
+from src.context import ContextWindow
+from src.prompt import prompt_template
+from src.scripted_llm import ScriptedChatModel
+from src.sessions import Session, stream_turn
+from config import *
+
+
+SMALL_TALK = ["Thanks", "Okay", "Hello"]
+
+
+class MessageBuffer:
+	# Previous history: the last `size` messages, whatever they are, without a summary
+	def __init__(self, size):
+		self.size = size
+
+	def fit(self, messages, summary=''):
+		return messages[-self.size:], summary
+
+	def prompt(self, messages, summary=''):
+		return list(messages)
+
+WINDOWS = {
+	'buffer': lambda args: MessageBuffer(args.buffer),
+	'tokens': lambda args: ContextWindow(max_tokens=args.max_tokens, tool_result_tokens=args.tool_result_tokens, summary_tokens=args.summary_tokens),
+}
+
+
+def create_tools(n_doctors, n_slots, n_conditions, seed):
+	# Tools returning results of the same shape and size as the app's tools, from the synthetic data in memory
+	doctors = synthetic.doctors(n_doctors, seed)
+	slots = synthetic.appointments([name for name, _ in doctors], n_slots, seed=seed)
+	conditions = synthetic.conditions(n_conditions, seed)
+	rng = random.Random(seed)
+	chunks = {condition: [synthetic.answer(rng, condition, CHUNK_SIZE // 6) for _ in range(K)] for condition in conditions}
+	link = '<a href="res?id={}" target="_blank"> link </a>'
+
+	def search_medical_information(query: str) -> str:
+		"""Use to look up additional medical context and information to answer the question."""
+		condition = next((c for c in conditions if c in query), conditions[0])
+		return '\n\n'.join(chunks[condition])
+
+	def search_doctor_by_specialization(specialization: str) -> list[str]:
+		"""Use to look up a list of doctor with a desired specialization."""
+		return [name for name, s in doctors if s == specialization]
+
+	def search_available_doctor_appointments(doctor: str) -> list[dict]:
+		"""Use to look up a list of the first available time slots for appointments with a given doctor."""
+		return [{'time_slot': t, 'doctor': d, 'reservation_link': link.format(i)} for i, d, t, patient in slots if d == doctor and patient is None][:AVAILABILITY_TOOL_SLOTS]
+
+	def search_patient_appointments(patient: str, doctor: str = None) -> list[dict]:
+		"""Use to look up the list of appointments currently scheduled by the patient"""
+		return [{'time_slot': t, 'doctor': d, 'reservation_link': link.format(i)} for i, d, t, p in slots if p == patient][:5]
+
+	tools = [search_medical_information, search_doctor_by_specialization, search_available_doctor_appointments, search_patient_appointments]
+	return [StructuredTool.from_function(func=f, name=f.__name__) for f in tools], doctors, conditions
+
+def conversation(rng, turns, doctors, conditions):
+	# Knowledge questions, doctor and time slot searches, the user's appointments and small talk, in random order
+	messages = []
+	for _ in range(turns):
+		kind = rng.choice(['knowledge', 'knowledge', 'specialization', 'doctor', 'patient', 'small_talk'])
+		if kind == 'knowledge': messages.append(rng.choice(synthetic.QUESTION_TYPES)[1].format(rng.choice(conditions)))
+		elif kind == 'specialization': messages.append("I need a {}ist, which doctors are available?".format(rng.choice(synthetic.SPECIALIZATIONS)[:-1].lower()))
+		elif kind == 'doctor': messages.append("What are the available time slots of {}?".format(rng.choice(doctors)[0]))
+		elif kind == 'patient': messages.append("Show my appointments")
+		else: messages.append(rng.choice(SMALL_TALK))
+	return messages
+
+def orphaned_calls(messages):
+	# Tool calls sent without their result, and results sent without their call
+	calls = {call['id'] for m in messages if isinstance(m, AIMessage) for call in m.tool_calls}
+	results = {m.tool_call_id for m in messages if isinstance(m, ToolMessage)}
+	return len(calls ^ results)
+
+def run_conversation(agent, window, messages, user_name):
+	"""
+	:return: For each turn, the prompt tokens of its LLM generations, its time to first token and latency (seconds),
+	         and the number of orphaned tool calls in the history sent with it.
+	"""
+	session, stats = Session('benchmark', user_name), []
+	for msg in messages:
+		orphans = orphaned_calls(window.fit(session.messages + [HumanMessage(content=msg)], session.summary)[0])
+		start, first_token = time.perf_counter(), None
+		# The trace of the turn counts the prompt tokens of its generations
+		with tracing.trace('benchmark') as t:
+			for event, _ in stream_turn(session, msg, agent, window=window):
+				if first_token is None and event in ('token', 'done'): first_token = time.perf_counter() - start
+		stats.append((t.tokens['input'], first_token, time.perf_counter() - start, orphans))
+	return stats
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Prompt tokens and latency per turn of long conversations, with the previous message-count history vs. the token-aware context window.")
+	parser.add_argument('--conversations', type=int, default=4)
+	parser.add_argument('--turns', type=int, default=12, help="Turns per conversation.")
+	parser.add_argument('--buffer', type=int, default=5, help="Messages kept by the message-count history.")
+	parser.add_argument('--max-tokens', type=int, default=HISTORY_TOKENS)
+	parser.add_argument('--tool-result-tokens', type=int, default=HISTORY_TOOL_RESULT_TOKENS)
+	parser.add_argument('--summary-tokens', type=int, default=HISTORY_SUMMARY_TOKENS)
+	parser.add_argument('--doctors', type=int, default=200)
+	parser.add_argument('--slots', type=int, default=20000)
+	parser.add_argument('--conditions', type=int, default=500)
+	parser.add_argument('--token-latency', type=float, default=0.005, help="Seconds per generated token of the scripted LLM.")
+	parser.add_argument('--prompt-latency', type=float, default=SCRIPTED_LLM_PROMPT_LATENCY, help="Seconds per prompt token of the scripted LLM.")
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	# Agent with the scripted LLM, the app's system prompt and synthetic tools
+	tools, doctors, conditions = create_tools(args.doctors, args.slots, args.conditions, args.seed)
+	llm = ScriptedChatModel(token_latency=args.token_latency, prompt_latency=args.prompt_latency, max_tokens=MAX_TOKENS)
+	system_prompt = SystemMessage(content=prompt_template.format(user_name=USER_NAME, today=datetime.date.today().strftime('%A %Y-%m-%d'), table_names=['doctors', 'appointments'], host=HOST))
+	agent = create_react_agent(llm, tools, messages_modifier=lambda messages: [system_prompt] + messages)
+	rng = random.Random(args.seed)
+	conversations = [conversation(rng, args.turns, doctors, conditions) for _ in range(args.conversations)]
+
+	print("Conversations: {}, turns: {}, prompt latency: {:.2f}ms/token".format(args.conversations, args.turns, args.prompt_latency * 1000))
+	print("{:<8} {:>13} {:>13} {:>13} {:>10} {:>10} {:>10} {:>8}".format('history', 'tokens/turn', 'last turns', 'max tokens', 'ttft p50', 'p50 (ms)', 'p99 (ms)', 'orphans'))
+	for name, make_window in WINDOWS.items():
+		stats = [s for messages in conversations for s in run_conversation(agent, make_window(args), messages, USER_NAME)]
+		tokens, ttfts, latencies, orphans = (np.array(values) for values in zip(*stats))
+		# Prompt tokens of the second half of the conversations, once the history is full
+		last = np.array([s[0] for i, s in enumerate(stats) if i % args.turns >= args.turns // 2])
+		print("{:<8} {:>13.0f} {:>13.0f} {:>13.0f} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}".format(name, tokens.mean(), last.mean(), tokens.max(),
+			np.percentile(ttfts, 50) * 1000, np.percentile(latencies, 50) * 1000, np.percentile(latencies, 99) * 1000, int(orphans.sum())))
@@ -0,0 +1,72 @@
+import os
+import time
+import sqlite3
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from src import db
+from src.create_db import create_db
+from config import *
+
+
+# First page of the free time slots of a doctor, as read by the agent tool
+AVAILABLE_RANGE = ('', -1, '\U0010ffff', AVAILABILITY_TOOL_SLOTS)
+
+
+def available_params(doctor):
+	return AVAILABLE_RANGE + db.prefix_range(db.normalize_key(doctor)) + (AVAILABILITY_TOOL_SLOTS,)
+
+
+def query_per_call_connection(path, doctor):
+	# Previous access pattern: a fresh connection for every query. The connection is closed here, so that only the
+	# setup cost is measured and the benchmark does not run out of file handles
+	conn = sqlite3.connect(path)
+	try:
+		cur = conn.cursor()
+		result = cur.execute(db.SELECT_AVAILABLE_APPOINTMENTS, available_params(doctor))
+		return result.fetchall()
+	finally:
+		conn.close()
+
+def query_pool(pool, doctor):
+	with pool.connection() as conn:
+		return conn.execute(db.SELECT_AVAILABLE_APPOINTMENTS, available_params(doctor)).fetchall()
+
+def run(fn, threads, queries):
+	doctors = ['Lyubor', 'Brazov', 'Amicis', 'Mirabella', 'Muller', 'Dubois']
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=threads) as executor:
+		list(executor.map(lambda i: fn(doctors[i % len(doctors)]), range(queries)))
+	elapsed = time.perf_counter() - start
+	return queries / elapsed
+
+def benchmark(threads, queries, pool_size):
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'bench.db')
+		create_db(path).close()
+		pool = db.ConnectionPool(path, size=pool_size, timeout=DB_TIMEOUT, cached_statements=DB_CACHED_STATEMENTS)
+
+		# Warm up both paths before measuring
+		run(lambda d: query_per_call_connection(path, d), threads, threads)
+		run(lambda d: query_pool(pool, d), threads, threads)
+
+		before = run(lambda d: query_per_call_connection(path, d), threads, queries)
+		after = run(lambda d: query_pool(pool, d), threads, queries)
+		pool.close()
+
+	print("Concurrent callers: {}, queries: {}, pool size: {}".format(threads, queries, pool_size))
+	print("Per-call connection: {:.0f} queries/s".format(before))
+	print("Connection pool:     {:.0f} queries/s".format(after))
+	print("Speedup: {:.2f}x".format(after / before))
+	return before, after
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Compare per-call SQLite connections with the shared connection pool.")
+	parser.add_argument('--threads', type=int, default=16, help="Number of concurrent callers.")
+	parser.add_argument('--queries', type=int, default=20000, help="Total number of queries.")
+	parser.add_argument('--pool-size', type=int, default=DB_POOL_SIZE, help="Size of the connection pool.")
+	args = parser.parse_args()
+
+	benchmark(args.threads, args.queries, args.pool_size)
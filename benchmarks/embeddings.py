@@ -0,0 +1,68 @@
+import os
+import glob
+import time
+import random
+import argparse
+import tempfile
+
+from src.embeddings import EmbeddingService
+from src.ingest import iter_chunks
+from src.create_index import DATA_PATH
+from config import *
+
+
+def load_texts(data_path, n):
+	# Use real chunks if the dataset is available, otherwise synthetic sentences
+	files = [os.path.relpath(p, data_path) for p in sorted(glob.glob(os.path.join(data_path, '*', '*.xml')))]
+	texts = []
+	for _, chunks, _ in iter_chunks(data_path, files, CHUNK_SIZE, CHUNK_OVERLAP, parser='native'):
+		texts += [c.page_content for c in chunks]
+		if len(texts) >= n: return texts[:n]
+	rng = random.Random(0)
+	words = ['patient', 'symptoms', 'treatment', 'disease', 'chronic', 'therapy', 'diagnosis', 'blood', 'pressure', 'insulin', 'heart', 'brain']
+	return texts + [' '.join(rng.choice(words) for _ in range(80)) for _ in range(n - len(texts))]
+
+def timed(fn, texts):
+	start = time.perf_counter()
+	fn(texts)
+	return len(texts) / (time.perf_counter() - start)
+
+def benchmark(n, batch_sizes, threads):
+	texts = load_texts(DATA_PATH, n)
+	print("Chunks: {}, threads: {}".format(len(texts), threads))
+
+	# Raw model throughput, for each batch size
+	service = EmbeddingService(EMBEDDING_MODEL, threads=threads, normalize=EMBEDDING_NORMALIZE, device='cpu')
+	service.encode(texts[:32]) # Warm up
+	for batch_size in batch_sizes:
+		service.batch_size = batch_size
+		print("Batch size {:>4}: {:>8.1f} chunks/s".format(batch_size, timed(service.encode, texts)))
+
+	# Cache: first pass embeds and stores vectors, second pass only reads them back
+	with tempfile.TemporaryDirectory() as tmp:
+		service = EmbeddingService(EMBEDDING_MODEL, batch_size=EMBEDDING_BATCH_SIZE, threads=threads, normalize=EMBEDDING_NORMALIZE, device='cpu', cache_path=tmp)
+		print("Cache cold:      {:>8.1f} chunks/s".format(timed(service.embed, texts)))
+		service.cache._lru.clear()
+		print("Cache warm disk: {:>8.1f} chunks/s".format(timed(service.embed, texts)))
+		print("Cache warm LRU:  {:>8.1f} chunks/s".format(timed(service.embed, texts[:EMBEDDING_CACHE_LRU_SIZE])))
+
+		# Queries are only kept in the LRU: they are embedded again after a restart (or once evicted), but the ones which
+		# are also embedded as documents afterwards are written to disk without running the model again
+		queries = ['{} ?'.format(t) for t in texts[:EMBEDDING_CACHE_LRU_SIZE]]
+		embed_queries = lambda q: [service.embed_query(t) for t in q]
+		print("Queries cold:    {:>8.1f} queries/s".format(timed(embed_queries, queries)))
+		service.cache._lru.clear()
+		print("Queries restart: {:>8.1f} queries/s".format(timed(embed_queries, queries)))
+		rows = len(service.cache)
+		print("Queries as docs: {:>8.1f} chunks/s, {} vectors written".format(timed(service.embed, queries), len(service.cache) - rows))
+		service.cache.close()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Measure embedding throughput on CPU, with and without the vector cache.")
+	parser.add_argument('-n', type=int, default=2000, help="Number of chunks to embed.")
+	parser.add_argument('--batch-sizes', type=int, nargs='+', default=[8, 32, 64, 128], help="Batch sizes to compare.")
+	parser.add_argument('--threads', type=int, default=EMBEDDING_THREADS, help="Number of CPU threads.")
+	args = parser.parse_args()
+
+	benchmark(args.n, args.batch_sizes, args.threads)
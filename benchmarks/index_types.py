@@ -0,0 +1,78 @@
+import os
+import time
+import argparse
+import numpy as np
+import faiss
+
+from src.vector_index import BuildDocstore, build_index, set_search_params, INDEX_TYPES, BUILD_DOCSTORE_NAME
+from config import *
+
+
+def load_source(synthetic=None, dim=384):
+	# Vectors of the chunks indexed by src/create_index.py, in a flat index, or random unit vectors
+	if synthetic is None:
+		docstore = BuildDocstore(os.path.join(INDEX_PATH, BUILD_DOCSTORE_NAME))
+		try:
+			return build_index(docstore, 'flat')
+		finally:
+			docstore.close()
+	vectors = np.random.default_rng(0).standard_normal((synthetic, dim)).astype(np.float32)
+	faiss.normalize_L2(vectors)
+	source = faiss.IndexFlatL2(dim)
+	source.add(vectors)
+	return source
+
+def make_queries(source, n, noise=0.05):
+	# Perturbed copies of random indexed vectors, so that queries have meaningful neighbours
+	rng = np.random.default_rng(1)
+	queries = source.reconstruct_batch(rng.choice(source.ntotal, size=n, replace=False)) + noise * rng.standard_normal((n, source.d)).astype(np.float32)
+	faiss.normalize_L2(queries)
+	return queries
+
+def measure(index, queries, ground_truth, k):
+	# Queries are searched one at a time, as in serving
+	latencies, hits = [], 0
+	for q, gt in zip(queries, ground_truth):
+		start = time.perf_counter()
+		_, ids = index.search(q[None, :], k)
+		latencies.append(time.perf_counter() - start)
+		hits += len(set(ids[0]) & set(gt))
+	latencies = np.array(latencies) * 1000
+	return hits / ground_truth.size, latencies.mean(), np.percentile(latencies, 99)
+
+def benchmark(source, index_types, k, n_queries, nprobes, ef_searches):
+	queries = make_queries(source, n_queries)
+	_, ground_truth = source.search(queries, k)
+	print("Vectors: {}, dim: {}, queries: {}, k: {}".format(source.ntotal, source.d, n_queries, k))
+	print("{:<10} {:<14} {:>9} {:>11} {:>11} {:>10}".format('type', 'params', 'recall@k', 'mean (ms)', 'p99 (ms)', 'size (MB)'))
+
+	results = []
+	for index_type in index_types:
+		start = time.perf_counter()
+		index = build_index(source, index_type)
+		build_time = time.perf_counter() - start
+		size = faiss.serialize_index(index).nbytes / 2**20
+
+		if index_type.startswith('ivf'): settings = [('nprobe={}'.format(n), {'nprobe': n}) for n in nprobes]
+		elif index_type == 'hnsw': settings = [('efSearch={}'.format(e), {'ef_search': e}) for e in ef_searches]
+		else: settings = [('-', {})]
+
+		for name, params in settings:
+			set_search_params(index, **params)
+			recall, mean, p99 = measure(index, queries, ground_truth, k)
+			results.append({'type': index_type, 'params': name, 'recall': recall, 'mean_ms': mean, 'p99_ms': p99, 'size_mb': size, 'build_s': build_time})
+			print("{:<10} {:<14} {:>9.3f} {:>11.3f} {:>11.3f} {:>10.1f}".format(index_type, name, recall, mean, p99, size))
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Recall@k vs. latency of the serving index types, against exact (flat) search.")
+	parser.add_argument('--types', nargs='+', choices=INDEX_TYPES, default=list(INDEX_TYPES), help="Index types to compare.")
+	parser.add_argument('-k', type=int, default=K, help="Number of neighbours.")
+	parser.add_argument('--queries', type=int, default=1000, help="Number of queries.")
+	parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64], help="nprobe values for IVF indexes.")
+	parser.add_argument('--ef-search', type=int, nargs='+', default=[16, 64, 256], help="efSearch values for HNSW indexes.")
+	parser.add_argument('--synthetic', type=int, default=None, help="Use N random vectors instead of the vectors of the built index.")
+	args = parser.parse_args()
+
+	benchmark(load_source(args.synthetic), args.types, args.k, args.queries, args.nprobe, args.ef_search)
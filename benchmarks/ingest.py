@@ -0,0 +1,36 @@
+import os
+import glob
+import time
+import argparse
+
+from src.ingest import iter_chunks, PARSERS
+from src.create_index import DATA_PATH, fix_nltk
+from config import *
+
+
+def benchmark(data_path, parsers, workers_list, limit=None):
+	files = [os.path.relpath(p, data_path) for p in sorted(glob.glob(os.path.join(data_path, '*', '*.xml')))]
+	if limit is not None: files = files[:limit]
+	if 'unstructured' in parsers: fix_nltk()
+
+	results = []
+	for parser in parsers:
+		for workers in workers_list:
+			start = time.perf_counter()
+			n_chunks = sum(len(chunks) for _, chunks, _ in iter_chunks(data_path, files, CHUNK_SIZE, CHUNK_OVERLAP, workers=workers, parser=parser))
+			elapsed = time.perf_counter() - start
+			results.append((parser, workers, elapsed, n_chunks))
+			print("Parser: {:<12} workers: {:>2}  time: {:>7.1f}s  files/s: {:>7.1f}  chunks/s: {:>8.1f}".format(
+				parser, workers, elapsed, len(files) / elapsed, n_chunks / elapsed))
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Time parsing and chunking of the dataset with different parsers and numbers of workers.")
+	parser.add_argument('--data', default=DATA_PATH, help="Dataset folder.")
+	parser.add_argument('--parsers', nargs='+', choices=PARSERS, default=list(PARSERS), help="Parsers to compare.")
+	parser.add_argument('--workers', type=int, nargs='+', default=[1, INGEST_WORKERS], help="Numbers of worker processes to compare.")
+	parser.add_argument('--limit', type=int, default=None, help="Only process the first N files.")
+	args = parser.parse_args()
+
+	benchmark(args.data, args.parsers, args.workers, limit=args.limit)
@@ -0,0 +1,258 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import subprocess
+import http.client
+import urllib.parse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import synthetic
+from config import *
+
+
+SCENARIOS = ('knowledge', 'appointments', 'availability', 'reservation', 'emergency', 'mixed')
+MIXED_WEIGHTS = {'knowledge': 0.5, 'appointments': 0.25, 'reservation': 0.15, 'emergency': 0.1}
+EMERGENCY_MESSAGES = [
+	"I have a strong chest pain and I can't breathe",
+	"My husband is unconscious on the floor",
+	"I fell and I think my arm is broken",
+	"My child has a high fever and keeps vomiting",
+	"I burned my hand with boiling water, is it an emergency?",
+]
+SERVER_COMMANDS = {
+	'flask': lambda port: [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--host', '127.0.0.1', '--port', str(port), '--with-threads'],
+	'asgi': lambda port: [sys.executable, '-m', 'hypercorn', 'asgi:app', '--bind', '127.0.0.1:{}'.format(port)],
+	'gunicorn': lambda port: [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', '127.0.0.1:{}'.format(port), 'app:app'],
+}
+# Metrics compared against a baseline, and whether higher values are better
+COMPARED_METRICS = {'p50_ms': False, 'p99_ms': False, 'ttft_p50_ms': False, 'ttft_p99_ms': False, 'throughput': True}
+VERSION_PATTERN = re.compile(rb'name="version" value=(\d+)')
+
+
+class Client:
+	"""
+	HTTP client of a simulated user, keeping its session cookie. Each request is recorded in `records` as a
+	(scenario, latency, time to first token, success) tuple, where the time to first token is only measured on chat
+	streams, as the time to the first token, or to the answer if it was not generated by the LLM.
+	"""
+
+	def __init__(self, port, records):
+		self.port = port
+		self.records = records
+		self.cookie = None
+
+	def request(self, scenario, method, path, form=None, stream=False):
+		headers = {'Content-Type': 'application/x-www-form-urlencoded'} if form is not None else {}
+		if self.cookie is not None: headers['Cookie'] = self.cookie
+		body, first_token, ok = None, None, False
+		start = time.perf_counter()
+		conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=600)
+		try:
+			conn.request(method, path, body=urllib.parse.urlencode(form) if form is not None else None, headers=headers)
+			response = conn.getresponse()
+			cookie = response.getheader('Set-Cookie')
+			if cookie is not None: self.cookie = cookie.split(';')[0]
+			if stream:
+				for line in response:
+					if first_token is None and line.startswith((b'event: token', b'event: done')): first_token = time.perf_counter() - start
+			else:
+				body = response.read()
+			ok = response.status == 200
+		except (OSError, http.client.HTTPException):
+			pass
+		finally:
+			conn.close()
+		self.records.append((scenario, time.perf_counter() - start, first_token, ok))
+		return body if ok else None
+
+	def chat(self, scenario, msg):
+		self.request(scenario, 'POST', '/stream', form={'msg': msg}, stream=True)
+
+
+def knowledge(client, rng, data, scenario='knowledge'):
+	client.chat(scenario, rng.choice(data['questions']))
+
+def appointments(client, rng, data, scenario='appointments'):
+	specialization = rng.choice(synthetic.SPECIALIZATIONS)
+	client.chat(scenario, "I need a {}ist, which doctors are available?".format(specialization[:-1].lower()))
+	client.chat(scenario, "What are the available time slots of {}?".format(rng.choice(data['doctors'])))
+
+def availability(client, rng, data, scenario='availability'):
+	# First two pages of the free slots of a doctor, without the agent
+	doctor = urllib.parse.quote(rng.choice(data['doctors']))
+	page = client.request(scenario, 'GET', '/availability?doctor={}&limit=10'.format(doctor))
+	after = json.loads(page)['next'] if page is not None else None
+	if after is not None: client.request(scenario, 'GET', '/availability?doctor={}&limit=10&after={}'.format(doctor, after))
+
+def reservation(client, rng, data, scenario='reservation'):
+	# Open the reservation page of a free slot, reserve it with the version shown, then cancel it
+	slot_id = rng.choice(data['free_slots'])
+	page = client.request(scenario, 'GET', '/res?id={}'.format(slot_id))
+	version = VERSION_PATTERN.search(page or b'')
+	form = {'slot_id': slot_id}
+	if version is not None: form['version'] = version.group(1).decode()
+	client.request(scenario, 'POST', '/setReservation', form=form)
+	client.request(scenario, 'POST', '/cancelReservation', form={'slot_id': slot_id})
+
+def emergency(client, rng, data, scenario='emergency'):
+	client.chat(scenario, rng.choice(EMERGENCY_MESSAGES))
+
+def mixed(client, rng, data):
+	flow = rng.choices(list(MIXED_WEIGHTS), weights=list(MIXED_WEIGHTS.values()))[0]
+	FLOWS[flow](client, rng, data, scenario='mixed')
+
+FLOWS = {'knowledge': knowledge, 'appointments': appointments, 'availability': availability, 'reservation': reservation, 'emergency': emergency, 'mixed': mixed}
+
+
+def summarize(records, elapsed):
+	latencies = np.array([latency for _, latency, _, _ in records]) * 1000
+	ttfts = np.array([ttft for _, _, ttft, _ in records if ttft is not None]) * 1000
+	percentile = lambda values, p: round(float(np.percentile(values, p)), 2) if len(values) > 0 else None
+	return {'requests': len(records), 'errors': sum(not ok for _, _, _, ok in records),
+	        'p50_ms': percentile(latencies, 50), 'p99_ms': percentile(latencies, 99),
+	        'ttft_p50_ms': percentile(ttfts, 50), 'ttft_p99_ms': percentile(ttfts, 99),
+	        'throughput': round(len(records) / elapsed, 3)}
+
+def run_scenario(port, scenario, concurrency, iterations, data, seed):
+	"""
+	Let `concurrency` simulated users, each with its own session, run the flow of a scenario `iterations` times.
+
+	:return: The latency percentiles (milliseconds) and throughput (requests per second) of their requests.
+	"""
+	records = []
+	def user(i):
+		client, rng = Client(port, records), random.Random('{}-{}-{}-{}'.format(seed, scenario, concurrency, i))
+		for _ in range(iterations): FLOWS[scenario](client, rng, data)
+
+	start = time.perf_counter()
+	with ThreadPoolExecutor(max_workers=concurrency) as executor:
+		list(executor.map(user, range(concurrency)))
+	return summarize(records, time.perf_counter() - start)
+
+
+def prepare_assets(assets, n_doctors, n_slots, n_conditions, seed):
+	# Synthetic database and indexed corpus, created by benchmarks/synthetic.py with the assets folder of the server
+	env = dict(os.environ, MEDASSIST_ASSETS=assets)
+	subprocess.run([sys.executable, '-m', 'benchmarks.synthetic', '--doctors', str(n_doctors), '--slots', str(n_slots),
+	                '--conditions', str(n_conditions), '--seed', str(seed)], cwd=ROOT_DIR, env=env, check=True)
+	# Answers cached and chat history written by a previous run would change the results
+	for folder in ('answer_cache', 'chat_history'): shutil.rmtree(os.path.join(assets, folder), ignore_errors=True)
+
+def free_port():
+	with socket.socket() as s:
+		s.bind(('127.0.0.1', 0))
+		return s.getsockname()[1]
+
+def scenario_data(n_doctors, n_slots, n_conditions, seed):
+	# Questions, doctors and free slots of the synthetic assets, used by the flows
+	doctor_names = [name for name, _ in synthetic.doctors(n_doctors, seed)]
+	return {'questions': synthetic.questions(n_conditions, seed), 'doctors': doctor_names,
+	        'free_slots': [i for i, _, _, patient in synthetic.appointments(doctor_names, n_slots, seed=seed) if patient is None]}
+
+def start_server(server, assets, port, token_latency, prompt_latency, parallel, log, timeout=600., workers=1):
+	"""
+	Start the app on the synthetic assets, with the scripted LLM, and wait until its components are loaded. With
+	gunicorn, `workers` processes share the `parallel` generations of the LLM.
+	"""
+	env = dict(os.environ, MEDASSIST_ASSETS=assets, MEDASSIST_LLM_BACKEND='scripted', MEDASSIST_SCRIPTED_TOKEN_LATENCY=str(token_latency),
+	           MEDASSIST_SCRIPTED_PROMPT_LATENCY=str(prompt_latency), MEDASSIST_SCRIPTED_PARALLEL=str(parallel), MEDASSIST_LOG_LEVEL='WARNING')
+	if server == 'gunicorn': env.update(MEDASSIST_WORKERS=str(workers), MEDASSIST_LLM_CONCURRENCY=str(parallel))
+	process = subprocess.Popen(SERVER_COMMANDS[server](port), cwd=ROOT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline:
+		if process.poll() is not None: raise RuntimeError("The server exited with status {}, see {}".format(process.returncode, log.name))
+		try:
+			conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+			conn.request('GET', '/ready')
+			response = conn.getresponse()
+			if response.status == 200: return process
+			status = json.loads(response.read())
+			if status.get('error') is not None: raise RuntimeError("The server failed to start: {}, see {}".format(status['error'], log.name))
+		except (OSError, http.client.HTTPException, ValueError):
+			pass
+		time.sleep(0.5)
+	process.terminate()
+	raise RuntimeError("The server was not ready after {:.0f}s, see {}".format(timeout, log.name))
+
+
+def compare(baseline, results, tolerance):
+	"""
+	Print the change of each metric against a baseline, flagging changes for the worse beyond `tolerance`.
+
+	:return: The number of regressions.
+	"""
+	if baseline['params'] != results['params']: print("Warning: the baseline was run with different parameters: {}".format(baseline['params']))
+	regressions = 0
+	print("{:<13} {:>11} {:<12} {:>10} {:>10} {:>8}".format('scenario', 'concurrency', 'metric', 'baseline', 'current', 'change'))
+	for scenario, levels in results['results'].items():
+		for concurrency, stats in levels.items():
+			previous = baseline['results'].get(scenario, {}).get(concurrency)
+			if previous is None: continue
+			for metric, higher_is_better in COMPARED_METRICS.items():
+				if not previous.get(metric) or stats.get(metric) is None: continue
+				change = stats[metric] / previous[metric] - 1
+				regression = (-change if higher_is_better else change) > tolerance
+				regressions += regression
+				print("{:<13} {:>11} {:<12} {:>10.2f} {:>10.2f} {:>+7.1%}{}".format(scenario, concurrency, metric, previous[metric], stats[metric], change, '  REGRESSION' if regression else ''))
+	return regressions
+
+def benchmark(args):
+	params = {k: getattr(args, k) for k in ('server', 'doctors', 'slots', 'conditions', 'iterations', 'token_latency', 'prompt_latency', 'parallel', 'seed')}
+	prepare_assets(args.assets, args.doctors, args.slots, args.conditions, args.seed)
+	data = scenario_data(args.doctors, args.slots, args.conditions, args.seed)
+
+	port = free_port()
+	with open(os.path.join(args.assets, 'server.log'), 'w') as log:
+		process = start_server(args.server, args.assets, port, args.token_latency, args.prompt_latency, args.parallel, log)
+		try:
+			results = {}
+			print("Server: {}, doctors: {}, slots: {}, conditions: {}, token latency: {:.0f}ms, prompt latency: {:.2f}ms/token, parallel generations: {}".format(
+				args.server, args.doctors, args.slots, args.conditions, args.token_latency * 1000, args.prompt_latency * 1000, args.parallel))
+			print("{:<13} {:>11} {:>9} {:>7} {:>9} {:>9} {:>10} {:>10} {:>8}".format('scenario', 'concurrency', 'requests', 'errors', 'p50 (ms)', 'p99 (ms)', 'ttft p50', 'ttft p99', 'req/s'))
+			for scenario in args.scenarios:
+				results[scenario] = {}
+				for concurrency in args.concurrency:
+					stats = run_scenario(port, scenario, concurrency, args.iterations, data, args.seed)
+					results[scenario][str(concurrency)] = stats
+					print("{:<13} {:>11} {:>9} {:>7} {:>9} {:>9} {:>10} {:>10} {:>8.2f}".format(scenario, concurrency, stats['requests'], stats['errors'],
+						stats['p50_ms'], stats['p99_ms'], stats['ttft_p50_ms'] or '-', stats['ttft_p99_ms'] or '-', stats['throughput']))
+		finally:
+			process.terminate()
+			process.wait()
+	return {'params': params, 'results': results}
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Load test of the app with a scripted stand-in for the LLM, on a synthetic database and corpus.")
+	parser.add_argument('--server', choices=list(SERVER_COMMANDS), default='flask', help="Flask app (app.py), ASGI app (asgi.py, served by hypercorn), or Flask app served by gunicorn (one worker, see benchmarks/scaling.py).")
+	parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+	parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8], help="Numbers of concurrent users.")
+	parser.add_argument('--iterations', type=int, default=4, help="Flows run by each user, per scenario and concurrency level.")
+	parser.add_argument('--doctors', type=int, default=200)
+	parser.add_argument('--slots', type=int, default=20000)
+	parser.add_argument('--conditions', type=int, default=500, help="Medical conditions in the synthetic corpus.")
+	parser.add_argument('--token-latency', type=float, default=SCRIPTED_LLM_TOKEN_LATENCY, help="Seconds per generated token.")
+	parser.add_argument('--prompt-latency', type=float, default=SCRIPTED_LLM_PROMPT_LATENCY, help="Seconds per prompt token.")
+	parser.add_argument('--parallel', type=int, default=SCRIPTED_LLM_PARALLEL, help="Concurrent generations of the LLM.")
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--assets', default=os.path.join(ASSETS_FOLDER, 'benchmark'), help="Folder of the synthetic assets, reused across runs.")
+	parser.add_argument('--save', help="Save the results to this JSON file, e.g. as a baseline.")
+	parser.add_argument('--compare', help="Compare the results with a baseline saved with --save.")
+	parser.add_argument('--tolerance', type=float, default=0.1, help="Relative change for the worse reported as a regression.")
+	args = parser.parse_args()
+
+	results = benchmark(args)
+	if args.save is not None:
+		with open(args.save, 'w') as f:
+			json.dump(results, f, indent=2)
+	if args.compare is not None:
+		with open(args.compare, 'r') as f:
+			baseline = json.load(f)
+		if compare(baseline, results, args.tolerance) > 0: sys.exit(1)
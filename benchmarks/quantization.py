@@ -0,0 +1,110 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import faiss
+
+from src.embeddings import EmbeddingService
+from src.vector_index import build_index
+from src.create_index import DATA_PATH
+from benchmarks.embeddings import load_texts
+from benchmarks.retrieval import sample_questions
+from config import *
+
+
+# Embedding backends compared with the current one (PyTorch, float32), as (backend, ONNX quantization)
+BACKENDS = {'torch': ('torch', None), 'onnx': ('onnx', None), 'onnx_int8': ('onnx', EMBEDDING_ONNX_QUANTIZATION)}
+STORAGE_TYPES = ('flat', 'fp16', 'sq8')
+
+
+def rss_mb():
+	# Resident memory of the process (Linux)
+	with open('/proc/self/statm') as f:
+		return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+
+def embed(backend, texts_path, out_path, threads, batch_size):
+	# Runs in a process of its own, so that the memory of each backend is measured alone
+	with open(texts_path, 'r') as f:
+		texts = json.load(f)
+	before = rss_mb()
+	service = EmbeddingService(EMBEDDING_MODEL, batch_size=batch_size, threads=threads, normalize=EMBEDDING_NORMALIZE, device='cpu',
+	                           backend=BACKENDS[backend][0], onnx_quantization=BACKENDS[backend][1], onnx_path=EMBEDDING_ONNX_PATH)
+	model_mb = rss_mb() - before
+	service.encode(texts['corpus'][:32]) # Warm up
+	start = time.perf_counter()
+	corpus = service.encode(texts['corpus'])
+	throughput = len(corpus) / (time.perf_counter() - start)
+	queries = service.encode(texts['queries'])
+	np.savez(out_path, corpus=corpus, queries=queries, throughput=throughput, model_mb=model_mb,
+	         peak_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+def run_backend(backend, texts_path, tmp, threads, batch_size):
+	out_path = os.path.join(tmp, backend + '.npz')
+	subprocess.run([sys.executable, '-m', 'benchmarks.quantization', '--embed', backend, '--texts', texts_path, '--out', out_path,
+	                '--threads', str(threads), '--batch-size', str(batch_size)], cwd=ROOT_DIR, check=True)
+	return dict(np.load(out_path))
+
+def flat_index(vectors):
+	index = faiss.IndexFlatL2(vectors.shape[1])
+	index.add(vectors)
+	return index
+
+def recall(index, queries, ground_truth, k):
+	# Fraction of the k nearest chunks of the current path that are also found
+	_, ids = index.search(queries, k)
+	return np.mean([len(set(found) & set(expected)) / k for found, expected in zip(ids, ground_truth)])
+
+def benchmark(n, n_queries, k, threads, batch_size, backends):
+	corpus = load_texts(DATA_PATH, n)
+	queries = [q for q, _ in sample_questions(DATA_PATH, n_queries)]
+	# Without the dataset, queries are the beginnings of random chunks
+	if len(queries) == 0: queries = [' '.join(t.split()[:12]) for t in random.Random(0).sample(corpus, min(n_queries, len(corpus)))]
+	print("Chunks: {}, queries: {}, k: {}, threads: {}".format(len(corpus), len(queries), k, threads))
+
+	with tempfile.TemporaryDirectory() as tmp:
+		texts_path = os.path.join(tmp, 'texts.json')
+		with open(texts_path, 'w') as f:
+			json.dump({'corpus': corpus, 'queries': queries}, f)
+		results = {backend: run_backend(backend, texts_path, tmp, threads, batch_size) for backend in ['torch'] + [b for b in backends if b != 'torch']}
+
+	# Agreement with the current path: PyTorch embeddings in a flat index
+	reference = results['torch']
+	_, ground_truth = flat_index(reference['corpus']).search(reference['queries'], k)
+	print("{:<10} {:>10} {:>11} {:>10} {:>8} {:>9}".format('backend', 'chunks/s', 'model (MB)', 'peak (MB)', 'cosine', 'recall@k'))
+	for backend, r in results.items():
+		cosine = np.mean(np.sum(r['corpus'] * reference['corpus'], axis=1) / (np.linalg.norm(r['corpus'], axis=1) * np.linalg.norm(reference['corpus'], axis=1)))
+		print("{:<10} {:>10.1f} {:>11.1f} {:>10.1f} {:>8.4f} {:>9.3f}".format(backend, float(r['throughput']), float(r['model_mb']), float(r['peak_mb']),
+			cosine, recall(flat_index(r['corpus']), r['queries'], ground_truth, k)))
+
+	# Vectors stored as float32, float16 or int8, searched with the queries of the same backend
+	print("{:<10} {:<6} {:>10} {:>10} {:>9}".format('backend', 'index', 'size (MB)', 'bytes/vec', 'recall@k'))
+	for backend, r in results.items():
+		source = flat_index(r['corpus'])
+		for index_type in STORAGE_TYPES:
+			index = build_index(source, index_type)
+			size = faiss.serialize_index(index).nbytes
+			print("{:<10} {:<6} {:>10.2f} {:>10.1f} {:>9.3f}".format(backend, index_type, size / 2**20, size / index.ntotal,
+				recall(index, r['queries'], ground_truth, k)))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Throughput, memory and retrieval agreement of the ONNX (float32 and int8) embedding backends and of float16/int8 index storage, against PyTorch embeddings in a flat index.")
+	parser.add_argument('-n', type=int, default=2000, help="Number of chunks to embed and index.")
+	parser.add_argument('--queries', type=int, default=200, help="Number of queries (MedQuAD questions).")
+	parser.add_argument('-k', type=int, default=K, help="Number of neighbours.")
+	parser.add_argument('--threads', type=int, default=EMBEDDING_THREADS, help="Number of CPU threads.")
+	parser.add_argument('--batch-size', type=int, default=EMBEDDING_BATCH_SIZE)
+	parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS))
+	parser.add_argument('--embed', choices=list(BACKENDS), help=argparse.SUPPRESS)
+	parser.add_argument('--texts', help=argparse.SUPPRESS)
+	parser.add_argument('--out', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.embed is not None: embed(args.embed, args.texts, args.out, args.threads, args.batch_size)
+	else: benchmark(args.n, args.queries, args.k, args.threads, args.batch_size, args.backends)
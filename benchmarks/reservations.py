@@ -0,0 +1,93 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from src import db, reservations
+from src.create_db import create_db
+from config import *
+
+
+RESET_APPOINTMENTS = "UPDATE appointments SET patient = NULL WHERE id IN ({})"
+
+
+def reserve_read_then_write(user_name, slot_id):
+	# Previous access pattern: read the slot, then write it in a separate statement if it looked free. Two callers can
+	# both see the slot free before either writes it
+	row = db.get_appointment(slot_id)
+	if row is None or row[2] is not None: return False
+	db.execute("UPDATE appointments SET patient = ? WHERE id = ?", (user_name, slot_id))
+	return True
+
+def reserve_conditional(user_name, slot_id):
+	return reservations.reserve(user_name, slot_id)['response'] == reservations.SUCCESS_RESPONSES['reserve']
+
+def reserve_batch(user_name, slot_ids):
+	# All-or-nothing reservation of every slot
+	results = reservations.reserve_many(user_name, slot_ids, atomic=True)
+	updated = [r['response'] == reservations.SUCCESS_RESPONSES['reserve'] for r in results]
+	if any(updated) and not all(updated): raise AssertionError("Partial atomic batch for {}".format(user_name))
+	return [slot_id for slot_id, u in zip(slot_ids, updated) if u]
+
+def run(fn, slots, threads, rounds, batch=False):
+	"""
+	Let every thread, each with a distinct user, try to reserve the same slots at the same time, for a number of rounds.
+
+	:return: The number of double bookings, of lost reservations (the owner in the database is not the winner), and
+	         the throughput in reservation attempts per second.
+	"""
+	double_bookings, lost, elapsed = 0, 0, 0.
+	barrier = threading.Barrier(threads)
+	def worker(i, slots):
+		user_name = 'patient{}'.format(i)
+		barrier.wait()
+		if batch: return user_name, fn(user_name, slots)
+		return user_name, [slot_id for slot_id in slots if fn(user_name, slot_id)]
+
+	with ThreadPoolExecutor(max_workers=threads) as executor:
+		for _ in range(rounds):
+			db.execute(RESET_APPOINTMENTS.format(','.join('?' * len(slots))), tuple(slots))
+			orders = [random.sample(slots, len(slots)) for _ in range(threads)]
+			start = time.perf_counter()
+			results = list(executor.map(worker, range(threads), orders))
+			elapsed += time.perf_counter() - start
+
+			# Users told that their reservation of each slot succeeded, and the actual owners
+			winners = collections.defaultdict(list)
+			for user_name, reserved in results:
+				for slot_id in reserved: winners[slot_id].append(user_name)
+			double_bookings += sum(len(users) - 1 for users in winners.values() if len(users) > 1)
+			owners = {slot_id: db.get_appointment(slot_id)[2] for slot_id in slots}
+			lost += sum(owners[slot_id] not in users for slot_id, users in winners.items())
+
+	return double_bookings, lost, threads * len(slots) * rounds / elapsed
+
+
+def benchmark(threads, rounds):
+	with tempfile.TemporaryDirectory() as tmp:
+		path = os.path.join(tmp, 'bench.db')
+		create_db(path).close()
+		db.open_pool(path, size=threads)
+		slots = [r[0] for r in db.fetchall("SELECT id FROM appointments WHERE patient IS NULL")]
+
+		print("Concurrent users: {}, contended slots: {}, rounds: {}".format(threads, len(slots), rounds))
+		print("{:<20} {:>16} {:>18} {:>12}".format('pattern', 'double bookings', 'lost reservations', 'attempts/s'))
+		for name, fn, batch in (('read-then-write', reserve_read_then_write, False),
+		                        ('conditional update', reserve_conditional, False),
+		                        ('atomic batch', reserve_batch, True)):
+			double_bookings, lost, throughput = run(fn, slots, threads, rounds, batch=batch)
+			print("{:<20} {:>16} {:>18} {:>12.0f}".format(name, double_bookings, lost, throughput))
+		db.close_pool()
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Stress test of concurrent reservations of the same slots, counting double bookings.")
+	parser.add_argument('--threads', type=int, default=16, help="Number of concurrent users.")
+	parser.add_argument('--rounds', type=int, default=50, help="Number of rounds, each starting with all slots free.")
+	args = parser.parse_args()
+
+	benchmark(args.threads, args.rounds)
@@ -0,0 +1,96 @@
+import os
+import glob
+import time
+import random
+import argparse
+import numpy as np
+
+from src import load_hf_embeddings
+from src.ingest import iter_qa_pairs
+from src.retrieval import HybridSearch, CrossEncoderReranker, reciprocal_rank_fusion
+from src.vector_index import open_index
+from src.create_index import DATA_PATH
+from config import *
+
+
+def sample_questions(data_path, n, seed=0):
+	# Question/answer pairs of MedQuAD, sampled uniformly over the files of the dataset
+	files = sorted(glob.glob(os.path.join(data_path, '*', '*.xml')))
+	random.Random(seed).shuffle(files)
+	questions = []
+	for file_path in files:
+		questions += [(q, metadata) for q, _, metadata in iter_qa_pairs(file_path)]
+		if len(questions) >= 4 * n: break
+	return random.Random(seed).sample(questions, min(n, len(questions)))
+
+def is_relevant(document, metadata):
+	# Chunks of the answer itself (native parser), or of the same file (unstructured parser, one document per file)
+	if os.path.basename(document.metadata.get('source', '')) != os.path.basename(metadata['source']): return False
+	return 'qid' not in document.metadata or document.metadata['qid'] == metadata['qid']
+
+def hits(searcher, positions, metadata):
+	return [is_relevant(d, metadata) for d in searcher.documents(positions)]
+
+def timed(fn, *args):
+	start = time.perf_counter()
+	result = fn(*args)
+	return result, time.perf_counter() - start
+
+def evaluate(searcher, questions, k, reranker=None):
+	"""
+	Run each stage of the retrieval on the questions.
+
+	:return: A dict mapping each stage to its (hits@k, hits@candidates, latencies) lists.
+	"""
+	n = searcher.candidates
+	stages = {name: ([], [], []) for name in ('dense', 'lexical', 'hybrid (rrf)', 'hybrid + rerank', 'memoized')}
+	def record(name, relevant, latency):
+		stages[name][0].append(any(relevant[:k]))
+		stages[name][1].append(any(relevant))
+		stages[name][2].append(latency)
+
+	for question, metadata in questions:
+		dense, dense_s = timed(searcher.dense, question, n)
+		lexical, lexical_s = timed(searcher.lexical, question, n)
+		fused, fuse_s = timed(lambda: reciprocal_rank_fusion([dense, lexical], k=searcher.rrf_k)[:n])
+		record('dense', hits(searcher, dense, metadata), dense_s)
+		record('lexical', hits(searcher, lexical, metadata), lexical_s)
+		record('hybrid (rrf)', hits(searcher, fused, metadata), dense_s + lexical_s + fuse_s)
+		if reranker is not None:
+			documents, read_s = timed(searcher.documents, fused)
+			order, rerank_s = timed(reranker.rerank, question, documents)
+			record('hybrid + rerank', [is_relevant(documents[i], metadata) for i in order], dense_s + lexical_s + fuse_s + read_s + rerank_s)
+
+		# Repeated query, answered from the memoized results
+		searcher.search(question, k)
+		documents, memo_s = timed(searcher.search, question, k)
+		record('memoized', [is_relevant(d, metadata) for d in documents], memo_s)
+	return {name: stage for name, stage in stages.items() if len(stage[2]) > 0}
+
+def benchmark(n_questions, k, candidates, rerank):
+	questions = sample_questions(DATA_PATH, n_questions)
+	embeddings = load_hf_embeddings()
+	index, docstore = open_index(INDEX_PATH, INDEX_TYPE, nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH, mmap=INDEX_MMAP)
+	reranker = CrossEncoderReranker(RERANKER_MODEL, batch_size=RERANKER_BATCH_SIZE, threads=EMBEDDING_THREADS) if rerank else None
+	searcher = HybridSearch(embeddings, index, docstore, mode='hybrid', candidates=candidates, rrf_k=RETRIEVAL_RRF_K, cache_size=len(questions))
+	searcher.dense(questions[0][0], candidates) # Warm up
+	if searcher.mode != 'hybrid': print("The docstore has no lexical index, run src/create_index.py to build it.")
+
+	results = evaluate(searcher, questions, k, reranker=reranker)
+	print("Documents: {}, questions: {}, k: {}, candidates: {}".format(docstore.size, len(questions), k, candidates))
+	print("{:<16} {:>9} {:>17} {:>10} {:>9}".format('stage', 'recall@k', 'recall@candidates', 'mean (ms)', 'p99 (ms)'))
+	for name, (top_k, pool, latencies) in results.items():
+		latencies = np.array(latencies) * 1000
+		print("{:<16} {:>9.3f} {:>17.3f} {:>10.2f} {:>9.2f}".format(name, np.mean(top_k), np.mean(pool), latencies.mean(), np.percentile(latencies, 99)))
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Recall and latency of each retrieval stage (dense, BM25, fusion, reranking) on MedQuAD questions.")
+	parser.add_argument('--questions', type=int, default=200, help="Number of sampled questions.")
+	parser.add_argument('--k', type=int, default=K, help="Number of documents returned to the agent.")
+	parser.add_argument('--candidates', type=int, default=RETRIEVAL_CANDIDATES, help="Candidates per ranking before fusion and reranking.")
+	parser.add_argument('--rerank', action='store_true', help="Also evaluate the cross-encoder reranker.")
+	args = parser.parse_args()
+
+	benchmark(args.questions, args.k, args.candidates, args.rerank)
@@ -0,0 +1,97 @@
+import time
+import argparse
+import collections
+import numpy as np
+
+from src import load_hf_embeddings, load_router, initialize_llm
+from config import *
+
+
+# Labelled requests, distinct from the router's examples. 'agent' marks requests that must be left to the agent.
+LABELLED_QUERIES = [
+	("Could you recommend a neurologist?", 'find_doctor'),
+	("I need to see a dermatologist for a rash", 'find_doctor'),
+	("Who are your cardiologists?", 'find_doctor'),
+	("Do you have any endocrinologist?", 'find_doctor'),
+	("I'm searching for a specialist in gastroenterology", 'find_doctor'),
+	("Any pneumology doctors?", 'find_doctor'),
+	("What times is Dr. Amicis free?", 'available_slots'),
+	("Can I book Dr. Muller?", 'available_slots'),
+	("Free slots for Dr Dubois please", 'available_slots'),
+	("I want an appointment with doctor Brazov", 'available_slots'),
+	("When does Dr. Mirabella have availability?", 'available_slots'),
+	("What slots are open with Lyubor?", 'available_slots'),
+	("What appointments have I booked?", 'my_appointments'),
+	("Remind me of my appointments", 'my_appointments'),
+	("Do I have an appointment scheduled with Dr. Lyubor?", 'my_appointments'),
+	("Show my upcoming visits", 'my_appointments'),
+	("What did I reserve?", 'my_appointments'),
+	("Give me my chat history", 'chat_history'),
+	("I'd like to download this conversation", 'chat_history'),
+	("Can I export the messages we exchanged?", 'chat_history'),
+	("What are the side effects of ibuprofen?", 'agent'),
+	("How can I lower my cholesterol?", 'agent'),
+	("I think I am having a heart attack", 'agent'),
+	("My head hurts a lot and I see flashes", 'agent'),
+	("What is the difference between type 1 and type 2 diabetes?", 'agent'),
+	("Which specialist treats kidney stones?", 'agent'),
+	("Good morning", 'agent'),
+	("No, thanks", 'agent'),
+	("Is psoriasis contagious?", 'agent'),
+	("What does a neurologist treat?", 'agent'),
+]
+
+
+def route_all(router, queries):
+	# Routed intent ('agent' if the router falls back) and latency of each request
+	intents, latencies = [], []
+	for query, _ in queries:
+		start = time.perf_counter()
+		intent, _ = router.dispatch(query)
+		latencies.append(time.perf_counter() - start)
+		intents.append(intent)
+	return intents, np.array(latencies) * 1000
+
+def agent_latencies(agent, queries):
+	latencies = []
+	for query, _ in queries:
+		start = time.perf_counter()
+		agent.invoke({"messages": [("user", query)]})
+		latencies.append(time.perf_counter() - start)
+	return np.array(latencies) * 1000
+
+def benchmark(with_agent=False):
+	embeddings = load_hf_embeddings()
+	router = load_router(embeddings)
+	router.route(LABELLED_QUERIES[0][0]) # Warm up
+
+	intents, latencies = route_all(router, LABELLED_QUERIES)
+	labels = [label for _, label in LABELLED_QUERIES]
+	correct = sum(i == l for i, l in zip(intents, labels))
+	# Wrong tool calls are the harmful errors, fallbacks of routable requests only cost latency
+	wrong = sum(i != l and i != 'agent' for i, l in zip(intents, labels))
+	missed = sum(i == 'agent' and l != 'agent' for i, l in zip(intents, labels))
+	print("Requests: {}, routing accuracy: {:.1%}, wrongly routed: {}, fell back to the agent: {}".format(len(labels), correct / len(labels), wrong, missed))
+
+	print("{:<16} {:>9} {:>7}".format('intent', 'requests', 'recall'))
+	counts = collections.Counter(labels)
+	for intent, n in counts.items():
+		hits = sum(i == l == intent for i, l in zip(intents, labels))
+		print("{:<16} {:>9} {:>7.1%}".format(intent, n, hits / n))
+
+	routed = [q for q, i in zip(LABELLED_QUERIES, intents) if i != 'agent']
+	print("Router latency: mean {:.1f}ms, p99 {:.1f}ms".format(latencies.mean(), np.percentile(latencies, 99)))
+	if with_agent and len(routed) > 0:
+		agent = initialize_llm(USER_NAME, HOST, k=K, max_tokens=MAX_TOKENS, temp=T, embeddings=embeddings)
+		agent_ms = agent_latencies(agent, routed)
+		routed_ms = latencies[[i != 'agent' for i in intents]]
+		print("Routed requests: {}, agent latency: mean {:.0f}ms, router latency: mean {:.1f}ms ({:.0f}x faster)".format(
+			len(routed), agent_ms.mean(), routed_ms.mean(), agent_ms.mean() / routed_ms.mean()))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Routing accuracy and latency of the intent router on a labelled set of requests.")
+	parser.add_argument('--agent', action='store_true', help="Also time the agent on the routed requests (requires Ollama).")
+	args = parser.parse_args()
+
+	benchmark(args.agent)
@@ -0,0 +1,82 @@
+import os
+import json
+import argparse
+
+from benchmarks import load
+from config import *
+
+
+# Scenarios bound by the CPU and the database of the server rather than by the LLM: routed appointment questions,
+# retrieval answers with a fast LLM, availability pages and reservations
+SCALING_SCENARIOS = ('appointments', 'knowledge', 'availability', 'reservation')
+
+
+def memory_mb(pid):
+	"""
+	Resident and proportional memory of a process and its children (the workers of gunicorn), in MB. The proportional
+	memory counts the pages shared by several processes once, split between them, so that it measures what the workers
+	share with the master.
+	"""
+	pids = [pid]
+	for p in pids:
+		for task in os.listdir('/proc/{}/task'.format(p)):
+			with open('/proc/{}/task/{}/children'.format(p, task)) as f:
+				pids += [int(child) for child in f.read().split()]
+	rss = pss = 0
+	for p in pids:
+		with open('/proc/{}/smaps_rollup'.format(p)) as f:
+			for line in f:
+				if line.startswith('Rss:'): rss += int(line.split()[1])
+				elif line.startswith('Pss:'): pss += int(line.split()[1])
+	return rss / 1024, pss / 1024
+
+def benchmark(args):
+	data = load.scenario_data(args.doctors, args.slots, args.conditions, args.seed)
+	results = {}
+	print("Doctors: {}, slots: {}, conditions: {}, concurrency: {}, token latency: {:.0f}ms, parallel generations: {}, CPUs: {}".format(
+		args.doctors, args.slots, args.conditions, args.concurrency, args.token_latency * 1000, args.parallel, os.cpu_count()))
+	print("{:<13} {:>7} {:>9} {:>7} {:>9} {:>9} {:>8} {:>8}".format('scenario', 'workers', 'requests', 'errors', 'p50 (ms)', 'p99 (ms)', 'req/s', 'speedup'))
+	for workers in args.workers:
+		# Fresh assets for each server, so that reservations, cached answers and history do not carry over
+		load.prepare_assets(args.assets, args.doctors, args.slots, args.conditions, args.seed)
+		port = load.free_port()
+		with open(os.path.join(args.assets, 'server.log'), 'w') as log:
+			process = load.start_server('gunicorn', args.assets, port, args.token_latency, args.prompt_latency, args.parallel, log, workers=workers)
+			try:
+				results[str(workers)] = {}
+				for scenario in args.scenarios:
+					stats = load.run_scenario(port, scenario, args.concurrency, args.iterations, data, args.seed)
+					results[str(workers)][scenario] = stats
+					base = results[str(args.workers[0])][scenario]['throughput']
+					print("{:<13} {:>7} {:>9} {:>7} {:>9} {:>9} {:>8.2f} {:>7.2f}x".format(scenario, workers, stats['requests'], stats['errors'],
+						stats['p50_ms'], stats['p99_ms'], stats['throughput'], stats['throughput'] / base))
+				# Once all workers have served requests
+				results[str(workers)]['memory_mb'] = memory_mb(process.pid)
+				print("{:<13} {:>7} RSS: {:.0f} MB, PSS: {:.0f} MB".format('memory', workers, *results[str(workers)]['memory_mb']))
+			finally:
+				process.terminate()
+				process.wait()
+	return results
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Throughput and latency of the app served by gunicorn with an increasing number of worker processes, with a scripted stand-in for the LLM.")
+	parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help="Numbers of worker processes, the first one is the reference of the speedups.")
+	parser.add_argument('--scenarios', nargs='+', choices=load.SCENARIOS, default=list(SCALING_SCENARIOS))
+	parser.add_argument('--concurrency', type=int, default=16, help="Concurrent users.")
+	parser.add_argument('--iterations', type=int, default=4, help="Flows run by each user, per scenario and number of workers.")
+	parser.add_argument('--doctors', type=int, default=200)
+	parser.add_argument('--slots', type=int, default=20000)
+	parser.add_argument('--conditions', type=int, default=500, help="Medical conditions in the synthetic corpus.")
+	parser.add_argument('--token-latency', type=float, default=0., help="Seconds per generated token, none by default so that the server is the bottleneck.")
+	parser.add_argument('--prompt-latency', type=float, default=0., help="Seconds per prompt token.")
+	parser.add_argument('--parallel', type=int, default=16, help="Concurrent generations of the LLM, shared by all workers.")
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--assets', default=os.path.join(ASSETS_FOLDER, 'benchmark'), help="Folder of the synthetic assets, recreated for each number of workers.")
+	parser.add_argument('--save', help="Save the results to this JSON file.")
+	args = parser.parse_args()
+
+	results = benchmark(args)
+	if args.save is not None:
+		with open(args.save, 'w') as f:
+			json.dump(results, f, indent=2)
@@ -0,0 +1,60 @@
+import os
+import time
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.messages import AIMessage
+
+from src.sessions import SessionStore, SharedSessionStore, run_turn, current_user
+from config import *
+
+
+class EchoAgent:
+	# Stand-in for the chat agent: answers after a fixed delay with the user and message it received
+	def __init__(self, latency):
+		self.latency = latency
+
+	def invoke(self, inputs, config=None):
+		time.sleep(self.latency)
+		msg = inputs['messages'][-1].content
+		return {'messages': inputs['messages'] + [AIMessage(content="{} | {}".format(current_user.get(), msg))]}
+
+def simulate_session(store, agent, i, turns):
+	session_id, user_name = 'session-{}'.format(i), 'user-{}'.format(i)
+	errors = 0
+	for j in range(turns):
+		session = store.get(session_id, user_name)
+		msg = '{} message {}'.format(session_id, j)
+		response = run_turn(session, msg, agent)
+		# The answer and the whole conversation must belong to this session only
+		if response != '{} | {}'.format(user_name, msg): errors += 1
+		errors += sum(1 for m in session.messages if session_id + ' ' not in m.content)
+	return errors
+
+def load_test(n_sessions, turns, latency, shared=False):
+	with tempfile.TemporaryDirectory() as tmp:
+		# The store of multi-worker servers keeps sessions in SQLite, loaded and saved around each turn
+		store = SessionStore(max_sessions=n_sessions, ttl=SESSION_TTL) if not shared else \
+		        SharedSessionStore(os.path.join(tmp, 'sessions.db'), os.path.join(tmp, 'locks'), max_sessions=n_sessions, ttl=SESSION_TTL)
+		agent = EchoAgent(latency)
+		start = time.perf_counter()
+		with ThreadPoolExecutor(max_workers=n_sessions) as executor:
+			errors = sum(executor.map(lambda i: simulate_session(store, agent, i, turns), range(n_sessions)))
+		elapsed = time.perf_counter() - start
+		if shared: store.close()
+
+	print("Store: {}, sessions: {}, turns per session: {}, agent latency: {:.0f}ms".format('shared' if shared else 'in-memory', n_sessions, turns, latency * 1000))
+	print("Cross-talk errors: {}".format(errors))
+	print("Throughput: {:.1f} turns/s".format(n_sessions * turns / elapsed))
+	return errors
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Concurrent simulated sessions against the session store, checking for cross-talk.")
+	parser.add_argument('--sessions', type=int, default=64, help="Number of concurrent sessions.")
+	parser.add_argument('--turns', type=int, default=20, help="Number of turns per session.")
+	parser.add_argument('--latency', type=float, default=0.01, help="Simulated agent latency, in seconds.")
+	parser.add_argument('--shared', action='store_true', help="Use the session store shared by the workers of a multi-worker server.")
+	args = parser.parse_args()
+
+	load_test(args.sessions, args.turns, args.latency, shared=args.shared)
@@ -0,0 +1,125 @@
+import os
+import random
+import sqlite3
+import argparse
+import datetime
+from xml.sax.saxutils import escape
+
+from src.create_db import create_schema, insert_doctors, insert_appointments, EMERGENCIES_SCHEMA, TIME_FORMAT
+from src.create_index import create_index
+from config import *
+
+
+SPECIALIZATIONS = ['Neurology', 'Pneumology', 'Endocrinology', 'Gastroenterology', 'Cardiology', 'Dermatology',
+                   'Nephrology', 'Rheumatology', 'Oncology', 'Urology', 'Hematology', 'Immunology']
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'ven', 'tor', 'sel', 'dun', 'bri', 'co', 'fa', 'gel', 'nor', 'pa', 'quin', 'ser',
+             'tal', 'ul', 'vis', 'zan', 'mer', 'ost', 'ple', 'dra']
+CONDITION_SUFFIXES = ['syndrome', 'disease', 'fever', 'disorder', 'deficiency', 'dystrophy']
+QUESTION_TYPES = [('information', "What is {}?"), ('symptoms', "What are the symptoms of {}?"), ('causes', "What causes {}?"),
+                  ('treatment', "What are the treatments for {}?"), ('prevention', "How to prevent {}?")]
+ANSWER_WORDS = """
+	patients may experience pain fatigue fever swelling inflammation of the joints skin lungs kidneys or heart which can
+	be mild or severe and often develop slowly over months treatment usually includes medication rest physical therapy
+	and regular follow up with a specialist while some people need surgery diagnosis is based on blood tests imaging a
+	physical exam and the medical history of the family the condition is more common in older adults and in people with
+	a weakened immune system risk factors include smoking obesity infections and certain genetic variants
+	""".split()
+# Time slots start on the next Monday, since the app only offers time slots after the current time
+START_TIME = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=7 - datetime.date.today().weekday()), datetime.time(9))
+SLOTS_PER_DAY = 8
+CORPUS_FOLDER = 'Synthetic'
+
+
+def make_name(rng, syllables):
+	return ''.join(rng.choice(SYLLABLES) for _ in range(syllables)).capitalize()
+
+def unique_names(n, seed, make):
+	rng, names = random.Random(seed), []
+	seen = set()
+	while len(names) < n:
+		name = make(rng)
+		if name in seen: continue
+		seen.add(name)
+		names.append(name)
+	return names
+
+def doctors(n, seed=0):
+	"""
+	:return: A list of n (doctor name, specialization) pairs.
+	"""
+	names = unique_names(n, 'doctors-{}'.format(seed), lambda rng: 'Dr. ' + make_name(rng, rng.randint(2, 3)))
+	return [(name, SPECIALIZATIONS[i % len(SPECIALIZATIONS)]) for i, name in enumerate(names)]
+
+def appointments(doctor_names, n_slots, booked=0.1, seed=0):
+	"""
+	Time slots of one hour, spread evenly over the doctors, `SLOTS_PER_DAY` per day, with a fraction booked by other
+	patients.
+
+	:return: A list of (slot id, doctor name, time slot, patient) tuples.
+	"""
+	rng = random.Random('appointments-{}'.format(seed))
+	slots = []
+	for i in range(n_slots):
+		doctor, j = doctor_names[i % len(doctor_names)], i // len(doctor_names)
+		time = START_TIME + datetime.timedelta(days=j // SLOTS_PER_DAY, hours=j % SLOTS_PER_DAY)
+		patient = 'patient{}'.format(rng.randrange(1000)) if rng.random() < booked else None
+		slots.append((i, doctor, time.strftime(TIME_FORMAT), patient))
+	return slots
+
+def conditions(n, seed=0):
+	return unique_names(n, 'conditions-{}'.format(seed), lambda rng: '{} {}'.format(make_name(rng, 3), rng.choice(CONDITION_SUFFIXES)))
+
+def questions(n_conditions, seed=0):
+	return [template.format(condition) for condition in conditions(n_conditions, seed) for _, template in QUESTION_TYPES]
+
+def answer(rng, condition, words):
+	# Random words, mentioning the condition at the start and in the middle of the answer
+	text = [rng.choice(ANSWER_WORDS) for _ in range(words)]
+	return '{} {} {} {}.'.format(condition, ' '.join(text[:words // 2]), condition, ' '.join(text[words // 2:]))
+
+def create_synthetic_db(path, n_doctors, n_slots, booked=0.1, seed=0):
+	# Replaces the database, so that each run starts from the same slots and without emergencies
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	if os.path.exists(path): os.remove(path)
+	db = sqlite3.connect(path)
+	cur = db.cursor()
+	create_schema(cur)
+	create_schema(cur, EMERGENCIES_SCHEMA)
+	doctor_list = doctors(n_doctors, seed)
+	doctor_ids = insert_doctors(cur, doctor_list)
+	insert_appointments(cur, appointments([name for name, _ in doctor_list], n_slots, booked=booked, seed=seed), doctor_ids)
+	db.commit()
+	db.close()
+
+def write_corpus(data_path, n_conditions, words=120, seed=0):
+	"""
+	Write a MedQuAD-like corpus: one XML file per condition, with a question/answer pair per question type. Files of a
+	previous run with the same parameters are identical, so that the index is not updated again.
+	"""
+	folder = os.path.join(data_path, CORPUS_FOLDER)
+	os.makedirs(folder, exist_ok=True)
+	rng = random.Random('corpus-{}'.format(seed))
+	for i, condition in enumerate(conditions(n_conditions, seed)):
+		pairs = ''.join('<QAPair pid="{0}"><Question qid="{1}_{0}" qtype="{2}">{3}</Question><Answer>{4}</Answer></QAPair>'.format(
+			j, i, qtype, escape(template.format(condition)), escape(answer(rng, condition, words))) for j, (qtype, template) in enumerate(QUESTION_TYPES))
+		with open(os.path.join(folder, '{}.xml'.format(i)), 'w') as f:
+			f.write('<Document id="{0}" url="synthetic/{0}"><Focus>{1}</Focus><QAPairs>{2}</QAPairs></Document>'.format(i, escape(condition), pairs))
+	# Conditions of a previous, larger corpus
+	for file_name in os.listdir(folder):
+		if int(file_name.split('.')[0]) >= n_conditions: os.remove(os.path.join(folder, file_name))
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Create a synthetic database and corpus, and index the corpus, in the assets folder (MEDASSIST_ASSETS).")
+	parser.add_argument('--doctors', type=int, default=200, help="Number of doctors.")
+	parser.add_argument('--slots', type=int, default=20000, help="Number of time slots.")
+	parser.add_argument('--conditions', type=int, default=500, help="Number of medical conditions in the corpus, with {} questions each.".format(len(QUESTION_TYPES)))
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	print("Creating database with {} doctors and {} time slots...".format(args.doctors, args.slots))
+	create_synthetic_db(DB_PATH, args.doctors, args.slots, seed=args.seed)
+	print("Writing corpus of {} conditions...".format(args.conditions))
+	data_path = os.path.join(ASSETS_FOLDER, 'data')
+	write_corpus(data_path, args.conditions, seed=args.seed)
+	create_index(data_path, INDEX_PATH, CHUNK_SIZE, CHUNK_OVERLAP, parser='native')
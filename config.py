@@ -4,10 +4,34 @@ import os
 USER_NAME = 'Martini'
 HOST = '127.0.0.1'
 PORT = 8080
+SECRET_KEY = os.environ.get('MEDASSIST_SECRET_KEY') # Signs session cookies, generated once in SECRET_KEY_PATH if unset
+SESSION_MAX = 1000
+SESSION_TTL = 3600. # Seconds of inactivity after which a conversation is discarded
+
+# Logging, tracing and profiling
+LOG_LEVEL = os.environ.get('MEDASSIST_LOG_LEVEL', 'INFO') # DEBUG also logs messages, responses and the agent's steps
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+TRACE_BUFFER = 100 # Recent request traces served by /debug/traces
+PROFILER = os.environ.get('MEDASSIST_PROFILER', '0') == '1' # Enables the sampling profiler at /debug/profile
+PROFILER_INTERVAL = 0.005 # Seconds between stack samples
+PROFILER_MAX_SECONDS = 60.
+
+# Async serving (asgi.py)
+ASYNC_THREADS = 16 # Threads running blocking work (SQLite, embeddings, file I/O)
+LLM_CONCURRENCY = int(os.environ.get('MEDASSIST_LLM_CONCURRENCY', 1)) # Requests served concurrently by the local Ollama backend
+LLM_QUEUE_SIZE = 16 # Requests waiting for the LLM before new ones are rejected with 429
+
+# Multi-worker serving (gunicorn.conf.py): components are loaded once before the workers are forked, and the workers
+# share conversation sessions and the LLM_CONCURRENCY slots of the LLM backend through files in WORKERS_FOLDER
+WORKERS = int(os.environ.get('MEDASSIST_WORKERS', 1))
+PREFORK = os.environ.get('MEDASSIST_PREFORK') == '1' # Set by gunicorn.conf.py, in the master process loading the app
+WORKER_THREADS = 8 # Requests served concurrently by each worker
+SESSION_LOCK_STRIPES = 256 # Lock files shared by the sessions
+LLM_SLOT_POLL_INTERVAL = 0.01 # Seconds between attempts to take an LLM slot when all are taken
 
 # File paths
 ROOT_DIR = os.path.dirname(__file__)
-ASSETS_FOLDER = os.path.join(ROOT_DIR, 'assets')
+ASSETS_FOLDER = os.environ.get('MEDASSIST_ASSETS', os.path.join(ROOT_DIR, 'assets')) # e.g. the synthetic assets of benchmarks/load.py
 DB_ROOT = os.path.join(ASSETS_FOLDER, 'database')
 DB_NAME = 'medassist'
 DB_PATH = os.path.join(DB_ROOT, DB_NAME + '.db')
@@ -15,13 +39,108 @@ INDEX_ROOT = os.path.join(ASSETS_FOLDER, 'index')
 INDEX_NAME = 'medassist'
 INDEX_PATH = os.path.join(INDEX_ROOT, INDEX_NAME + '.faiss')
 CHAT_HISTORY_FOLDER = os.path.join(ASSETS_FOLDER, 'chat_history')
+HISTORY_DB_PATH = os.path.join(CHAT_HISTORY_FOLDER, 'history.db')
+HISTORY_ARCHIVE_FOLDER = os.path.join(CHAT_HISTORY_FOLDER, 'archive')
+WORKERS_FOLDER = os.path.join(ASSETS_FOLDER, 'workers')
+SESSION_DB_PATH = os.path.join(WORKERS_FOLDER, 'sessions.db')
+SESSION_LOCK_FOLDER = os.path.join(WORKERS_FOLDER, 'session_locks')
+LLM_SLOTS_FOLDER = os.path.join(WORKERS_FOLDER, 'llm_slots')
+SECRET_KEY_PATH = os.path.join(WORKERS_FOLDER, 'secret_key')
+METRICS_FOLDER = os.path.join(WORKERS_FOLDER, 'metrics')
+
+# Parameters for database access
+DB_POOL_SIZE = 8
+DB_TIMEOUT = 30.
+DB_CACHED_STATEMENTS = 128
+
+# Parameters for the chat history
+HISTORY_FLUSH_INTERVAL = 1. # Maximum seconds a queued message waits for its batch to fill before it is written
+HISTORY_FLUSH_TIMEOUT = 5. # Maximum seconds an export waits for the messages queued before it to be written
+HISTORY_BATCH_SIZE = 256 # Queued messages that trigger a write before the flush interval
+HISTORY_MAX_MESSAGES = 10000 # Messages per user kept in the live store, older ones are archived
+HISTORY_SEGMENT_SIZE = 2000 # Messages per compressed archive segment
+HISTORY_PAGE_SIZE = 100
+
+# Parameters for reservations
+MAX_BATCH_SLOTS = 50 # Maximum time slots per request to /batchReservation
+
+# Parameters for availability lookups
+AVAILABILITY_PAGE_SIZE = 100 # Maximum time slots per page of /availability
+AVAILABILITY_TOOL_SLOTS = 10 # Time slots returned to the agent per lookup, so that they do not flood its context
+CALENDAR_SLOT_MINUTES = 30 # Duration of the time slots of generated calendars (src/create_db.py --weeks)
+
+# Parameters for emergencies
+EMERGENCY_CODES = ('RED', 'YELLOW', 'GREEN') # From the most to the least urgent
+EMERGENCY_ALERT_CODES = ('RED', 'YELLOW') # Codes delivered by default to live subscribers
+EMERGENCY_PAGE_SIZE = 100
+EMERGENCY_KEEPALIVE = 15. # Seconds between keep-alive comments on idle emergency streams
+EMERGENCY_POLL_INTERVAL = 1. # Seconds between polls of `src/check_emergencies.py --follow`
+EMERGENCY_SUBSCRIBER_QUEUE = 1000 # Pending events per subscriber, slower subscribers catch up from the database
+STAFF_TOKEN = os.environ.get('MEDASSIST_STAFF_TOKEN') # Bearer token of the emergency endpoints, disabled if unset
+
+# Parameters for embeddings
+EMBEDDING_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_THREADS = os.cpu_count()
+EMBEDDING_NORMALIZE = True
+EMBEDDING_CACHE_PATH = os.path.join(ASSETS_FOLDER, 'embedding_cache')
+EMBEDDING_CACHE_LRU_SIZE = 10000
+EMBEDDING_BACKEND = os.environ.get('MEDASSIST_EMBEDDING_BACKEND', 'torch') # 'torch', or 'onnx' (ONNX Runtime on CPU, requires optimum[onnxruntime])
+EMBEDDING_ONNX_QUANTIZATION = 'avx2' # Int8 model for the CPU ('arm64', 'avx2', 'avx512' or 'avx512_vnni'), or None for float32
+EMBEDDING_ONNX_PATH = os.path.join(ASSETS_FOLDER, 'onnx') # Quantized models exported from EMBEDDING_MODEL
 
 # Parameters for creating vector index
 CHUNK_SIZE = 500
 CHUNK_OVERLAP = 20
+INDEX_BATCH_SIZE = 256
+INDEX_CHECKPOINT_BATCHES = 50
+INGEST_WORKERS = max(1, (os.cpu_count() or 1) - 1)
+INGEST_QUEUE_FACTOR = 4
+INGEST_PARSER = 'unstructured'
+
+# Parameters for the serving index
+INDEX_TYPE = 'flat' # One of 'flat', 'ivf_flat', 'hnsw', 'ivf_pq', or 'fp16', 'sq8', 'ivf_sq8' (vectors stored as float16 or int8)
+INDEX_NLIST = 1024 # Number of IVF cells (capped based on the number of vectors)
+INDEX_HNSW_M = 32
+INDEX_PQ_M = 16 # Number of PQ sub-quantizers, must divide the embedding dimension
+INDEX_PQ_BITS = 8
+INDEX_TRAIN_SIZE = 100000
+INDEX_NPROBE = 16
+INDEX_EF_SEARCH = 64
+INDEX_MMAP = True
+INDEX_APPEND_MAX_GROWTH = 1. # New vectors are appended to a trained serving index until it grows by this fraction, then it is exported again
+
+# Parameters for the retrieval of medical information
+RETRIEVAL_MODE = 'hybrid' # One of 'dense' (vector index), 'lexical' (BM25) or 'hybrid' (both, with reciprocal rank fusion)
+RETRIEVAL_CANDIDATES = 20 # Candidates retrieved by each ranking before fusion (and reranking)
+RETRIEVAL_RRF_K = 60 # Rank offset of reciprocal rank fusion
+RETRIEVAL_CACHE_SIZE = 1024 # Memoized results of repeated queries
+RERANKER = False # Rerank the fused candidates with a cross-encoder (CPU)
+RERANKER_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+RERANKER_BATCH_SIZE = 16
+
+# Parameters for the semantic answer cache
+ANSWER_CACHE = True
+ANSWER_CACHE_PATH = os.path.join(ASSETS_FOLDER, 'answer_cache')
+ANSWER_CACHE_THRESHOLD = 0.95 # Minimum cosine similarity between a question and a cached one
+ANSWER_CACHE_SIZE = 1000
+ANSWER_CACHE_TTL = 24 * 3600. # Seconds after which a cached answer is discarded
+
+# Parameters for the intent router
+ROUTER = True
+ROUTER_THRESHOLD = 0.6 # Minimum cosine similarity between a request and the nearest example of its intent
+ROUTER_MARGIN = 0.05 # Minimum similarity gap between the best and the second best intent
 
 # Parameters for LLM initialization
-CHAT_BUFFER = 5
+LLM_BACKEND = os.environ.get('MEDASSIST_LLM_BACKEND', 'ollama') # 'ollama', or 'scripted' (deterministic stand-in, see src/scripted_llm.py)
+LLM_MODEL = 'llama3.1'
+LLM_KEEP_ALIVE = '30m' # How long Ollama keeps the model loaded after the last request
+SCRIPTED_LLM_TOKEN_LATENCY = float(os.environ.get('MEDASSIST_SCRIPTED_TOKEN_LATENCY', 0.02)) # Seconds per generated token
+SCRIPTED_LLM_PROMPT_LATENCY = float(os.environ.get('MEDASSIST_SCRIPTED_PROMPT_LATENCY', 0.0005)) # Seconds per prompt token
+SCRIPTED_LLM_PARALLEL = int(os.environ.get('MEDASSIST_SCRIPTED_PARALLEL', 1)) # Concurrent generations, like OLLAMA_NUM_PARALLEL
+HISTORY_TOKENS = 1024 # Token budget of the conversation history sent to the LLM with each turn, besides the system prompt
+HISTORY_TOOL_RESULT_TOKENS = 150 # Tokens kept of each tool result of previous turns
+HISTORY_SUMMARY_TOKENS = 256 # Maximum size of the summary of the turns that no longer fit in the history
 K=2
 T=0.1
 MAX_TOKENS = 500
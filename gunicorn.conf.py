@@ -0,0 +1,38 @@
+import os
+import shutil
+
+# Read by the config: the app is loaded in the master, before the workers are forked (see `helper.model_threads`)
+os.environ['MEDASSIST_PREFORK'] = '1'
+
+from config import *
+
+
+# Multi-worker serving of the Flask app: MEDASSIST_WORKERS=4 gunicorn -c gunicorn.conf.py app:app
+# The app is loaded once in the master process, and the workers are forked once its components are loaded, so that
+# they share the memory of the embedding model and of the vector index instead of loading a copy each.
+bind = '{}:{}'.format(HOST, PORT)
+workers = WORKERS
+worker_class = 'gthread'
+threads = WORKER_THREADS
+preload_app = True
+
+# Metrics of all workers are written to files, collected by /metrics (see src/metrics.py). The folder must be set
+# before the app is loaded.
+shutil.rmtree(METRICS_FOLDER, ignore_errors=True)
+os.makedirs(METRICS_FOLDER)
+os.environ['PROMETHEUS_MULTIPROC_DIR'] = METRICS_FOLDER
+
+
+def when_ready(server):
+    # Called in the master once the app is loaded, before the workers are forked
+    from app import startup
+    from src import workers
+    workers.prepare_fork(startup)
+
+def post_fork(server, worker):
+    from src import workers
+    workers.after_fork(server.num_workers)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1 +1 @@
-from .helper import initialize_llm, parse_results
\ No newline at end of file
+from .helper import initialize_llm, start_components, load_hf_embeddings, load_answer_cache, load_router, load_reranker, load_retriever, parse_results
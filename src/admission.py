@@ -0,0 +1,53 @@
+import asyncio
+import contextlib
+
+
+class QueueFull(Exception):
+    def __init__(self, position):
+        super().__init__("Admission queue is full ({} requests ahead)".format(position))
+        self.position = position
+
+
+class AdmissionQueue:
+    """
+    Limits the number of requests that are served concurrently by the LLM backend (`concurrency`), and the number of
+    requests that are waiting for their turn (`max_waiting`). Requests are admitted in arrival order; when the queue is
+    full, new requests are rejected with `QueueFull` instead of piling up.
+    """
+
+    def __init__(self, concurrency=1, max_waiting=16):
+        self.concurrency = concurrency
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def position(self):
+        """
+        Number of requests ahead of a request arriving now, i.e. 0 if it would be served immediately.
+        """
+        return max(0, self.active + self.waiting - self.concurrency + 1)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """
+        Wait for a free slot, and hold it for the duration of the `async with` block.
+
+        :raises QueueFull: If `max_waiting` requests are already waiting.
+        """
+        position = self.position()
+        if position > self.max_waiting:
+            raise QueueFull(position)
+
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
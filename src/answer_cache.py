@@ -0,0 +1,218 @@
+import os
+import re
+import json
+import time
+import logging
+import threading
+import collections
+import numpy as np
+import faiss
+from langchain_core.messages import AIMessage
+
+from . import metrics
+from .vector_index import index_file
+from .workers import FileLock
+from config import *
+
+
+logger = logging.getLogger(__name__)
+
+
+# Only turns answered from the knowledge base alone (guideline 5 of the prompt) are cached: answers about doctors,
+# appointments, emergencies or the user's own data depend on who asks and when.
+CACHEABLE_TOOLS = {'search_medical_information'}
+# Questions about the user's own situation: first-person references (including relatives, "my son") and ages. Their
+# answers are about the person asking, and must not be served to other users.
+PERSONAL_PATTERN = re.compile(r"\b(i|i'm|im|i've|i'd|i'll|me|my|mine|myself|we|we're|us|our|ours)\b|\b\d+[\s-]*(years?|yrs?|months?)[\s-]*old\b|\baged?\s+\d+", re.IGNORECASE)
+# References to earlier turns ("what are its symptoms?") and openers of follow-up questions ("and for children?"): the
+# question only makes sense with the conversation it belongs to
+FOLLOW_UP_PATTERN = re.compile(r"\b(it|its|it's|they|them|their|this|that|these|those|he|him|his|she|her|former|latter|same|above|previous|also|too)\b|^\W*(and|or|but|so|then|what about|how about)\b", re.IGNORECASE)
+ENTRIES_NAME = 'answers.json'
+INDEX_NAME = 'answers.faiss'
+
+
+def index_version(save_path=INDEX_PATH, index_type=INDEX_TYPE):
+    # Changes whenever src/create_index.py exports a new serving index
+    try:
+        stat = os.stat(index_file(save_path, index_type))
+    except FileNotFoundError:
+        return None
+    return '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+
+def is_shareable(question, user_name, context=False):
+    """
+    Check whether a question can be answered for any user alike: it does not mention the user or their own situation,
+    and, if the conversation has earlier turns, it does not refer to them.
+
+    :param user_name: The name of the user.
+    :param context: Whether the question follows earlier turns of the conversation.
+    """
+    if PERSONAL_PATTERN.search(question) is not None or user_name.lower() in question.lower(): return False
+    return not context or FOLLOW_UP_PATTERN.search(question) is None
+
+def is_cacheable(question, new_messages, user_name, context=False):
+    """
+    Check whether a turn is a pure knowledge question, i.e. the question is shareable (see `is_shareable`), the agent
+    only searched medical information, and the answer does not address the user by name.
+
+    :param new_messages: The messages produced by the agent in the turn.
+    :param user_name: The name of the user.
+    :param context: Whether the question follows earlier turns of the conversation.
+    """
+    if not is_shareable(question, user_name, context): return False
+    tools = {call['name'] for m in new_messages if isinstance(m, AIMessage) for call in m.tool_calls}
+    if len(tools) == 0 or not tools <= CACHEABLE_TOOLS: return False
+    return user_name.lower() not in new_messages[-1].content.lower()
+
+
+class AnswerCache:
+    """
+    Semantic cache of the agent's answers. Questions are embedded and looked up in a small dedicated FAISS index, and
+    the answer of the most similar cached question is served if their cosine similarity is at least `threshold`.
+    Entries are evicted after `ttl` seconds or when more than `max_entries` are cached (least recently used first),
+    and the whole cache is discarded when the serving index changes. The cache is saved to `path`, if given.
+    """
+
+    def __init__(self, embeddings, path=None, threshold=0.95, max_entries=1000, ttl=86400., index_path=INDEX_PATH, index_type=INDEX_TYPE):
+        self.embeddings = embeddings
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.index_path = index_path
+        self.index_type = index_type
+        self._lock = threading.Lock()
+        self.clear(index_version(index_path, index_type))
+        if path is not None: self._load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self, version=None):
+        # Entries by id, in least recently used order, and their question vectors
+        self._entries = collections.OrderedDict()
+        self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.embeddings.dim))
+        self._next_id = 0
+        self.version = version
+        metrics.ANSWER_CACHE_ENTRIES.set(0)
+
+    def _embed(self, text):
+        vector = np.asarray([self.embeddings.embed_query(text)], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _check_version(self):
+        version = index_version(self.index_path, self.index_type)
+        if version != self.version:
+            logger.info("Serving index changed, clearing answer cache")
+            self.clear(version)
+
+    def _remove(self, ids):
+        self._index.remove_ids(np.asarray(ids, dtype=np.int64))
+        for i in ids: del self._entries[i]
+        metrics.ANSWER_CACHE_ENTRIES.set(len(self._entries))
+
+    def _evict(self, now):
+        expired = [i for i, entry in self._entries.items() if now - entry['created'] > self.ttl]
+        overflow = len(self._entries) - len(expired) - self.max_entries
+        if overflow > 0:
+            expired_ids = set(expired)
+            kept = (i for i in self._entries if i not in expired_ids)
+            expired += [next(kept) for _ in range(overflow)]
+        if len(expired) > 0: self._remove(expired)
+
+    def _nearest(self, vector):
+        # Id of the most similar cached question, if similar enough
+        if self._index.ntotal == 0: return None
+        scores, ids = self._index.search(vector, 1)
+        return int(ids[0][0]) if ids[0][0] >= 0 and scores[0][0] >= self.threshold else None
+
+    def lookup(self, question, user_name=USER_NAME, context=False):
+        """
+        Look up the answer to a question similar to the given one, if the question is shareable (see `is_shareable`).
+
+        :param context: Whether the question follows earlier turns of the conversation.
+        :return: The cached answer, or None.
+        """
+        if not is_shareable(question, user_name, context):
+            metrics.ANSWER_CACHE_LOOKUPS.labels('skipped').inc()
+            return None
+        start = time.perf_counter()
+        vector = self._embed(question)
+        with self._lock:
+            self._check_version()
+            i = self._nearest(vector)
+            if i is not None and time.time() - self._entries[i]['created'] > self.ttl:
+                self._remove([i])
+                i = None
+            if i is None:
+                metrics.ANSWER_CACHE_LOOKUPS.labels('miss').inc()
+                return None
+            self._entries.move_to_end(i)
+            entry = self._entries[i]
+
+        metrics.ANSWER_CACHE_LOOKUPS.labels('hit').inc()
+        metrics.ANSWER_CACHE_SAVED_SECONDS.inc(max(0., entry['elapsed'] - (time.perf_counter() - start)))
+        return entry['answer']
+
+    def store(self, question, answer, elapsed):
+        """
+        Cache the answer to a question.
+
+        :param elapsed: The time taken by the agent to answer, in seconds.
+        """
+        vector = self._embed(question)
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            # A near-duplicate question replaces the cached one
+            i = self._nearest(vector)
+            if i is not None: self._remove([i])
+            self._entries[self._next_id] = {'question': question, 'answer': answer, 'elapsed': elapsed, 'created': now}
+            self._index.add_with_ids(vector, np.asarray([self._next_id], dtype=np.int64))
+            self._next_id += 1
+            self._evict(now)
+            metrics.ANSWER_CACHE_ENTRIES.set(len(self._entries))
+
+    def store_turn(self, question, new_messages, user_name, elapsed, context=False):
+        """
+        Cache the answer of a turn, if it is a pure knowledge question (see `is_cacheable`).
+        """
+        if not is_cacheable(question, new_messages, user_name, context):
+            metrics.ANSWER_CACHE_STORES.labels('skipped').inc()
+            return
+        self.store(question, new_messages[-1].content, elapsed)
+        metrics.ANSWER_CACHE_STORES.labels('stored').inc()
+
+    def save(self):
+        """
+        Save the cache, writing temporary files first, so that an interrupted save does not corrupt it. Saves of the
+        workers of a multi-worker server, each with its own cache, are serialized, and the last one is kept.
+        """
+        if self.path is None: return
+        os.makedirs(self.path, exist_ok=True)
+        with FileLock(os.path.join(self.path, 'save.lock')):
+            with self._lock:
+                entries = {'version': self.version, 'next_id': self._next_id, 'entries': [dict(entry, id=i) for i, entry in self._entries.items()]}
+                faiss.write_index(self._index, os.path.join(self.path, INDEX_NAME + '.tmp'))
+            with open(os.path.join(self.path, ENTRIES_NAME + '.tmp'), 'w') as f:
+                json.dump(entries, f)
+            os.replace(os.path.join(self.path, INDEX_NAME + '.tmp'), os.path.join(self.path, INDEX_NAME))
+            os.replace(os.path.join(self.path, ENTRIES_NAME + '.tmp'), os.path.join(self.path, ENTRIES_NAME))
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.path, ENTRIES_NAME)) as f:
+                saved = json.load(f)
+            index = faiss.read_index(os.path.join(self.path, INDEX_NAME))
+        except (FileNotFoundError, ValueError, RuntimeError):
+            return
+        # Answers based on a previous version of the serving index are discarded
+        if saved['version'] != self.version or index.d != self.embeddings.dim or index.ntotal != len(saved['entries']): return
+        self._index = index
+        self._entries = collections.OrderedDict((entry.pop('id'), entry) for entry in saved['entries'])
+        self._next_id = saved['next_id']
+        with self._lock:
+            self._evict(time.time())
+        metrics.ANSWER_CACHE_ENTRIES.set(len(self._entries))
+        logger.info("Loaded {} cached answers".format(len(self._entries)))
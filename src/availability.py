@@ -0,0 +1,64 @@
+import datetime
+
+from . import db
+from config import *
+
+
+FIELDS = ('id', 'time_slot', 'doctor')
+
+# Upper bound of an open time range. Lookups never start before the current time, so that past slots are not offered.
+MAX_TIME = '\U0010ffff'
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def as_slot(row):
+    return dict(zip(FIELDS, row))
+
+def parse_date(text):
+    """
+    Validate a 'YYYY-MM-DD' date, e.g. given by the agent or the query string.
+
+    :return: The date, or None if the text is empty.
+    :raise ValueError: If the date is malformed.
+    """
+    if text is None or text.strip() == '': return None
+    return datetime.date.fromisoformat(text.strip())
+
+def current_time():
+    return datetime.datetime.now().strftime(TIME_FORMAT)
+
+def date_range(start_date=None, end_date=None):
+    """
+    :return: The (start, end) bounds of the time slots between two dates, both included, for the queries below.
+    """
+    start, end = parse_date(start_date), parse_date(end_date)
+    return (start.isoformat() if start is not None else None,
+            (end + datetime.timedelta(days=1)).isoformat() if end is not None else None)
+
+def list_available(doctor, start=None, end=None, after=None, limit=AVAILABILITY_PAGE_SIZE):
+    """
+    Read a page of the free time slots of a doctor, in chronological order, optionally within a time range.
+
+    :param start: Start of the time range (inclusive), as a 'YYYY-MM-DD[ HH:MM:SS]' string, the current time if None
+                  or earlier.
+    :param end: End of the time range (exclusive), as a 'YYYY-MM-DD[ HH:MM:SS]' string.
+    :param after: Id of the last time slot of the previous page, None for the first page.
+    :return: A list of time slots, as dicts.
+    """
+    # Keyset cursor on (time slot, id): the page starts after the previous one, and not before the start of the range
+    cursor = (max(start or '', current_time()), -1)
+    if after is not None:
+        after_time = db.appointment_time(after)
+        if after_time is not None: cursor = max(cursor, (after_time, after))
+    return [as_slot(r) for r in db.find_available_appointments(doctor, cursor[0], cursor[1], end or MAX_TIME, limit)]
+
+def next_available(specialization, n=AVAILABILITY_TOOL_SLOTS, start=None, end=None):
+    """
+    Find the first n free time slots with any doctor of a specialization, in chronological order.
+
+    :param start: Start of the time range (inclusive), as a 'YYYY-MM-DD[ HH:MM:SS]' string, the current time if None
+                  or earlier.
+    :param end: End of the time range (exclusive), as a 'YYYY-MM-DD[ HH:MM:SS]' string.
+    :return: A list of time slots, as dicts.
+    """
+    return [as_slot(r) for r in db.find_next_available_appointments(specialization, max(start or '', current_time()), end or MAX_TIME, n)]
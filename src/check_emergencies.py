@@ -1,24 +1,47 @@
-import sqlite3
+import time
+import argparse
 
+from src import db
+from src.emergencies import list_emergencies, emergencies_after
 from config import *
 
 
-def check_emergencies():
-	# Connect to database
-	db = sqlite3.connect(DB_PATH)
-	cur = db.cursor()
-	
-	# Prepare query
-	query = """
-			SELECT *
-			FROM emergencies
-			"""
-	result = cur.execute(query)
-	emergencies = result.fetchall()
-	
+def print_emergency(e):
+	print('* [{}] {} #{} {} (user {}): {}'.format(e['time'], e['code'], e['id'], e['patient'], e['user'], e['question']))
+
+def check_emergencies(codes, start=None, end=None, after=None, limit=EMERGENCY_PAGE_SIZE):
+	# Retrieve a page of emergencies through the shared connection pool
+	emergencies = list_emergencies(codes, start=start, end=end, after=after, limit=limit)
+
 	print("List of emergencies:")
-	for e in emergencies: print('* {}'.format(e))
-	
-	
+	for e in emergencies: print_emergency(e)
+	if len(emergencies) == limit: print("More emergencies: use --after {}".format(emergencies[-1]['id']))
+
+def follow_emergencies(codes, after=None, interval=EMERGENCY_POLL_INTERVAL):
+	# Poll for new emergencies, reading only the ones after the last seen id (this runs in a separate process, so it
+	# cannot subscribe to the in-process bus of the server)
+	cursor = db.last_emergency_id() if after is None else after
+	print("Following {} emergencies after #{} (Ctrl+C to stop)".format('/'.join(codes), cursor))
+	while True:
+		for events, cursor in emergencies_after(cursor, codes):
+			for e in events: print_emergency(e)
+		time.sleep(interval)
+
+
 if __name__ == '__main__':
-	check_emergencies()
+	parser = argparse.ArgumentParser(description="List registered emergencies, or follow new ones.")
+	parser.add_argument('--code', action='append', choices=EMERGENCY_CODES, help="Color-code to include (repeatable). By default, all codes are listed, and RED and YELLOW are followed.")
+	parser.add_argument('--start', default=None, help="Start of the time range (inclusive), as 'YYYY-MM-DD[ HH:MM:SS]'.")
+	parser.add_argument('--end', default=None, help="End of the time range (exclusive), as 'YYYY-MM-DD[ HH:MM:SS]'.")
+	parser.add_argument('--after', type=int, default=None, help="Id of the last emergency seen: list the next page, or follow from there.")
+	parser.add_argument('--limit', type=int, default=EMERGENCY_PAGE_SIZE, help="Page size.")
+	parser.add_argument('--follow', action='store_true', help="Print new emergencies as they are registered.")
+	parser.add_argument('--interval', type=float, default=EMERGENCY_POLL_INTERVAL, help="Seconds between polls when following.")
+	args = parser.parse_args()
+
+	try:
+		if args.follow: follow_emergencies(args.code or EMERGENCY_ALERT_CODES, after=args.after, interval=args.interval)
+		else: check_emergencies(args.code or EMERGENCY_CODES, start=args.start, end=args.end, after=args.after, limit=args.limit)
+	except KeyboardInterrupt:
+		pass
+	db.close_pool()
@@ -0,0 +1,124 @@
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
+
+from . import metrics, tracing
+from config import *
+
+
+# Id of the message carrying the summary of the earlier conversation, so that it is not stored with the history
+SUMMARY_ID = 'conversation-summary'
+TRUNCATED = ' [...]'
+SUMMARY_LINE_CHARS = 200
+
+
+def count_tokens(text):
+    # Rough number of tokens of a text, about 4 characters per token in English
+    return max(1, len(text) // 4)
+
+def message_tokens(message):
+    # Content, and the arguments of tool calls, plus a few tokens of role and formatting
+    tokens = count_tokens(str(message.content)) + 4
+    if isinstance(message, AIMessage): tokens += sum(count_tokens(str(call['args'])) for call in message.tool_calls)
+    return tokens
+
+def split_turns(messages):
+    """
+    Split a conversation into turns, each starting with a user message and followed by the tool calls, tool results
+    and answer of the agent. Messages before the first user message form a turn of their own.
+    """
+    turns = []
+    for m in messages:
+        if isinstance(m, HumanMessage) or len(turns) == 0: turns.append([])
+        turns[-1].append(m)
+    return turns
+
+def truncate(text, max_chars):
+    if len(text) <= max_chars or text.endswith(TRUNCATED): return text
+    return text[:max_chars].rsplit(' ', 1)[0] + TRUNCATED
+
+def compress_tool_results(turn, max_tokens):
+    # Tool results keep their first `max_tokens` tokens, and their call id, so that the tool call is not orphaned
+    return [ToolMessage(content=truncate(str(m.content), 4 * max_tokens), tool_call_id=m.tool_call_id, name=m.name, id=m.id)
+            if isinstance(m, ToolMessage) else m for m in turn]
+
+def drop_tool_calls(turn):
+    # The user message and the final answer, without the tool calls and their results
+    return [m for m in turn if not isinstance(m, ToolMessage) and not (isinstance(m, AIMessage) and m.tool_calls)]
+
+def summarize_turns(summary, turns):
+    """
+    Extend the summary of a conversation with older turns, as one line per turn with the user message, the tools called
+    and the start of the answer. Only the new turns are read, the summary is not generated again.
+    """
+    lines = [summary] if summary else []
+    for turn in turns:
+        question = ' '.join(str(m.content) for m in turn if isinstance(m, HumanMessage))
+        tools = sorted({call['name'] for m in turn if isinstance(m, AIMessage) for call in m.tool_calls})
+        answers = [str(m.content) for m in turn if isinstance(m, AIMessage) and not m.tool_calls and m.content]
+        if not question and not answers: continue
+        line = "- The user said: {}".format(truncate(' '.join(question.split()), SUMMARY_LINE_CHARS))
+        if tools: line += " (looked up with {})".format(', '.join(tools))
+        if answers: line += " The assistant answered: {}".format(truncate(' '.join(answers[-1].split()), SUMMARY_LINE_CHARS))
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+class ContextWindow:
+    """
+    Token-aware conversation history of a session. Once the history exceeds `max_tokens`, it is reduced in this order,
+    starting with the oldest turns, until it fits:
+      1. tool results of previous turns are cut to `tool_result_tokens` (always applied, they are mostly retrieved
+         chunks and time slots that the answer already quotes),
+      2. previous turns drop their tool calls and results, keeping the user message and the answer,
+      3. previous turns are folded into a rolling summary of at most `summary_tokens`, sent as a system message.
+    Turns are kept or removed as a whole, so that a tool call is never sent without its result. The current turn is
+    always kept.
+
+    :param summarize: A function (summary, turns) -> summary, extending the summary with the given turns.
+    """
+
+    def __init__(self, max_tokens=HISTORY_TOKENS, tool_result_tokens=HISTORY_TOOL_RESULT_TOKENS, summary_tokens=HISTORY_SUMMARY_TOKENS,
+                 summarize=summarize_turns):
+        self.max_tokens = max_tokens
+        self.tool_result_tokens = tool_result_tokens
+        self.summary_tokens = summary_tokens
+        self.summarize = summarize
+
+    def _trim_summary(self, summary):
+        # Oldest lines of the summary are dropped first
+        lines = summary.split('\n')
+        while len(lines) > 1 and count_tokens('\n'.join(lines)) > self.summary_tokens: lines.pop(0)
+        return truncate('\n'.join(lines), 4 * self.summary_tokens)
+
+    def fit(self, messages, summary=''):
+        """
+        :return: The messages that fit within the budget, and the summary of the removed ones.
+        """
+        turns = split_turns([m for m in messages if m.id != SUMMARY_ID])
+        if len(turns) == 0: return [], summary
+        turns = [compress_tool_results(turn, self.tool_result_tokens) for turn in turns[:-1]] + [turns[-1]]
+        sizes = [sum(message_tokens(m) for m in turn) for turn in turns]
+        total = lambda: sum(sizes) + (count_tokens(summary) if summary else 0)
+
+        # Drop the tool calls of previous turns, oldest first
+        for i in range(len(turns) - 1):
+            if total() <= self.max_tokens: break
+            turns[i] = drop_tool_calls(turns[i])
+            sizes[i] = sum(message_tokens(m) for m in turns[i])
+
+        # Fold the oldest turns into the summary, leaving room for it
+        if total() > self.max_tokens and len(turns) > 1:
+            folded = 1
+            while folded < len(turns) - 1 and sum(sizes[folded:]) + self.summary_tokens > self.max_tokens: folded += 1
+            summary = self._trim_summary(self.summarize(summary, turns[:folded]))
+            turns, sizes = turns[folded:], sizes[folded:]
+        return [m for turn in turns for m in turn], summary
+
+    def prompt(self, messages, summary=''):
+        """
+        :return: The messages to send to the agent: the summary of the earlier conversation, if any, and the history.
+        """
+        tokens = sum(message_tokens(m) for m in messages) + (count_tokens(summary) if summary else 0)
+        metrics.HISTORY_TOKENS.observe(tokens)
+        tracing.annotate(history_tokens=tokens)
+        if not summary: return list(messages)
+        return [SystemMessage(content="Summary of the earlier conversation with the user:\n" + summary, id=SUMMARY_ID)] + list(messages)
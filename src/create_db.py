@@ -1,66 +1,323 @@
 import os
 import shutil
+import random
 import sqlite3
+import argparse
+import datetime
 
+from src.db import normalize_key
 from config import *
 
 
+# Free time slots of each doctor in (time slot, id) order, a partial index that only holds free slots and covers
+# availability lookups: `patient` (always null) is an equality column, so that the time slots of a doctor, then their
+# ids, are read in order, without touching the table or sorting
+AVAILABILITY_INDEX = "CREATE INDEX idx_appointments_free ON appointments(doctor_id, patient, time_slot) WHERE patient IS NULL"
+
+# A doctor has at most one time slot at a given time, so that generated calendars can be added again (or over the demo
+# time slots) without duplicating them
+TIME_SLOT_INDEX = "CREATE UNIQUE INDEX idx_appointments_doctor_time ON appointments(doctor_id, time_slot)"
+
+# Names of different doctors can have the same lookup key (e.g. 'Dr. Rossi' and 'Rossi'): lookups match key prefixes,
+# and return all of them
+DOCTOR_NAME_INDEX = "CREATE INDEX idx_doctors_name ON doctors(name_key)"
+DOCTOR_SPECIALIZATION_INDEX = "CREATE INDEX idx_doctors_specialization ON doctors(specialization_key)"
+
+# Typed schema, with normalized lookup keys and indexes supporting the queries in src/db.py.
+# Time slots are stored as sortable ISO timestamps ('YYYY-MM-DD HH:MM:SS'), and appointments carry a row version that
+# is incremented by every change of patient, for optimistic concurrency control.
+SCHEMA = [
+	"""
+	CREATE TABLE doctors(
+		id INTEGER PRIMARY KEY,
+		name TEXT NOT NULL,
+		name_key TEXT NOT NULL,
+		specialization TEXT NOT NULL,
+		specialization_key TEXT NOT NULL
+	)
+	""",
+	"""
+	CREATE TABLE appointments(
+		id INTEGER PRIMARY KEY,
+		doctor_id INTEGER NOT NULL REFERENCES doctors(id),
+		time_slot TEXT NOT NULL,
+		patient TEXT COLLATE NOCASE,
+		version INTEGER NOT NULL DEFAULT 0
+	)
+	""",
+	DOCTOR_NAME_INDEX,
+	DOCTOR_SPECIALIZATION_INDEX,
+	"CREATE INDEX idx_appointments_doctor_patient ON appointments(doctor_id, patient)",
+	"CREATE INDEX idx_appointments_patient ON appointments(patient)",
+	AVAILABILITY_INDEX,
+	TIME_SLOT_INDEX,
+]
+
+# Emergencies are read by code and time window (triage) and tailed by id (new events), so that neither needs a scan
+EMERGENCIES_SCHEMA = [
+	"""
+	CREATE TABLE emergencies(
+		id INTEGER PRIMARY KEY,
+		user TEXT,
+		patient TEXT,
+		time TEXT NOT NULL,
+		question TEXT,
+		code TEXT NOT NULL
+	)
+	""",
+	"CREATE INDEX idx_emergencies_code_time ON emergencies(code, time)",
+]
+
+LEGACY_TIME_FORMAT = "%d-%m-%Y %H:%M:%S"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Recurring weekly schedules of generated calendars: working days are drawn among weekdays, and each doctor works one of
+# these shifts, as (start hour, end hour)
+SHIFTS = [(8, 12), (9, 13), (14, 18), (9, 17)]
+MIN_WORKING_DAYS = 2
+
+
+def create_schema(cur, schema=SCHEMA):
+	for query in schema:
+		cur.execute(query)
+
+def insert_doctors(cur, doctors):
+	query = "INSERT INTO doctors(name, name_key, specialization, specialization_key) VALUES(?, ?, ?, ?)"
+	cur.executemany(query, [(name, normalize_key(name), spec, normalize_key(spec)) for name, spec in doctors])
+	return {name: doctor_id for doctor_id, name in cur.execute("SELECT id, name FROM doctors")}
+
+def shared_name_keys(cur):
+	# Names of the doctors of each lookup key shared by several doctors
+	return dict(cur.execute("SELECT name_key, group_concat(name, ', ') FROM doctors GROUP BY name_key HAVING count(*) > 1").fetchall())
+
+def report_shared_name_keys(cur):
+	for key, names in shared_name_keys(cur).items():
+		print("Doctors sharing the lookup key '{}' (lookups return all of them): {}.".format(key, names))
+
+def insert_appointments(cur, appointments, doctor_ids):
+	query = "INSERT INTO appointments(id, doctor_id, time_slot, patient) VALUES(?, ?, ?, ?)"
+	cur.executemany(query, [(i, doctor_ids[doctor], t, patient) for i, doctor, t, patient in appointments])
+
+def weekly_schedule(rng):
+	# Working days (0 is Monday) and shift of a doctor, repeated every week
+	days = sorted(rng.sample(range(5), rng.randint(MIN_WORKING_DAYS, 5)))
+	return days, rng.choice(SHIFTS)
+
+def calendar_slots(doctor_ids, start, weeks, slot_minutes=CALENDAR_SLOT_MINUTES, booked=0., seed=0):
+	"""
+	Generate the time slots of a recurring weekly schedule for each doctor, over `weeks` weeks from the Monday of the
+	week of `start`, with a fraction `booked` of the slots reserved by other patients.
+
+	:return: A generator of (doctor id, time slot, patient) tuples, so that calendars are never held in memory.
+	"""
+	rng = random.Random(seed)
+	monday = start - datetime.timedelta(days=start.weekday())
+	for doctor_id in doctor_ids:
+		days, (begin, end) = weekly_schedule(rng)
+		for week in range(weeks):
+			for day in days:
+				date = monday + datetime.timedelta(weeks=week, days=day)
+				t, stop = datetime.datetime.combine(date, datetime.time(begin)), datetime.datetime.combine(date, datetime.time(end))
+				while t < stop:
+					patient = 'patient{}'.format(rng.randrange(10000)) if booked > 0 and rng.random() < booked else None
+					yield doctor_id, t.strftime(TIME_FORMAT), patient
+					t += datetime.timedelta(minutes=slot_minutes)
+
+def insert_calendar(db, doctor_ids, start, weeks, slot_minutes=CALENDAR_SLOT_MINUTES, booked=0., seed=0):
+	"""
+	Add the generated calendars of the given doctors to the database, in a single transaction with one bulk insert.
+	Time slots that a doctor already has (e.g. demo time slots, or a calendar added before) are skipped.
+
+	:return: The number of time slots added.
+	"""
+	query = "INSERT OR IGNORE INTO appointments(doctor_id, time_slot, patient) VALUES(?, ?, ?)"
+	# Explicit transaction, so that the rows are not committed one by one on connections in autocommit mode (migrate_db)
+	cur = db.cursor()
+	if not db.in_transaction: cur.execute("BEGIN")
+	try:
+		count = cur.executemany(query, calendar_slots(doctor_ids, start, weeks, slot_minutes=slot_minutes, booked=booked, seed=seed)).rowcount
+		cur.execute("COMMIT")
+	except Exception:
+		if db.in_transaction: cur.execute("ROLLBACK")
+		raise
+	return count
+
 def create_db(path):
 	os.makedirs(os.path.dirname(path), exist_ok=True)
 	if os.path.exists(path): shutil.move(path, path + '.old') # Save-replace old files
 	db = sqlite3.connect(path)
 	cur = db.cursor()
-	
-	tables = {  'doctors':
-		          {'header':     ('name', 'specialization'),
-		           'data':      [('Dr. Lyubor', 'Neurology'),
-		                         ('Dr. Brazov', 'Pneumology'),
-		                         ('Dr. Amicis', 'Endocrinology'),
-		                         ('Dr. Mirabella', 'Gastroenterology'),
-		                         ('Dr. Muller', 'Cardiology'),
-		                         ('Dr. Dubois', 'Dermatology'),]
-		           },
-	            
-	            'appointments':
-		            {'header':   ('id', 'doctor', 'time_slot', 'patient'),
-		             'data':    [(0,  'Dr. Lyubor', '10-01-2025 09:00:00', None),
-		                         (1,  'Dr. Lyubor', '10-01-2025 10:00:00', 'Martini'),
-		                         (2,  'Dr. Brazov', '11-01-2025 09:00:00', None),
-		                         (3,  'Dr. Brazov', '11-01-2025 10:00:00', None),
-		                         (4,  'Dr. Amicis', '12-01-2025 09:00:00', None),
-		                         (5,  'Dr. Amicis', '12-01-2025 10:00:00', None),
-		                         (6,  'Dr. Mirabella', '13-01-2025 09:00:00', 'Russel'),
-		                         (7,  'Dr. Mirabella', '13-01-2025 10:00:00', None),
-		                         (8,  'Dr. Muller', '14-01-2025 09:00:00', None),
-		                         (9,  'Dr. Muller', '14-01-2025 10:00:00', None),
-		                         (10, 'Dr. Dubois', '15-01-2025 09:00:00', None),
-		                         (11, 'Dr. Dubois', '15-01-2025 10:00:00', None),]
-		            }
-	          }
-	
-	for t_name, t in tables.items():
-		creation_query = "CREATE TABLE {}{}".format(t_name, t['header'])
-		print("Creation query: {}".format(creation_query))
-		cur.execute(creation_query)
-		placeholders = ','.join(['?'] * len(t['header']))
-		insertion_query = "INSERT INTO {} VALUES({})".format(t_name, placeholders)
-		print("Insertion query: {}".format(insertion_query))
-		cur.executemany(insertion_query, t['data'])
-		db.commit()
-	
+
+	doctors = [('Dr. Lyubor', 'Neurology'),
+	           ('Dr. Brazov', 'Pneumology'),
+	           ('Dr. Amicis', 'Endocrinology'),
+	           ('Dr. Mirabella', 'Gastroenterology'),
+	           ('Dr. Muller', 'Cardiology'),
+	           ('Dr. Dubois', 'Dermatology'),]
+
+	# Demo time slots on the coming days, so that they are not in the past for the availability lookups
+	def slot(days, hour): return datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=days), datetime.time(hour)).strftime(TIME_FORMAT)
+	appointments = [(0,  'Dr. Lyubor', slot(1, 9), None),
+	                (1,  'Dr. Lyubor', slot(1, 10), 'Martini'),
+	                (2,  'Dr. Brazov', slot(2, 9), None),
+	                (3,  'Dr. Brazov', slot(2, 10), None),
+	                (4,  'Dr. Amicis', slot(3, 9), None),
+	                (5,  'Dr. Amicis', slot(3, 10), None),
+	                (6,  'Dr. Mirabella', slot(4, 9), 'Russel'),
+	                (7,  'Dr. Mirabella', slot(4, 10), None),
+	                (8,  'Dr. Muller', slot(5, 9), None),
+	                (9,  'Dr. Muller', slot(5, 10), None),
+	                (10, 'Dr. Dubois', slot(6, 9), None),
+	                (11, 'Dr. Dubois', slot(6, 10), None),]
+
+	print("Creating schema...")
+	create_schema(cur)
+	create_schema(cur, EMERGENCIES_SCHEMA)
+	doctor_ids = insert_doctors(cur, doctors)
+	insert_appointments(cur, appointments, doctor_ids)
+	db.commit()
+
+	return db
+
+def table_columns(db, table):
+	return [r[1] for r in db.execute("PRAGMA table_info({})".format(table))]
+
+def is_legacy_db(db):
+	columns = table_columns(db, 'doctors')
+	return len(columns) > 0 and 'name_key' not in columns
+
+def index_sql(db, name):
+	# Definition of an index, or None if it does not exist
+	row = db.execute("SELECT sql FROM sqlite_master WHERE type = 'index' and name = ?", (name,)).fetchone()
+	return row[0] if row is not None else None
+
+def drop_unique_name_key(cur):
+	# The unique constraint of the first typed schema can only be dropped by copying the table. The copy is renamed
+	# after the original is dropped, so that the references of appointments still name the doctors table.
+	cur.execute(SCHEMA[0].replace("CREATE TABLE doctors(", "CREATE TABLE doctors_new("))
+	cur.execute("INSERT INTO doctors_new SELECT id, name, name_key, specialization, specialization_key FROM doctors")
+	cur.execute("DROP TABLE doctors")
+	cur.execute("ALTER TABLE doctors_new RENAME TO doctors")
+	cur.execute(DOCTOR_NAME_INDEX)
+	cur.execute(DOCTOR_SPECIALIZATION_INDEX)
+	print("Removed the unique constraint of doctor lookup keys.")
+
+def add_availability_index(cur):
+	# Replaces the index of a previous version, if any
+	cur.execute("DROP INDEX IF EXISTS idx_appointments_free")
+	cur.execute(AVAILABILITY_INDEX)
+	print("Added index of free time slots.")
+
+def add_appointment_versions(cur):
+	cur.execute("ALTER TABLE appointments ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+	print("Added row versions to appointments.")
+
+def unique_time_slots(appointments):
+	# One time slot per doctor and time, preferring reserved ones, then the first one
+	kept = {}
+	for a in appointments:
+		key = (a[1], a[2])
+		if key not in kept or (kept[key][3] is None and a[3] is not None): kept[key] = a
+	return sorted(kept.values())
+
+def add_time_slot_index(cur):
+	# Duplicate time slots of a doctor are removed first, keeping the reserved one, or else the first one
+	removed = cur.execute("""
+		DELETE FROM appointments
+		WHERE id NOT IN (
+			SELECT coalesce(min(id) FILTER (WHERE patient IS NOT NULL), min(id))
+			FROM appointments
+			GROUP BY doctor_id, time_slot)
+		""").rowcount
+	cur.execute(TIME_SLOT_INDEX)
+	print("Added unique index of time slots ({} duplicate time slots removed).".format(removed))
+
+def migrate_appointments(cur):
+	# Read legacy data
+	doctors = cur.execute("SELECT name, specialization FROM doctors").fetchall()
+	appointments = cur.execute("SELECT id, doctor, time_slot, patient FROM appointments").fetchall()
+
+	# Doctors referenced only by appointments are kept, with unknown specialization
+	known = {name for name, _ in doctors}
+	doctors += [(d, '') for d in dict.fromkeys(a[1] for a in appointments) if d not in known]
+	appointments = [(int(i), doctor, datetime.datetime.strptime(t, LEGACY_TIME_FORMAT).strftime(TIME_FORMAT), patient)
+	                for i, doctor, t, patient in appointments]
+	n_legacy, appointments = len(appointments), unique_time_slots(appointments)
+	if len(appointments) < n_legacy: print("Removed {} duplicate time slots.".format(n_legacy - len(appointments)))
+
+	# Replace legacy tables
+	cur.execute("DROP TABLE appointments")
+	cur.execute("DROP TABLE doctors")
+	create_schema(cur)
+	doctor_ids = insert_doctors(cur, doctors)
+	insert_appointments(cur, appointments, doctor_ids)
+	print("Migrated {} doctors and {} appointments.".format(len(doctors), len(appointments)))
+	report_shared_name_keys(cur)
+
+def migrate_emergencies(cur):
+	# The legacy table (user, patient, time, question, code) was created on the first registered emergency, if any
+	emergencies = []
+	if len(table_columns(cur, 'emergencies')) > 0:
+		emergencies = cur.execute("SELECT user, patient, time, question, code FROM emergencies ORDER BY rowid").fetchall()
+		emergencies = [(user, patient, datetime.datetime.strptime(t, LEGACY_TIME_FORMAT).strftime(TIME_FORMAT), question, code)
+		               for user, patient, t, question, code in emergencies]
+		cur.execute("DROP TABLE emergencies")
+	create_schema(cur, EMERGENCIES_SCHEMA)
+	cur.executemany("INSERT INTO emergencies(user, patient, time, question, code) VALUES(?, ?, ?, ?, ?)", emergencies)
+	print("Migrated {} emergencies.".format(len(emergencies)))
+
+def migrate_db(path):
+	"""
+	Migrate a database created with a previous schema to the current one: the old untyped schema (no keys or indexes,
+	'dd-mm-YYYY HH:MM:SS' time slots), the typed schema without appointment versions, the current index of free time slots
+	or the unique index of time slots, or with unique doctor lookup keys, and the unindexed emergencies table. A copy of
+	the old database is kept next to it.
+	"""
+	db = sqlite3.connect(path, isolation_level=None)
+	legacy = is_legacy_db(db)
+	migrations = []
+	if legacy: migrations.append(migrate_appointments)
+	elif 'version' not in table_columns(db, 'appointments'): migrations.append(add_appointment_versions)
+	if not legacy and index_sql(db, 'idx_appointments_free') != AVAILABILITY_INDEX: migrations.append(add_availability_index)
+	if not legacy and index_sql(db, 'idx_appointments_doctor_time') is None: migrations.append(add_time_slot_index)
+	if not legacy and index_sql(db, 'idx_doctors_name') is None: migrations.append(drop_unique_name_key)
+	if 'id' not in table_columns(db, 'emergencies'): migrations.append(migrate_emergencies)
+	if len(migrations) == 0:
+		print("Database {} already up to date.".format(path))
+		return db
+
+	db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+	shutil.copy(path, path + '.old')
+	cur = db.cursor()
+	cur.execute("BEGIN")
+	try:
+		for migration in migrations: migration(cur)
+		cur.execute("COMMIT")
+	except Exception:
+		cur.execute("ROLLBACK")
+		raise
+
 	return db
-	
-	
 
 if __name__ == '__main__':
-	# Create DB
-	db = create_db(DB_PATH)
-	
+	parser = argparse.ArgumentParser(description="Create the application database, or migrate an existing one to the current schema.")
+	parser.add_argument('--migrate', action='store_true', help="Migrate the existing database instead of creating a new one.")
+	parser.add_argument('--weeks', type=int, default=0, help="Add a generated calendar of this many weeks for every doctor, with recurring weekly schedules.")
+	parser.add_argument('--start', type=datetime.date.fromisoformat, default=datetime.date.today(), help="First week of the generated calendar (YYYY-MM-DD).")
+	parser.add_argument('--booked', type=float, default=0., help="Fraction of the generated time slots already reserved.")
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args()
+
+	# Create or migrate DB
+	db = migrate_db(DB_PATH) if args.migrate else create_db(DB_PATH)
+	if args.weeks > 0:
+		doctor_ids = [r[0] for r in db.execute("SELECT id FROM doctors ORDER BY id")]
+		print("Added {} time slots.".format(insert_calendar(db, doctor_ids, args.start, args.weeks, booked=args.booked, seed=args.seed)))
+
 	# Try out a query
 	cur = db.cursor()
 	select_query = "SELECT name FROM doctors"
 	print("Select query: {}".format(select_query))
 	res = cur.execute(select_query)
 	print("Query results: {}".format(res.fetchall()))
-	
-	
\ No newline at end of file
+
@@ -1,12 +1,24 @@
 import os
-from langchain_community.vectorstores import FAISS
+import time
+import glob
+import json
+import hashlib
+import argparse
+from tqdm import tqdm
 import nltk
 
-from src.helper import load_data, text_split, load_hf_embeddings
+from src.helper import load_hf_embeddings
+from src.ingest import iter_chunks, PARSERS
+from src.vector_index import BuildDocstore, export_index, append_index, INDEX_TYPES, BUILD_DOCSTORE_NAME, LEGACY_DOCSTORE_NAME
 from config import *
 
 
 DATA_PATH = os.path.join(ROOT_DIR, 'data', 'MedQuAD-master')
+MANIFEST_NAME = 'manifest.json'
+# Version of the files of the build, which is started from scratch when it changes. Previous versions kept the vectors
+# in a langchain FAISS index, pickled with its map of chunk ids.
+BUILD_FORMAT = 2
+LEGACY_BUILD_FILES = ('index.faiss', 'index.pkl')
 
 
 def fix_nltk():
@@ -15,20 +27,145 @@ def fix_nltk():
 	nltk.download('punkt_tab')
 	nltk.download('averaged_perceptron_tagger_eng')
 
-def create_index(data_path, save_path, chunk_size, chunk_overlap):
+def file_hash(path):
+	h = hashlib.sha256()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			h.update(block)
+	return h.hexdigest()
+
+def load_manifest(save_path, params):
+	# The manifest maps each source file to its content hash and to the ids of its chunks in the docstore. If the index
+	# was built with different parsing/chunking/embedding parameters or build format (or without a manifest), it is
+	# rebuilt from scratch.
+	path = os.path.join(save_path, MANIFEST_NAME)
+	if not os.path.exists(path): return None
+	with open(path, 'r') as f:
+		manifest = json.load(f)
+	if manifest.get('params') != params: return None
+	return manifest
+
+def save_manifest(manifest, save_path):
+	path = os.path.join(save_path, MANIFEST_NAME)
+	with open(path + '.tmp', 'w') as f:
+		json.dump(manifest, f)
+	os.replace(path + '.tmp', path)
+
+def open_docstore(save_path, resume):
+	# A new build starts from an empty docstore. The build index pickled by previous versions, and the serving docstore
+	# they shared between index types, are removed.
+	os.makedirs(save_path, exist_ok=True)
+	names = LEGACY_BUILD_FILES + (LEGACY_DOCSTORE_NAME,)
+	if not resume: names = (BUILD_DOCSTORE_NAME,) + names
+	for name in names:
+		if os.path.exists(os.path.join(save_path, name)): os.remove(os.path.join(save_path, name))
+	return BuildDocstore(os.path.join(save_path, BUILD_DOCSTORE_NAME))
+
+def remove_chunks(docstore, manifest, ids):
+	# The chunks after the deleted ones moved: the serving indexes can no longer be appended to (see `append_index`)
+	if docstore.delete(ids) > 0: manifest['exports'] = {}
+
+def add_batch(docstore, manifest, embeddings, chunks, ids):
+	# Drop chunks that were already added by an interrupted run, before adding them again
+	stale = docstore.existing_ids(ids)
+	if len(stale) > 0: remove_chunks(docstore, manifest, stale)
+	docstore.add(ids, chunks, embeddings.embed_documents([c.page_content for c in chunks]))
+
+def save_checkpoint(docstore, manifest, save_path):
+	# Commit the chunks first, and the manifest last, so that the manifest never refers to chunks missing from the
+	# docstore
+	docstore.commit()
+	save_manifest(manifest, save_path)
+
+def create_index(data_path, save_path, chunk_size, chunk_overlap, batch_size=INDEX_BATCH_SIZE, checkpoint_every=INDEX_CHECKPOINT_BATCHES,
+                 workers=INGEST_WORKERS, parser=INGEST_PARSER, index_type=INDEX_TYPE, rebuild=False):
+	"""
+	Build or update the vector index. Files are parsed and split by a pool of `workers` processes, and streamed in order
+	to the embedding stage, where their chunks are embedded in batches of bounded size, and written with their vectors
+	to a SQLite docstore (see `BuildDocstore`), so that memory does not grow with the number of chunks. A manifest of
+	file content hashes is stored with the docstore, so that subsequent runs only embed new or changed files, and remove
+	the chunks of changed or deleted files. The docstore and the manifest are also saved every `checkpoint_every`
+	batches, so that an interrupted run resumes from the last checkpoint. Finally, the vectors are read back in blocks to
+	build the serving index of the given type, with the BM25 index of the documents (see src/vector_index.py).
+	When files were only added since the last export, their chunks are appended to the serving index instead, so that
+	the update costs the new chunks only; changed or removed files move the positions of the following chunks, and
+	the serving index is exported again.
+	"""
 	print("Creating index...")
-	fix_nltk()
-	print("Loading data...")
-	data = load_data(data_path)
-	print("Data loaded...")
-	text_chunks = text_split(data, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+	if parser == 'unstructured': fix_nltk()
 	print("Loading embeddings...")
 	embeddings = load_hf_embeddings()
-	print("Creating vector store...")
-	vectorstore_from_docs = FAISS.from_documents(text_chunks, embedding=embeddings)
-	vectorstore_from_docs.save_local(save_path)
+
+	# Load previous manifest and docstore, if available
+	params = {'chunk_size': chunk_size, 'chunk_overlap': chunk_overlap, 'parser': parser, 'embeddings': embeddings.fingerprint, 'format': BUILD_FORMAT}
+	manifest = None if rebuild else load_manifest(save_path, params)
+	docstore = open_docstore(save_path, resume=manifest is not None)
+	if manifest is None: manifest = {'params': params, 'files': {}}
+	# Number of vectors of each exported serving index, the first ones of the docstore (see `append_index`)
+	manifest.setdefault('exports', {})
+	indexed = manifest['files']
+
+	# Compare current files with the manifest
+	print("Scanning data...")
+	files = {os.path.relpath(p, data_path): p for p in sorted(glob.glob(os.path.join(data_path, '*', '*.xml')))}
+	hashes = {rel_path: file_hash(p) for rel_path, p in tqdm(files.items())}
+	changed = [rel_path for rel_path, h in hashes.items() if indexed.get(rel_path, {}).get('hash') != h]
+	removed = [rel_path for rel_path in indexed if rel_path not in hashes]
+	print("Files: {} total, {} new or changed, {} removed".format(len(files), len(changed), len(removed)))
+
+	# Remove stale chunks in a single pass over the index
+	stale_ids = [i for rel_path in changed + removed for i in indexed.get(rel_path, {}).get('ids', [])]
+	if len(stale_ids) > 0:
+		print("Removing {} stale chunks...".format(len(stale_ids)))
+		remove_chunks(docstore, manifest, stale_ids)
+	for rel_path in changed + removed: indexed.pop(rel_path, None)
+
+	# Stream new or changed files, embedding and indexing their chunks in bounded batches
+	print("Updating vector store with {} workers ({} parser)...".format(workers, parser))
+	start = time.perf_counter()
+	batch_chunks, batch_ids, batch_files, n_batches = [], [], {}, 0
+	for rel_path, chunks, ids in tqdm(iter_chunks(data_path, changed, chunk_size, chunk_overlap, workers=workers, parser=parser), total=len(changed)):
+		batch_chunks += chunks
+		batch_ids += ids
+		batch_files[rel_path] = {'hash': hashes[rel_path], 'ids': ids}
+		if len(batch_chunks) >= batch_size:
+			add_batch(docstore, manifest, embeddings, batch_chunks, batch_ids)
+			indexed.update(batch_files)
+			batch_chunks, batch_ids, batch_files, n_batches = [], [], {}, n_batches + 1
+			if checkpoint_every > 0 and n_batches % checkpoint_every == 0: save_checkpoint(docstore, manifest, save_path)
+	if len(batch_chunks) > 0:
+		add_batch(docstore, manifest, embeddings, batch_chunks, batch_ids)
+	indexed.update(batch_files)
+	save_checkpoint(docstore, manifest, save_path)
+	print("Indexed {} files in {:.1f}s".format(len(changed), time.perf_counter() - start))
+
+	# Append the new vectors and documents to the serving index if chunks were only added since its last export,
+	# otherwise export it again
+	total = docstore.ntotal
+	if total > 0:
+		start = time.perf_counter()
+		exported = manifest['exports'].get(index_type)
+		appended = append_index(docstore, save_path, exported, index_type) if exported is not None else None
+		if appended is None:
+			print("Exporting {} index...".format(index_type))
+			export_index(docstore, save_path, index_type)
+			print("Exported {} vectors in {:.1f}s".format(total, time.perf_counter() - start))
+		elif appended > 0:
+			print("Appended {} vectors to the {} index in {:.1f}s".format(appended, index_type, time.perf_counter() - start))
+		manifest['exports'][index_type] = total
+		save_manifest(manifest, save_path)
+	docstore.close()
 	print("Done!")
-	return vectorstore_from_docs
+	return total
 
 if __name__ == '__main__':
-	_ = create_index(DATA_PATH, INDEX_PATH, CHUNK_SIZE, CHUNK_OVERLAP)
\ No newline at end of file
+	parser = argparse.ArgumentParser(description="Build or incrementally update the vector index.")
+	parser.add_argument('--rebuild', action='store_true', help="Ignore the existing index and rebuild it from scratch.")
+	parser.add_argument('--batch-size', type=int, default=INDEX_BATCH_SIZE, help="Number of chunks embedded and added to the index at once.")
+	parser.add_argument('--workers', type=int, default=INGEST_WORKERS, help="Number of processes used to parse and split files.")
+	parser.add_argument('--parser', choices=PARSERS, default=INGEST_PARSER, help="XML parser: 'unstructured' (UnstructuredXMLLoader) or 'native' (MedQuAD question/answer pairs, no nltk required).")
+	parser.add_argument('--index-type', choices=INDEX_TYPES, default=INDEX_TYPE, help="Type of the serving index.")
+	args = parser.parse_args()
+
+	_ = create_index(DATA_PATH, INDEX_PATH, CHUNK_SIZE, CHUNK_OVERLAP, batch_size=args.batch_size, workers=args.workers, parser=args.parser,
+	                 index_type=args.index_type, rebuild=args.rebuild)
@@ -0,0 +1,372 @@
+import os
+import re
+import queue
+import sqlite3
+import weakref
+import threading
+from contextlib import contextmanager
+
+from . import tracing
+from config import *
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of SQLite connections.
+
+    Connections are opened lazily up to the given size, configured once (WAL journal, busy timeout, statement cache) and
+    then reused by every caller. Since the statement cache of a connection is keyed by the SQL text, queries should be
+    passed as constant strings so that they are prepared only once per connection.
+    """
+
+    def __init__(self, path, size=4, timeout=30., cached_statements=128):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self._closed = False
+        self._reset()
+        _pools.add(self)
+
+    def _reset(self):
+        self._idle = queue.LifoQueue(maxsize=self.size)
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, cached_statements=self.cached_statements)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def acquire(self):
+        if self._closed: raise RuntimeError("Connection pool for {} is closed.".format(self.path))
+
+        # Reuse an idle connection if possible, otherwise open a new one while below the pool size
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+
+        # Pool exhausted, wait for a connection to be released
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("No database connection available after {} seconds.".format(self.timeout))
+
+    def release(self, conn):
+        if conn.in_transaction: conn.rollback()
+        if self._closed:
+            conn.close()
+            return
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrow a connection for the duration of a `with` block. The transaction is committed if the block completes
+        normally and rolled back otherwise.
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+            if conn.in_transaction: conn.commit()
+        finally:
+            self.release(conn)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# Pools of the process, reset in the child of a fork (e.g. a worker of a pre-forking server), where each pool opens its
+# own connections. Inherited connections must neither be used nor closed (closing one could checkpoint and delete the
+# WAL of the parent), so they are only kept referenced.
+_pools = weakref.WeakSet()
+_inherited = []
+
+def _reset_pools():
+    for pool in list(_pools):
+        _inherited.extend(pool._idle.queue)
+        pool._reset()
+
+os.register_at_fork(after_in_child=_reset_pools)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_PATH, size=DB_POOL_SIZE, timeout=DB_TIMEOUT, cached_statements=DB_CACHED_STATEMENTS)
+    return _pool
+
+def open_pool(path, size=DB_POOL_SIZE):
+    """
+    Point the module pool at another database (e.g. a temporary one in benchmarks), closing the current pool.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None: _pool.close()
+        _pool = ConnectionPool(path, size=size, timeout=DB_TIMEOUT, cached_statements=DB_CACHED_STATEMENTS)
+    return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None: _pool.close()
+        _pool = None
+
+def fetchall(query, params=()):
+    with tracing.span('sqlite'), get_pool().connection() as conn:
+        return conn.execute(query, params).fetchall()
+
+def fetchone(query, params=()):
+    with tracing.span('sqlite'), get_pool().connection() as conn:
+        return conn.execute(query, params).fetchone()
+
+def execute(query, params=()):
+    with tracing.span('sqlite'), get_pool().connection() as conn:
+        return conn.execute(query, params).rowcount
+
+
+def normalize_key(text):
+    """
+    Normalize a doctor or specialization name to the lookup key stored in the database, e.g. 'Dr. Lyubor' -> 'lyubor'.
+    Lookups match the beginning of the keys (see `prefix_range`): unlike the substring matches of previous versions,
+    'Lyubor' finds 'Dr. Lyubor', but 'Ivanova' does not find 'Dr. Anna Ivanova', nor 'logy' any specialization.
+    """
+    words = re.findall(r'[a-z0-9]+', text.lower())
+    if len(words) > 1 and words[0] in ('dr', 'doctor'): words = words[1:]
+    return ' '.join(words)
+
+def prefix_range(key):
+    # Bounds for an index-friendly prefix match: key <= col < key + U+10FFFF
+    return key, key + '\U0010ffff'
+
+def specialization_prefix(text):
+    # Match e.g. 'cardiologist' or 'cardiological' against 'cardiology'
+    return re.sub(r'(ists?|ical|ic|y)$', '', normalize_key(text))
+
+
+# Queries are kept as module-level constants, so that each pooled connection prepares them only once. Lookups compare
+# normalized keys against index ranges, so that they never need a full table scan (CROSS JOIN pins the join order,
+# so that doctor lookups drive the (doctor_id, patient) index).
+SELECT_DOCTORS_BY_SPECIALIZATION = """
+            SELECT name
+            FROM doctors
+            WHERE specialization_key >= ? and specialization_key < ?
+        """
+
+# Page of the free time slots of a doctor in a time window, after the (time slot, id) cursor of the previous page. The
+# slots of each matching doctor are read in (time slot, id) order from the covering partial index of free slots (the
+# `patient is null` condition selects it), stopping at the page size, so that only these are merged and sorted.
+SELECT_AVAILABLE_APPOINTMENTS = """
+            SELECT a.id, a.time_slot, d.name
+            FROM doctors d CROSS JOIN appointments a ON a.id IN (
+                SELECT f.id
+                FROM appointments f
+                WHERE f.doctor_id = d.id and f.patient is null and (f.time_slot, f.id) > (?, ?) and f.time_slot < ?
+                ORDER BY f.time_slot, f.id
+                LIMIT ?)
+            WHERE d.name_key >= ? and d.name_key < ?
+            ORDER BY a.time_slot, a.id
+            LIMIT ?
+        """
+
+# First free time slots with any doctor of a specialization: at most n per doctor, read in order from the covering
+# partial index of free slots, then merged in time order, so that the cost depends on the number of doctors rather than
+# of slots
+SELECT_NEXT_AVAILABLE_APPOINTMENTS = """
+            SELECT a.id, a.time_slot, d.name
+            FROM doctors d CROSS JOIN appointments a ON a.id IN (
+                SELECT f.id
+                FROM appointments f
+                WHERE f.doctor_id = d.id and f.patient is null and f.time_slot >= ? and f.time_slot < ?
+                ORDER BY f.time_slot, f.id
+                LIMIT ?)
+            WHERE d.specialization_key >= ? and d.specialization_key < ?
+            ORDER BY a.time_slot, a.id
+            LIMIT ?
+        """
+
+SELECT_PATIENT_APPOINTMENTS = """
+            SELECT a.id, a.time_slot, d.name
+            FROM appointments a JOIN doctors d ON d.id = a.doctor_id
+            WHERE a.patient = ?
+            ORDER BY a.time_slot
+        """
+
+SELECT_PATIENT_DOCTOR_APPOINTMENTS = """
+            SELECT a.id, a.time_slot, d.name
+            FROM doctors d CROSS JOIN appointments a ON a.doctor_id = d.id
+            WHERE d.name_key >= ? and d.name_key < ? and a.patient = ?
+            ORDER BY a.time_slot
+        """
+
+SELECT_APPOINTMENT = """
+            SELECT d.name, a.time_slot, a.patient, a.version
+            FROM appointments a JOIN doctors d ON d.id = a.doctor_id
+            WHERE a.id = ?
+        """
+
+SELECT_APPOINTMENT_TIME = """
+            SELECT time_slot
+            FROM appointments
+            WHERE id = ?
+        """
+
+SELECT_APPOINTMENT_STATE = """
+            SELECT patient, version
+            FROM appointments
+            WHERE id = ?
+        """
+
+# Reservations are conditional single-statement updates: the check and the write happen atomically in the database,
+# so that two concurrent requests can never both reserve a slot. Reserving a slot already reserved by the same patient
+# (or cancelling a free slot) succeeds without changing it, and the version is only incremented by actual changes.
+# A :version other than NULL must match the row version (optimistic concurrency control).
+RESERVE_APPOINTMENT = """
+            UPDATE appointments
+            SET patient = coalesce(patient, :patient), version = version + (patient IS NULL)
+            WHERE id = :id and (patient IS NULL or patient = :patient) and (:version IS NULL or version = :version)
+            RETURNING patient, version
+        """
+
+CANCEL_APPOINTMENT = """
+            UPDATE appointments
+            SET patient = NULL, version = version + (patient IS NOT NULL)
+            WHERE id = :id and (patient IS NULL or patient = :patient) and (:version IS NULL or version = :version)
+            RETURNING patient, version
+        """
+
+# Vocabulary of doctor names and specializations, read once at startup by the intent router (a full scan by design)
+SELECT_DOCTOR_VOCABULARY = """
+            SELECT name, name_key, specialization, specialization_key
+            FROM doctors
+        """
+
+SELECT_TABLE_NAMES = """
+            SELECT name
+            FROM sqlite_master
+            WHERE type = 'table' and name NOT LIKE 'sqlite_%'
+        """
+
+INSERT_EMERGENCY = """
+            INSERT INTO emergencies(user, patient, time, question, code) VALUES (?, ?, ?, ?, ?)
+            RETURNING id
+        """
+
+SELECT_EMERGENCY_TIME = """
+            SELECT time
+            FROM emergencies
+            WHERE id = ?
+        """
+
+SELECT_LAST_EMERGENCY_ID = """
+            SELECT max(id)
+            FROM emergencies
+        """
+
+# Page of the emergencies of a code in a time window, after the (time, id) cursor of the previous page, read from the
+# (code, time) index in order
+SELECT_EMERGENCIES = """
+            SELECT id, user, patient, time, question, code
+            FROM emergencies
+            WHERE code = ? and (time, id) > (?, ?) and time < ?
+            ORDER BY time, id
+            LIMIT ?
+        """
+
+# New emergencies since the last one seen, read from the primary key
+SELECT_EMERGENCIES_AFTER = """
+            SELECT id, user, patient, time, question, code
+            FROM emergencies
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+        """
+
+def find_doctors_by_specialization(specialization):
+    return [r[0] for r in fetchall(SELECT_DOCTORS_BY_SPECIALIZATION, prefix_range(specialization_prefix(specialization)))]
+
+def find_available_appointments(doctor, after_time, after_id, end, limit):
+    return fetchall(SELECT_AVAILABLE_APPOINTMENTS, (after_time, after_id, end, limit) + prefix_range(normalize_key(doctor)) + (limit,))
+
+def find_next_available_appointments(specialization, start, end, n):
+    return fetchall(SELECT_NEXT_AVAILABLE_APPOINTMENTS, (start, end, n) + prefix_range(specialization_prefix(specialization)) + (n,))
+
+def find_patient_appointments(patient, doctor=None):
+    if doctor is not None and doctor != '':
+        return fetchall(SELECT_PATIENT_DOCTOR_APPOINTMENTS, prefix_range(normalize_key(doctor)) + (patient.strip(),))
+    return fetchall(SELECT_PATIENT_APPOINTMENTS, (patient.strip(),))
+
+def get_appointment(slot_id):
+    return fetchone(SELECT_APPOINTMENT, (slot_id,))
+
+def appointment_time(slot_id):
+    row = fetchone(SELECT_APPOINTMENT_TIME, (slot_id,))
+    return row[0] if row is not None else None
+
+def update_appointments(query, patient, slots, atomic=False):
+    """
+    Reserve or cancel time slots in a single transaction.
+
+    :param query: RESERVE_APPOINTMENT or CANCEL_APPOINTMENT.
+    :param patient: The name of the patient.
+    :param slots: A list of (slot id, expected version or None) pairs.
+    :param atomic: If True, either all slots are updated or none is.
+    :return: A list of (slot id, updated, patient, version) tuples, with the state of each slot after the transaction,
+             where patient and version are None if the slot does not exist.
+    """
+    results = []
+    with tracing.span('sqlite'), get_pool().connection() as conn:
+        for slot_id, version in slots:
+            row = conn.execute(query, {'id': slot_id, 'patient': patient, 'version': version}).fetchone()
+            updated = row is not None
+            # The state of a slot is only read when the update did not apply
+            if not updated: row = conn.execute(SELECT_APPOINTMENT_STATE, (slot_id,)).fetchone() or (None, None)
+            results.append((slot_id, updated) + tuple(row))
+        if atomic and not all(updated for _, updated, _, _ in results):
+            conn.rollback()
+            results = [(slot_id, False) + tuple(conn.execute(SELECT_APPOINTMENT_STATE, (slot_id,)).fetchone() or (None, None))
+                       for slot_id, _ in slots]
+    return results
+
+def list_doctors():
+    return fetchall(SELECT_DOCTOR_VOCABULARY)
+
+def list_tables():
+    return [r[0] for r in fetchall(SELECT_TABLE_NAMES)]
+
+def insert_emergency(user, patient, time, question, code):
+    return fetchone(INSERT_EMERGENCY, (user, patient, time, question, code))[0]
+
+def emergency_time(emergency_id):
+    row = fetchone(SELECT_EMERGENCY_TIME, (emergency_id,))
+    return row[0] if row is not None else None
+
+def last_emergency_id():
+    return fetchone(SELECT_LAST_EMERGENCY_ID)[0] or 0
+
+def list_emergencies(code, after_time, after_id, end, limit):
+    return fetchall(SELECT_EMERGENCIES, (code, after_time, after_id, end, limit))
+
+def list_emergencies_after(after_id, limit):
+    return fetchall(SELECT_EMERGENCIES_AFTER, (after_id, limit))
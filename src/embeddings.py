@@ -0,0 +1,270 @@
+import os
+import re
+import sqlite3
+import hashlib
+import weakref
+import threading
+import logging
+import collections
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from . import tracing
+from config import *
+
+
+logger = logging.getLogger(__name__)
+
+
+# Int8 ONNX models are quantized for a CPU instruction set (None: float32 model)
+ONNX_QUANTIZATIONS = (None, 'arm64', 'avx2', 'avx512', 'avx512_vnni')
+
+
+def content_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class VectorCache:
+    """
+    Persistent content hash -> vector cache.
+
+    Vectors are appended to a float32 file which is memory-mapped, so that only the rows actually used are paged in,
+    while the hash -> row mapping is kept in a small SQLite database. Recently used vectors are also kept in a bounded
+    in-memory LRU, which alone holds the vectors put with `persist=False`, e.g. of user queries, so that the files only
+    grow with the documents: such vectors are computed again once evicted or after a restart, unless they are put again
+    with `persist=True`. The cache can be shared by several processes (e.g. the workers of the server): rows are allocated
+    in a write transaction of the database.
+    """
+
+    def __init__(self, path, dim, lru_size=10000, grow_rows=4096):
+        self.path = path
+        self.dim = dim
+        self.lru_size = lru_size
+        self.grow_rows = grow_rows
+        self._lru = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(path, exist_ok=True)
+        self._connect()
+        self._keys.execute("CREATE TABLE IF NOT EXISTS vectors(key TEXT PRIMARY KEY, row INTEGER NOT NULL) WITHOUT ROWID")
+        self._keys.commit()
+        self._rows = self._next_row()
+
+        self._vectors_path = os.path.join(path, 'vectors.f32')
+        if not os.path.exists(self._vectors_path): open(self._vectors_path, 'wb').close()
+        self._open(max(self._rows, self._file_rows()))
+        _caches.add(self)
+
+    def _connect(self):
+        self._keys = sqlite3.connect(os.path.join(self.path, 'keys.db'), check_same_thread=False)
+
+    def _after_fork(self):
+        # The child of a fork opens its own connection, keeping the inherited one referenced (see `db._reset_pools`)
+        _inherited.append(self._keys)
+        self._lock = threading.Lock()
+        self._connect()
+
+    def _next_row(self):
+        return self._keys.execute("SELECT COALESCE(MAX(row) + 1, 0) FROM vectors").fetchone()[0]
+
+    def _file_rows(self):
+        return os.path.getsize(self._vectors_path) // (4 * self.dim)
+
+    def _open(self, capacity):
+        # Make sure the file can hold the given number of rows, then (re)map it
+        capacity = max(capacity, self.grow_rows)
+        with open(self._vectors_path, 'r+b') as f:
+            if os.path.getsize(self._vectors_path) < capacity * 4 * self.dim: f.truncate(capacity * 4 * self.dim)
+        self._capacity = capacity
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+
+    def _touch(self, key, vector, persisted=True):
+        # Entries are (vector, whether it is on disk)
+        self._lru[key] = (vector, persisted)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size: self._lru.popitem(last=False)
+
+    def _select(self, keys):
+        # Look up keys on disk, in chunks to stay below the SQLite variable limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            query = "SELECT key, row FROM vectors WHERE key IN ({})".format(','.join(['?'] * len(chunk)))
+            yield from self._keys.execute(query, chunk)
+
+    def get_many(self, keys):
+        found = {}
+        with self._lock:
+            missing = []
+            for key in keys:
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    found[key] = self._lru[key][0]
+                else:
+                    missing.append(key)
+
+            for key, row in self._select(missing):
+                # Rows beyond the mapped file were added by another process
+                if row >= self._capacity: self._remap(self._file_rows())
+                vector = np.array(self._vectors[row])
+                found[key] = vector
+                self._touch(key, vector)
+        return found
+
+    def _remap(self, capacity):
+        self._vectors.flush()
+        del self._vectors
+        self._open(capacity)
+
+    def put_many(self, keys, vectors, persist=True):
+        with self._lock:
+            # Keys in the LRU are only written if they were only kept in memory until now (e.g. a query which is also a
+            # document chunk)
+            new = [(k, v) for k, v in dict(zip(keys, vectors)).items() if k not in self._lru or (persist and not self._lru[k][1])]
+            if len(new) == 0: return
+            if not persist:
+                for k, v in new: self._touch(k, v, persisted=False)
+                return
+            # The write transaction reserves the next rows against other processes until the keys are committed
+            self._keys.execute("BEGIN IMMEDIATE")
+            try:
+                # Keys evicted from the LRU, or written by another process, are already on disk
+                stored = set(k for k, _ in self._select([k for k, _ in new]))
+                write = [(k, v) for k, v in new if k not in stored]
+                self._rows = self._next_row()
+                if self._rows + len(write) > self._capacity: self._remap(max(2 * self._capacity, self._rows + len(write), self._file_rows()))
+
+                rows = range(self._rows, self._rows + len(write))
+                if len(write) > 0:
+                    self._vectors[rows.start:rows.stop] = np.stack([v for _, v in write])
+                    self._vectors.flush()
+                self._keys.executemany("INSERT INTO vectors VALUES(?, ?)", [(k, r) for (k, _), r in zip(write, rows)])
+                self._keys.commit()
+            except Exception:
+                self._keys.rollback()
+                raise
+            self._rows += len(write)
+            for k, v in new: self._touch(k, v)
+
+    def __len__(self):
+        return self._rows
+
+    def close(self):
+        with self._lock:
+            self._vectors.flush()
+            self._keys.close()
+
+
+# Caches of the process, reopened in the child of a fork
+_caches = weakref.WeakSet()
+_inherited = []
+
+def _reopen_caches():
+    for cache in list(_caches): cache._after_fork()
+
+os.register_at_fork(after_in_child=_reopen_caches)
+
+
+def onnx_file_name(quantization):
+    # Float32 model exported by sentence-transformers, or int8 model quantized for the given CPU instruction set
+    return 'onnx/model.onnx' if quantization is None else 'onnx/model_int8_{}.onnx'.format(quantization)
+
+def load_onnx_model(model_name, quantization=None, export_path=None, threads=None):
+    """
+    Load a sentence-transformer model with the ONNX Runtime backend, on CPU. Int8 models are quantized dynamically from
+    the float32 ONNX model on first use, and saved in `export_path` for the next runs.
+
+    :param quantization: CPU instruction set of the int8 model: 'arm64', 'avx2', 'avx512' or 'avx512_vnni', or None for
+                         the float32 model.
+    """
+    import onnxruntime
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    if quantization not in ONNX_QUANTIZATIONS: raise ValueError("Unknown ONNX quantization {}, expected one of {}".format(quantization, ONNX_QUANTIZATIONS))
+    options = onnxruntime.SessionOptions()
+    if threads is not None: options.intra_op_num_threads = threads
+    model_kwargs = {'provider': 'CPUExecutionProvider', 'session_options': options}
+    if quantization is None: return SentenceTransformer(model_name, device='cpu', backend='onnx', model_kwargs=model_kwargs)
+
+    path = os.path.join(export_path, re.sub(r'[^A-Za-z0-9_.-]', '_', model_name))
+    file_name = onnx_file_name(quantization)
+    if not os.path.exists(os.path.join(path, file_name)):
+        logger.info("Exporting {} to ONNX with int8 quantization for {}...".format(model_name, quantization))
+        model = SentenceTransformer(model_name, device='cpu', backend='onnx')
+        model.save(path)
+        export_dynamic_quantized_onnx_model(model, quantization, path, file_suffix='int8_' + quantization)
+    return SentenceTransformer(path, device='cpu', backend='onnx', model_kwargs=dict(model_kwargs, file_name=file_name))
+
+
+class EmbeddingService(Embeddings):
+    """
+    Sentence-transformer embeddings with batching control, a bounded number of CPU threads, normalized float32 output,
+    and a vector cache, so that identical chunks are only embedded once (their vectors are persisted), and repeated
+    queries are only embedded once while they are in the in-memory LRU of the cache. The model runs
+    on PyTorch (`backend='torch'`), or on ONNX Runtime (`backend='onnx'`), optionally quantized to int8 (see
+    `load_onnx_model`), which is faster and smaller on CPUs without a GPU.
+    """
+
+    def __init__(self, model_name, batch_size=64, threads=None, normalize=True, device=None, cache_path=None, cache_lru_size=10000,
+                 backend='torch', onnx_quantization=None, onnx_path=None):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        if threads is not None: torch.set_num_threads(threads)
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.normalize = normalize
+        self.backend = backend
+        self.onnx_quantization = onnx_quantization if backend == 'onnx' else None
+        if backend == 'torch': self.model = SentenceTransformer(model_name, device=device)
+        elif backend == 'onnx': self.model = load_onnx_model(model_name, self.onnx_quantization, export_path=onnx_path, threads=threads)
+        else: raise ValueError("Unknown embedding backend {}, expected 'torch' or 'onnx'".format(backend))
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+        # One cache per model, backend and normalization setting
+        self.cache = None
+        if cache_path is not None:
+            cache_name = re.sub(r'[^A-Za-z0-9_.-]', '_', model_name) + self._variant + ('_norm' if normalize else '')
+            self.cache = VectorCache(os.path.join(cache_path, cache_name), self.dim, lru_size=cache_lru_size)
+
+    @property
+    def _variant(self):
+        # Suffix of the ONNX models, whose vectors differ slightly from PyTorch ones
+        if self.backend == 'torch': return ''
+        return '_onnx' + ('_int8_' + self.onnx_quantization if self.onnx_quantization is not None else '')
+
+    @property
+    def fingerprint(self):
+        # Identifies the vector space produced by this service
+        fingerprint = {'model': self.model_name, 'normalize': self.normalize}
+        if self.backend != 'torch': fingerprint.update(backend=self.backend, quantization=self.onnx_quantization)
+        return fingerprint
+
+    def encode(self, texts):
+        vectors = self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=self.normalize, convert_to_numpy=True, show_progress_bar=False)
+        return vectors.astype(np.float32, copy=False)
+
+    def embed(self, texts, persist=True):
+        """
+        Embed a list of texts, only running the model on texts missing from the cache.
+
+        :param persist: Whether to save the new vectors on disk, or only keep them in memory.
+        :return: A float32 array of shape (len(texts), dim).
+        """
+        if self.cache is None: return self.encode(texts)
+        keys = [content_hash(t) for t in texts]
+        found = self.cache.get_many(keys)
+        missing = list(dict.fromkeys(k for k in keys if k not in found))
+        if len(missing) > 0:
+            texts_by_key = dict(zip(keys, texts))
+            found.update(zip(missing, self.encode([texts_by_key[k] for k in missing])))
+        # New vectors, and with `persist` the ones found in memory only, e.g. of a query which is also a document
+        self.cache.put_many(list(found), list(found.values()), persist=persist)
+        return np.stack([found[k] for k in keys]) if len(keys) > 0 else np.zeros((0, self.dim), dtype=np.float32)
+
+    def embed_documents(self, texts):
+        return self.embed(list(texts)).tolist()
+
+    def embed_query(self, text):
+        # Queries are not persisted, so that the cache does not keep every user question on disk
+        with tracing.span('embedding'):
+            return self.embed([text], persist=False)[0].tolist()
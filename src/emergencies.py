@@ -0,0 +1,258 @@
+import hmac
+import heapq
+import json
+import time
+import asyncio
+import datetime
+import threading
+import collections
+
+from . import db, metrics
+from config import *
+
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+FIELDS = ('id', 'user', 'patient', 'time', 'question', 'code')
+
+# Bounds of an open time range
+MIN_TIME, MAX_TIME = '', '\U0010ffff'
+
+
+def as_event(row):
+    return dict(zip(FIELDS, row))
+
+def parse_codes(codes, default=EMERGENCY_CODES):
+    """
+    Validate a list of color-codes, e.g. from the query string.
+
+    :raise ValueError: If a code is unknown.
+    """
+    codes = [c.strip().upper() for c in codes if c.strip() != ''] or list(default)
+    unknown = [c for c in codes if c not in EMERGENCY_CODES]
+    if len(unknown) > 0: raise ValueError("Unknown emergency codes: {}".format(', '.join(unknown)))
+    return codes
+
+def is_staff(authorization):
+    """
+    Check the Authorization header of a request to the emergency endpoints against STAFF_TOKEN.
+    """
+    if STAFF_TOKEN is None or authorization is None: return False
+    return hmac.compare_digest(authorization.encode(), 'Bearer {}'.format(STAFF_TOKEN).encode())
+
+def format_sse(event):
+    # Event ids let clients resume with the Last-Event-ID header after a disconnection
+    if event is None: return ": keep-alive\n\n"
+    return "id: {}\nevent: emergency\ndata: {}\n\n".format(event['id'], json.dumps(event))
+
+
+class Subscription:
+    """
+    Events of the given codes published on the bus since subscribing. At most `max_pending` events are kept: when a
+    subscriber falls further behind, all of them are dropped, and it is marked as lagging until it drains the
+    subscription, so that it reloads the events from the database after the last one it delivered.
+    Subscriptions are either consumed by a thread (`get`) or by an event loop (`aget`, if created with a `loop`).
+    """
+
+    def __init__(self, bus, codes, max_pending, loop=None):
+        self.bus = bus
+        self.codes = set(codes)
+        self.max_pending = max_pending
+        self._events = collections.deque()
+        self._lagging = False
+        self._cond = threading.Condition()
+        self._loop = loop
+        self._wakeup = asyncio.Event() if loop is not None else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.bus.unsubscribe(self)
+
+    def push(self, event):
+        if event['code'] not in self.codes: return
+        with self._cond:
+            # A lagging subscriber reads these events from the database
+            if self._lagging: return
+            if len(self._events) >= self.max_pending:
+                self._events.clear()
+                self._lagging = True
+            else:
+                self._events.append(event)
+            self._cond.notify_all()
+        if self._loop is not None: self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def drain(self):
+        """
+        :return: An (events, lagging) pair, with the pending events and whether events were dropped, in which case
+                 the list is empty and all events since the last one delivered must be read from the database.
+        """
+        with self._cond:
+            events, self._events = list(self._events), collections.deque()
+            lagging, self._lagging = self._lagging, False
+        return events, lagging
+
+    def get(self, timeout=None):
+        with self._cond:
+            self._cond.wait_for(lambda: len(self._events) > 0 or self._lagging, timeout)
+        return self.drain()
+
+    async def aget(self, timeout=None):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+        return self.drain()
+
+
+class EmergencyBus:
+    """
+    In-process publish/subscribe of registered emergencies, pushing each event to the subscriptions of its code.
+    """
+
+    def __init__(self, max_pending=1000):
+        self.max_pending = max_pending
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self, codes, loop=None):
+        subscription = Subscription(self, codes, self.max_pending, loop=loop)
+        with self._lock:
+            self._subscriptions.add(subscription)
+            metrics.EMERGENCY_SUBSCRIBERS.set(len(self._subscriptions))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+            metrics.EMERGENCY_SUBSCRIBERS.set(len(self._subscriptions))
+
+    def publish(self, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions: subscription.push(event)
+
+
+bus = EmergencyBus(EMERGENCY_SUBSCRIBER_QUEUE)
+_register_lock = threading.Lock()
+
+def register(user, patient, question, code):
+    """
+    Persist an emergency and publish it to the live subscribers.
+
+    :return: The registered event, as a dict.
+    """
+    t = datetime.datetime.now().strftime(TIME_FORMAT)
+    # Inserts and publications are serialized, so that subscribers receive events in id order and can use the last id
+    # as their cursor
+    with _register_lock:
+        emergency_id = db.insert_emergency(user, patient, t, question, code)
+        event = as_event((emergency_id, user, patient, t, question, code))
+        bus.publish(event)
+    metrics.EMERGENCIES_REGISTERED.labels(code).inc()
+    return event
+
+def list_emergencies(codes=EMERGENCY_CODES, start=None, end=None, after=None, limit=EMERGENCY_PAGE_SIZE):
+    """
+    Read a page of emergencies, in chronological order, optionally within a time range.
+
+    :param codes: The color-codes to include.
+    :param start: Start of the time range (inclusive), as a 'YYYY-MM-DD[ HH:MM:SS]' string.
+    :param end: End of the time range (exclusive), as a 'YYYY-MM-DD[ HH:MM:SS]' string.
+    :param after: Id of the last emergency of the previous page, None for the first page.
+    :return: A list of emergencies, as dicts.
+    """
+    # Keyset cursor on (time, id): the page starts after the previous one, and not before the start of the range
+    cursor = (start or MIN_TIME, 0)
+    if after is not None:
+        after_time = db.emergency_time(after)
+        if after_time is not None: cursor = max(cursor, (after_time, after))
+
+    # Each code is read in order from the (code, time) index, and the pages are merged
+    pages = [db.list_emergencies(code, cursor[0], cursor[1], end or MAX_TIME, limit) for code in codes]
+    rows = heapq.merge(*pages, key=lambda r: (r[3], r[0]))
+    return [as_event(r) for _, r in zip(range(limit), rows)]
+
+def emergencies_after(after, codes=EMERGENCY_ALERT_CODES, limit=EMERGENCY_PAGE_SIZE):
+    """
+    Read the emergencies registered after a given one, in id order, e.g. to catch up after a disconnection.
+
+    :return: A generator of (events, cursor) pairs, one per page, where cursor is the id of the last emergency read.
+    """
+    codes = set(codes)
+    while True:
+        rows = db.list_emergencies_after(after, limit)
+        if len(rows) == 0: return
+        after = rows[-1][0]
+        yield [as_event(r) for r in rows if r[5] in codes], after
+        if len(rows) < limit: return
+
+def follow(codes=EMERGENCY_ALERT_CODES, after=None, keepalive=EMERGENCY_KEEPALIVE, poll=None):
+    """
+    Follow the new emergencies of the given codes, catching up from the database first if `after` is given.
+
+    :param poll: If given, read new emergencies from the database every `poll` seconds, e.g. the ones registered by the
+                 other workers of a multi-worker server, which are not published in this process. Events published in this
+                 process then only wake the follower up, and are read from the database too: they may have been committed
+                 after emergencies of the other workers with lower ids, which the cursor must not skip.
+    :return: A generator of lists of events, where empty lists mark `keepalive` seconds without events.
+    """
+    # Subscribing before reading the cursor guarantees that no event is missed in between
+    with bus.subscribe(codes) as subscription:
+        cursor = db.last_emergency_id() if after is None else after
+        catch_up, idle = after is not None, 0.
+        while True:
+            if catch_up:
+                for events, cursor in emergencies_after(cursor, codes):
+                    if len(events) > 0:
+                        idle = 0.
+                        yield events
+                catch_up = False
+            if idle >= keepalive:
+                idle = 0.
+                yield []
+            timeout = keepalive - idle if poll is None else min(poll, keepalive - idle)
+            start = time.monotonic()
+            events, lagging = subscription.get(timeout)
+            idle += time.monotonic() - start
+            if lagging or poll is not None:
+                catch_up = True
+                continue
+            events = [e for e in events if e['id'] > cursor]
+            if len(events) > 0:
+                cursor, idle = events[-1]['id'], 0.
+                yield events
+
+async def afollow(codes=EMERGENCY_ALERT_CODES, after=None, keepalive=EMERGENCY_KEEPALIVE, poll=None):
+    """
+    Asynchronous version of `follow`, for the ASGI app: database reads run in the default executor.
+    """
+    with bus.subscribe(codes, loop=asyncio.get_running_loop()) as subscription:
+        cursor = await asyncio.to_thread(db.last_emergency_id) if after is None else after
+        catch_up, idle = after is not None, 0.
+        while True:
+            if catch_up:
+                pages = emergencies_after(cursor, codes)
+                while True:
+                    page = await asyncio.to_thread(next, pages, None)
+                    if page is None: break
+                    events, cursor = page
+                    if len(events) > 0:
+                        idle = 0.
+                        yield events
+                catch_up = False
+            if idle >= keepalive:
+                idle = 0.
+                yield []
+            timeout = keepalive - idle if poll is None else min(poll, keepalive - idle)
+            start = time.monotonic()
+            events, lagging = await subscription.aget(timeout)
+            idle += time.monotonic() - start
+            if lagging or poll is not None:
+                catch_up = True
+                continue
+            events = [e for e in events if e['id'] > cursor]
+            if len(events) > 0:
+                cursor, idle = events[-1]['id'], 0.
+                yield events
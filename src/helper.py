@@ -1,161 +1,238 @@
 import os
 import datetime
+import logging
 from langchain_core.messages import SystemMessage, HumanMessage
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.document_loaders import DirectoryLoader, UnstructuredXMLLoader, CSVLoader
-from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+import ollama
 from langchain_ollama import ChatOllama
-from langchain_community.vectorstores import FAISS
-from langchain_community.utilities import SQLDatabase
-from langchain_community.agent_toolkits import SQLDatabaseToolkit
 from langchain.agents.agent_toolkits import create_retriever_tool
 from langgraph.prebuilt import create_react_agent
 from langchain_core.tools import StructuredTool, ToolException
-import sqlite3
 
+from . import db, emergencies, availability
+from .embeddings import EmbeddingService
+from .answer_cache import AnswerCache
+from .router import IntentRouter
+from .vector_index import open_index
+from .retrieval import HybridSearch, HybridRetriever, CrossEncoderReranker
+from .startup import Startup
+from .history import get_store as get_history_store
+from .sessions import current_user
 from .prompt import prompt_template
+from .scripted_llm import ScriptedChatModel
+from .workers import SharedLLMSlots
 from config import *
 
 
+logger = logging.getLogger(__name__)
+
+
 def load_data(data_path):
     loader = DirectoryLoader(data_path, glob="*/*.xml", show_progress=True, loader_cls=UnstructuredXMLLoader)
     data = loader.load()
     return data
 
+def load_file(file_path):
+    loader = UnstructuredXMLLoader(file_path)
+    return loader.load()
+
 def text_split(data, chunk_size=500, chunk_overlap=20):
     splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
     text_chunks = splitter.split_documents(data)
     return text_chunks
 
+def model_threads():
+    # CPU thread pools do not survive a fork, and forked workers can deadlock on the pool of their parent: the models
+    # loaded by the master of a pre-forking server run on its own thread, and the workers size their pools after the
+    # fork (see `workers.after_fork`)
+    return 1 if PREFORK else EMBEDDING_THREADS
+
 def load_hf_embeddings():
     os.environ['HF_HOME'] = os.path.join(ASSETS_FOLDER, '.hf_cache')
-    return HuggingFaceEmbeddings(model_name='sentence-transformers/all-MiniLM-L6-v2')
+    return EmbeddingService(EMBEDDING_MODEL, batch_size=EMBEDDING_BATCH_SIZE, threads=model_threads(), normalize=EMBEDDING_NORMALIZE,
+                            cache_path=EMBEDDING_CACHE_PATH, cache_lru_size=EMBEDDING_CACHE_LRU_SIZE, backend=EMBEDDING_BACKEND,
+                            onnx_quantization=EMBEDDING_ONNX_QUANTIZATION, onnx_path=EMBEDDING_ONNX_PATH)
+
+def load_reranker():
+    if not RERANKER: return None
+    return CrossEncoderReranker(RERANKER_MODEL, batch_size=RERANKER_BATCH_SIZE, threads=model_threads())
+
+def load_retriever(embeddings, index, reranker=None, k=2):
+    """
+    Create the retriever of the medical information tool over the serving index (see `open_index`).
+
+    :param index: An (index, docstore) pair.
+    """
+    searcher = HybridSearch(embeddings, *index, mode=RETRIEVAL_MODE, candidates=RETRIEVAL_CANDIDATES, rrf_k=RETRIEVAL_RRF_K, reranker=reranker,
+                            cache_size=RETRIEVAL_CACHE_SIZE)
+    return HybridRetriever(searcher=searcher, k=k)
+
+def load_answer_cache(embeddings):
+    return AnswerCache(embeddings, path=ANSWER_CACHE_PATH, threshold=ANSWER_CACHE_THRESHOLD, max_entries=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL,
+                       index_path=INDEX_PATH, index_type=INDEX_TYPE)
+
+def load_router(embeddings):
+    tools = {'search_doctor_by_specialization': search_doctor_by_specialization,
+             'search_available_doctor_appointments': search_available_doctor_appointments,
+             'search_patient_appointments': search_patient_appointments}
+    return IntentRouter(embeddings, tools, threshold=ROUTER_THRESHOLD, margin=ROUTER_MARGIN)
 
 def parse_results(result):
     return result['messages'], result['messages'][-1].content
 
-def initialize_llm(user_name, host, k=2, max_tokens=512, temp=0.1):
-    # Load embeddings
-    print("Loading embeddings...")
-    embeddings = load_hf_embeddings()
-    
-    # Load index
-    print("Loading index...")
-    docsearch = FAISS.load_local(INDEX_PATH, embeddings, allow_dangerous_deserialization=True)
-    retriever = docsearch.as_retriever(search_kwargs={"k": k})
+class SharedChatOllama(SharedLLMSlots, ChatOllama):
+    pass
+
+class SharedScriptedChatModel(SharedLLMSlots, ScriptedChatModel):
+    pass
+
+def load_llm(max_tokens=512, temp=0.1, workers=WORKERS):
+    # Ollama model, kept loaded by Ollama between requests, or its deterministic stand-in. The workers of a multi-worker
+    # server share the LLM_CONCURRENCY slots of the backend (see `SharedLLMSlots`).
+    if LLM_BACKEND == 'scripted':
+        return (ScriptedChatModel if workers == 1 else SharedScriptedChatModel)(max_tokens=max_tokens, token_latency=SCRIPTED_LLM_TOKEN_LATENCY,
+                                                                                 prompt_latency=SCRIPTED_LLM_PROMPT_LATENCY, parallel=SCRIPTED_LLM_PARALLEL)
+    if LLM_BACKEND != 'ollama': raise ValueError("Unknown LLM backend {}, expected 'ollama' or 'scripted'".format(LLM_BACKEND))
+    return (ChatOllama if workers == 1 else SharedChatOllama)(model=LLM_MODEL, temperature=temp, max_tokens=max_tokens, keep_alive=LLM_KEEP_ALIVE)
+
+def warmup_llm(model=LLM_MODEL, keep_alive=LLM_KEEP_ALIVE):
+    # An empty request makes Ollama load the model, and keep it loaded, so that the first user does not pay for it
+    if LLM_BACKEND != 'ollama': return
+    try:
+        ollama.generate(model=model, prompt='', keep_alive=keep_alive)
+    except Exception as e:
+        # Not fatal: the model is loaded by the first request instead
+        logger.warning("LLM warm-up failed: {!r}".format(e))
+
+def create_agent(user_name, host, retriever, table_names, max_tokens=512, temp=0.1):
+    # Create retriever tool
     retriever_tool = create_retriever_tool(retriever, name="search_medical_information", description="Use to look up additional medical context and information to answer the question.")
-    tools = [retriever_tool]
     
     # Load LLM
-    print("Loading LLM...")
-    llm = ChatOllama(model="llama3.1", temperature=temp, max_tokens=max_tokens)
-    
-    # Load DB
-    db = SQLDatabase.from_uri("sqlite:///" + DB_PATH)
-    toolkit = SQLDatabaseToolkit(db=db, llm=llm)
-    #tools += toolkit.get_tools()
+    llm = load_llm(max_tokens=max_tokens, temp=temp)
     
     # Create additional tools
-    search_doctor_by_specialization_tool = StructuredTool.from_function(func=search_doctor_by_specialization, name="search_doctor_by_specialization", description="Use to look up a list of doctor with a desired specialization.", handle_tool_error=True)
-    search_available_doctor_appointments_tool = StructuredTool.from_function(func=search_available_doctor_appointments, name="search_available_doctor_appointments", description="Use to look up a list of available time slots for appointments with a given doctor.", handle_tool_error=True)
-    search_patient_appointments_tool = StructuredTool.from_function(func=search_patient_appointments, name="search_patient_appointments", description="Use to look up the list of appointments currently scheduled by the patient", handle_tool_error=True)
+    search_doctor_by_specialization_tool = StructuredTool.from_function(func=search_doctor_by_specialization, name="search_doctor_by_specialization", description="Use to look up a list of doctor with a desired specialization. Specializations are matched by the beginning of their name, e.g. Cardiology or Cardio.", handle_tool_error=True)
+    search_available_doctor_appointments_tool = StructuredTool.from_function(func=search_available_doctor_appointments, name="search_available_doctor_appointments", description="Use to look up a list of the first available time slots for appointments with a given doctor, optionally between two dates. Doctors are matched by the beginning of their name, e.g. Dr. Lyubor or Lyubor, not by a word from its middle.", handle_tool_error=True)
+    search_next_available_appointments_tool = StructuredTool.from_function(func=search_next_available_appointments, name="search_next_available_appointments", description="Use to look up a list of the earliest available time slots for appointments with any doctor of a desired specialization. Specializations are matched by the beginning of their name, e.g. Cardiology or Cardio.", handle_tool_error=True)
+    search_patient_appointments_tool = StructuredTool.from_function(func=search_patient_appointments, name="search_patient_appointments", description="Use to look up the list of appointments currently scheduled by the patient, optionally with a doctor matched by the beginning of their name, e.g. Dr. Lyubor or Lyubor.", handle_tool_error=True)
     register_emergency_tool = StructuredTool.from_function(func=register_emergency, name="register_emergency", description="Use to register a medical emergency manifested by a patient with a corresponding color-code.", handle_tool_error=True)
-    tools += [retriever_tool, search_doctor_by_specialization_tool, search_available_doctor_appointments_tool, search_patient_appointments_tool, register_emergency_tool]
+    tools = [retriever_tool, search_doctor_by_specialization_tool, search_available_doctor_appointments_tool, search_next_available_appointments_tool, search_patient_appointments_tool, register_emergency_tool]
+    
+    # Create agent
+    # The system prompt is rendered for the user of the current session, falling back to the given user name, with the
+    # current date, so that the agent can turn dates such as "next Tuesday" into the dates of the tools
+    def prompt(messages):
+        today = datetime.date.today().strftime('%A %Y-%m-%d')
+        return [SystemMessage(content=prompt_template.format(user_name=current_user.get(user_name), today=today, table_names=table_names, host=host))] + messages
+    # The graph prints each step of the agent at the debug log level
+    return create_react_agent(llm, tools, messages_modifier=prompt, debug=logger.isEnabledFor(logging.DEBUG))
+
+def initialize_llm(user_name, host, k=2, max_tokens=512, temp=0.1, embeddings=None):
+    # Load embeddings, unless shared with the caller
+    logger.info("Loading embeddings...")
+    if embeddings is None: embeddings = load_hf_embeddings()
+    
+    # Load index
+    logger.info("Loading index...")
+    index = open_index(INDEX_PATH, INDEX_TYPE, nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH, mmap=INDEX_MMAP)
+    retriever = load_retriever(embeddings, index, reranker=load_reranker(), k=k)
     
     # Create agent
-    print("Loading agent...")
-    prompt = SystemMessage(content=prompt_template.format(user_name=user_name, table_names=db.get_usable_table_names(), host=host))
-    agent = create_react_agent(llm, tools, messages_modifier=prompt, debug=True)
+    logger.info("Loading agent...")
+    agent = create_agent(user_name, host, retriever, db.list_tables(), max_tokens=max_tokens, temp=temp)
     
-    print("Done!")
+    logger.info("Done!")
     
     return agent
 
+def start_components(user_name, host, k=2, max_tokens=512, temp=0.1):
+    """
+    Load the components of the app in the background: the embedding model, the vector index, the reranker, the database
+    table names, the chat history store and the LLM warm-up are independent and run concurrently, then the agent, intent
+    router and answer cache are created. Components are available from the returned `Startup` once it is ready, e.g. `startup['agent']`.
+    """
+    return Startup({
+        'embeddings': (load_hf_embeddings, []),
+        'index': (lambda: open_index(INDEX_PATH, INDEX_TYPE, nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH, mmap=INDEX_MMAP), []),
+        'reranker': (load_reranker, []),
+        'tables': (db.list_tables, []),
+        'llm_warmup': (warmup_llm, []),
+        'history': (get_history_store, []),
+        'agent': (lambda embeddings, index, reranker, tables: create_agent(user_name, host, load_retriever(embeddings, index, reranker=reranker, k=k), tables, max_tokens=max_tokens, temp=temp),
+                  ['embeddings', 'index', 'reranker', 'tables']),
+        'router': (lambda embeddings: load_router(embeddings) if ROUTER else None, ['embeddings']),
+        'answer_cache': (lambda embeddings: load_answer_cache(embeddings) if ANSWER_CACHE else None, ['embeddings']),
+    }).start()
+
 def search_doctor_by_specialization(specialization: str) -> list[str]:
     """
     Look up doctor with a given specialization field.
     
-    :param specialization: The name of the specialization area, e.g. Cardiology.
+    :param specialization: The name of the specialization area, or its beginning, e.g. Cardiology or Cardio (not a word from its middle).
     :return: A list of doctors with the given specialization area.
     """
     
-    # Open connection to DB
-    db = sqlite3.connect(DB_PATH)
-    cur = db.cursor()
-    
-    # Prepare query to retrieve doctor information
-    query = """
-                SELECT name
-                FROM doctors
-                WHERE LOWER(specialization) LIKE LOWER(?)
-            """
-    
     # Execute query and fetch result
-    result = cur.execute(query, ('%' + specialization + '%',))
-    return list((r[0] for r in result.fetchall()))
+    return db.find_doctors_by_specialization(specialization)
+
+def slot_dates(start_date, end_date):
+    # Time range of the tools' optional dates, reported to the agent if malformed
+    try:
+        return availability.date_range(start_date, end_date)
+    except ValueError:
+        raise ToolException("Invalid date range {} - {}. Dates must be in the format YYYY-MM-DD.".format(start_date, end_date))
 
-def search_available_doctor_appointments(doctor: str) -> list[dict]:
+def with_links(slots):
+    return [{'time_slot': s['time_slot'], 'doctor': s['doctor'], 'reservation_link': '<a href="res?id={}" target="_blank"> link </a>'.format(s['id'])} for s in slots]
+
+def search_available_doctor_appointments(doctor: str, start_date: str = None, end_date: str = None) -> list[dict]:
     """
-    Look up available time slots for appointments with a given doctor.
+    Look up the first available time slots for appointments with a given doctor, optionally between two dates.
 
-    :param doctor: The name of the doctor.
-    :return: A list of time slots for appointments with the corresponding doctor and reservation link.
+    :param doctor: The name of the doctor as written in the appointments, or its beginning, e.g. Dr. Lyubor or Lyubor (not a word from its middle).
+    :param start_date: The first date (YYYY-MM-DD) of the time slots, e.g. to see the time slots after the ones already shown. If null starts from the current time.
+    :param end_date: The last date (YYYY-MM-DD) of the time slots. If null there is no last date.
+    :return: A list of at most AVAILABILITY_TOOL_SLOTS time slots for appointments, in chronological order, with the corresponding doctor and reservation link.
     """
     
-    # Open connection to DB
-    db = sqlite3.connect(DB_PATH)
-    cur = db.cursor()
-    
-    # Prepare query to retrieve time slot information
-    query = """
-                SELECT id, time_slot, doctor
-                FROM appointments
-                WHERE patient is null and LOWER(doctor) LIKE LOWER(?)
-            """
-    
     # Execute query and fetch result
-    result = cur.execute(query, ('%' + doctor + '%',))
-    return list(({'time_slot': r[1], 'doctor': r[2], 'reservation_link': '<a href="res?id={}" target="_blank"> link </a>'.format(r[0])} for r in result.fetchall()))
+    start, end = slot_dates(start_date, end_date)
+    return with_links(availability.list_available(doctor, start=start, end=end, limit=AVAILABILITY_TOOL_SLOTS))
+
+def search_next_available_appointments(specialization: str, start_date: str = None, end_date: str = None) -> list[dict]:
+    """
+    Look up the earliest available time slots for appointments with any doctor of a given specialization.
+
+    :param specialization: The name of the specialization area, or its beginning, e.g. Cardiology or Cardio (not a word from its middle).
+    :param start_date: The first date (YYYY-MM-DD) of the time slots. If null starts from the current time.
+    :param end_date: The last date (YYYY-MM-DD) of the time slots. If null there is no last date.
+    :return: A list of at most AVAILABILITY_TOOL_SLOTS time slots for appointments, in chronological order, with the corresponding doctor and reservation link.
+    """
+
+    # Execute query and fetch result
+    start, end = slot_dates(start_date, end_date)
+    return with_links(availability.next_available(specialization, n=AVAILABILITY_TOOL_SLOTS, start=start, end=end))
 
 def search_patient_appointments(patient: str, doctor: str = None) -> list[dict]:
     """
     Look up scheduled appointments of a patient with a given doctor.
 
     :param patient: The name of the patient.
-    :param doctor: The name of the doctor. If null returns the patient appointments with all doctors.
+    :param doctor: The name of the doctor, or its beginning, e.g. Dr. Lyubor or Lyubor (not a word from its middle). If null returns the patient appointments with all doctors.
     :return: A list of time slots of scheduled appointments with the corresponding doctor and reservation link.
     :raises ToolException: if the user is trying to access information of another patient.
     """
     
     # Check that user is authorized to access patient information
-    if patient.lower() != USER_NAME.lower():
-        raise ToolException("Current user is {}. This user is not allowed to access patient {}'s information. This information is confidential and cannot be disclosed. Answer the user's question by notifying this issue.".format(USER_NAME, patient))
-    
-    # Open connection to DB
-    db = sqlite3.connect(DB_PATH)
-    cur = db.cursor()
-    
-    if doctor is not None and doctor != '':
-        # Prepare query to retrieve time slot information
-        query = """
-                    SELECT id, time_slot, doctor
-                    FROM appointments
-                    WHERE LOWER(patient) LIKE LOWER(?) and LOWER(doctor) LIKE LOWER(?)
-                """
-    
-        # Execute query and fetch result
-        result = cur.execute(query, ('%' + patient + '%', '%' + doctor + '%',))
-    else:
-        # Prepare query to retrieve time slot information
-        query = """
-                    SELECT id, time_slot, doctor
-                    FROM appointments
-                    WHERE LOWER(patient) LIKE LOWER(?)
-                """
-        # Execute query and fetch result
-        result = cur.execute(query, ('%' + patient + '%',))
+    user_name = current_user.get()
+    if patient.lower() != user_name.lower():
+        raise ToolException("Current user is {}. This user is not allowed to access patient {}'s information. This information is confidential and cannot be disclosed. Answer the user's question by notifying this issue.".format(user_name, patient))
     
-    return list(({'time_slot': r[1],'doctor': r[2],  'reservation_link': '<a href="res?id={}" target="_blank"> link </a>'.format(r[0])} for r in result.fetchall()))
+    # Execute query and fetch result
+    result = db.find_patient_appointments(patient, doctor)
+    return list(({'time_slot': r[1],'doctor': r[2],  'reservation_link': '<a href="res?id={}" target="_blank"> link </a>'.format(r[0])} for r in result))
 
 def register_emergency(patient: str, question: str, code: str) -> str:
     """
@@ -167,27 +244,13 @@ def register_emergency(patient: str, question: str, code: str) -> str:
         :return: A success message of the operation.
     """
     
-    # Get current datetime in string format
-    t = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
-    
-    # Open connection to DB
-    db = sqlite3.connect(DB_PATH)
-    cur = db.cursor()
-    
-    # Prepare and execute query to create emergency table if it does not exist already.
-    query = """
-                CREATE TABLE IF NOT EXISTS emergencies(user, patient, time, question, code)
-            """
-    cur.execute(query)
+    # Validate color-code
+    code = code.strip().upper()
+    if code not in EMERGENCY_CODES:
+        raise ToolException("Invalid color-code {}. The color-code must be one of {}.".format(code, ', '.join(EMERGENCY_CODES)))
     
-    # Prepare query to register emergency
-    query = """
-                INSERT INTO emergencies VALUES (?, ?, ?, ?, ?)
-            """
-    
-    # Execute query and fetch result
-    cur.execute(query, (USER_NAME, patient, t, question, code))
-    db.commit()
+    # Register emergency, notifying the staff following the live emergency stream
+    emergencies.register(current_user.get(), patient, question, code)
     
     return "The emergency has been registered. Do not answer the user's question by returning the emergency color-code, because that information is reserved for doctors; instead, return general health tips related to the condition described by the user, reassure the user that the emergency can be handled by medical intervention, and advise consulting a healthcare professional."
 
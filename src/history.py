@@ -0,0 +1,260 @@
+import os
+import re
+import glob
+import gzip
+import hashlib
+import json
+import queue
+import time
+import logging
+import datetime
+import threading
+
+from .db import ConnectionPool
+from config import *
+
+
+logger = logging.getLogger(__name__)
+
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+EXPORT_TIME_FORMAT = '%d-%m-%Y %H:%M:%S'
+
+CREATE_MESSAGES = """
+            CREATE TABLE IF NOT EXISTS messages(
+                id INTEGER PRIMARY KEY,
+                user_key TEXT NOT NULL,
+                time TEXT NOT NULL,
+                source TEXT NOT NULL,
+                text TEXT NOT NULL
+            )
+        """
+
+CREATE_MESSAGES_INDEX = """
+            CREATE INDEX IF NOT EXISTS idx_messages_user ON messages(user_key, id)
+        """
+
+INSERT_MESSAGE = """
+            INSERT INTO messages(user_key, time, source, text) VALUES (?, ?, ?, ?)
+        """
+
+# Keyset pagination: pages start after the last id of the previous page
+SELECT_MESSAGES = """
+            SELECT id, time, source, text
+            FROM messages
+            WHERE user_key = ? and id > ? and time >= ? and time < ?
+            ORDER BY id
+            LIMIT ?
+        """
+
+COUNT_MESSAGES = """
+            SELECT count(*)
+            FROM messages
+            WHERE user_key = ?
+        """
+
+SELECT_OLDEST_MESSAGES = """
+            SELECT id, time, source, text
+            FROM messages
+            WHERE user_key = ?
+            ORDER BY id
+            LIMIT ?
+        """
+
+DELETE_MESSAGES_UNTIL = """
+            DELETE FROM messages
+            WHERE user_key = ? and id <= ?
+        """
+
+# Bounds of an open time range
+MIN_TIME, MAX_TIME = '', '\U0010ffff'
+LEGACY_ENTRY = re.compile(r'^\[(\d{2}-\d{2}-\d{4} \d{2}:\d{2}:\d{2})\] (user|bot): ', re.MULTILINE)
+
+
+def user_key(user_name):
+    return user_name.lower()
+
+def format_message(message):
+    # Export format of the chat history, e.g. "[19-09-2024 18:13:31] user: hello"
+    t = datetime.datetime.strptime(message['time'], TIME_FORMAT).strftime(EXPORT_TIME_FORMAT)
+    return "[{}] {}: {}\n\n".format(t, message['source'], message['text'])
+
+
+class HistoryStore:
+    """
+    Chat history of all users, stored in SQLite. Messages are appended to an in-memory queue and written by a background
+    thread in batches, when `batch_size` messages are pending or `flush_interval` seconds after the first pending one. When a user has more
+    than `max_messages` messages, the oldest ones are moved to gzipped JSON-lines segments of `segment_size` messages
+    in `archive_path`, so that the live store stays bounded; exports include the archived segments.
+    """
+
+    def __init__(self, path, archive_path, flush_interval=1., flush_timeout=5., batch_size=256, max_messages=10000, segment_size=2000):
+        self.archive_path = archive_path
+        self.flush_interval = flush_interval
+        self.flush_timeout = flush_timeout
+        self.batch_size = batch_size
+        self.max_messages = max_messages
+        self.segment_size = segment_size
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.pool = ConnectionPool(path, size=DB_POOL_SIZE, timeout=DB_TIMEOUT, cached_statements=DB_CACHED_STATEMENTS)
+        with self.pool.connection() as conn:
+            conn.execute(CREATE_MESSAGES)
+            conn.execute(CREATE_MESSAGES_INDEX)
+        self.import_legacy(os.path.dirname(path))
+
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='history-writer', daemon=True)
+        self._writer.start()
+
+    def append(self, user_name, text, source):
+        """
+        Queue a message for writing, without blocking the caller.
+        """
+        self._queue.put((user_key(user_name), datetime.datetime.now().strftime(TIME_FORMAT), source, text))
+
+    def flush(self, timeout=None):
+        """
+        Wait until the messages queued before the call are written, without waiting for the ones queued afterwards.
+
+        :param timeout: Maximum seconds to wait, None to wait until they are written.
+        :return: True if the messages were written, False if the timeout elapsed.
+        """
+        written = threading.Event()
+        self._queue.put(written)
+        return written.wait(timeout)
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+        self.pool.close()
+
+    def _write_loop(self):
+        closing = False
+        while not closing:
+            # Wait for a message, then collect more until the batch is full or the flush interval since the first one
+            # elapses. Flush requests (events) write the batch right away and are set once it is written.
+            batch, flushes = [], []
+            item = self._queue.get()
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is None: closing = True
+                elif isinstance(item, threading.Event): flushes.append(item)
+                else: batch.append(item)
+                if closing or len(flushes) > 0 or len(batch) >= self.batch_size: break
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+            if len(batch) > 0: self._write(batch)
+            for written in flushes: written.set()
+
+    def _write(self, batch):
+        try:
+            with self.pool.connection() as conn:
+                conn.executemany(INSERT_MESSAGE, batch)
+        except Exception as e:
+            logger.error("Failed to write {} chat history messages: {!r}".format(len(batch), e))
+            return
+        # The messages are written: a failed rotation only leaves the live store of a user over its bound until the next one
+        for key in set(item[0] for item in batch):
+            try:
+                self._rotate(key)
+            except Exception as e:
+                logger.error("Failed to archive the oldest chat history messages of {}: {!r}".format(key, e))
+
+    def _archive_folder(self, key):
+        # Named after a digest of the key, since keys are free text: any sanitization of the name maps different users
+        # (e.g. "bob smith" and "bob_smith") to the same folder
+        return os.path.join(self.archive_path, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def _rotate(self, key):
+        # Move the oldest messages of a user to compressed segments, until the live store is within bounds
+        with self.pool.connection() as conn:
+            while conn.execute(COUNT_MESSAGES, (key,)).fetchone()[0] > self.max_messages:
+                rows = conn.execute(SELECT_OLDEST_MESSAGES, (key, self.segment_size)).fetchall()
+                folder = self._archive_folder(key)
+                os.makedirs(folder, exist_ok=True)
+                # Segments are named after their first id, so that their order is the order of the messages, and
+                # writing a segment again after an interrupted rotation overwrites it
+                segment = os.path.join(folder, '{:012d}.jsonl.gz'.format(rows[0][0]))
+                with gzip.open(segment + '.tmp', 'wt') as f:
+                    for i, t, source, text in rows:
+                        f.write(json.dumps({'id': i, 'user_key': key, 'time': t, 'source': source, 'text': text}) + '\n')
+                os.replace(segment + '.tmp', segment)
+                conn.execute(DELETE_MESSAGES_UNTIL, (key, rows[-1][0]))
+                conn.commit()
+
+    def read(self, user_name, after=0, start=None, end=None, limit=HISTORY_PAGE_SIZE):
+        """
+        Read a page of the messages of a user in the live store, optionally within a time range.
+
+        :param after: Id of the last message of the previous page, 0 for the first page.
+        :param start: Start of the time range (inclusive), as a 'YYYY-MM-DD[ HH:MM:SS]' string.
+        :param end: End of the time range (exclusive), as a 'YYYY-MM-DD[ HH:MM:SS]' string.
+        :return: A list of messages, as dicts with id, time, source and text.
+        """
+        with self.pool.connection() as conn:
+            rows = conn.execute(SELECT_MESSAGES, (user_key(user_name), after, start or MIN_TIME, end or MAX_TIME, limit)).fetchall()
+        return [{'id': i, 'time': t, 'source': source, 'text': text} for i, t, source, text in rows]
+
+    def export(self, user_name, start=None, end=None, page_size=HISTORY_PAGE_SIZE):
+        """
+        Export the whole history of a user, archived segments first, optionally within a time range.
+
+        :return: A generator of text chunks, one per segment or page.
+        """
+        # Include the messages queued so far, but do not hold the download for longer than flush_timeout
+        if not self.flush(self.flush_timeout):
+            logger.warning("Exporting the chat history of {} before its last messages are written".format(user_key(user_name)))
+        key, start, end = user_key(user_name), start or MIN_TIME, end or MAX_TIME
+        for segment in sorted(glob.glob(os.path.join(self._archive_folder(key), '*.jsonl.gz'))):
+            with gzip.open(segment, 'rt') as f:
+                messages = [json.loads(line) for line in f]
+            # Every message records its user, so that a segment never yields the messages of another one
+            chunk = ''.join(format_message(m) for m in messages if m.get('user_key') == key and start <= m['time'] < end)
+            if len(chunk) > 0: yield chunk
+        after = 0
+        while True:
+            messages = self.read(user_name, after=after, start=start, end=end, limit=page_size)
+            if len(messages) == 0: break
+            yield ''.join(format_message(m) for m in messages)
+            after = messages[-1]['id']
+
+    def import_legacy(self, folder):
+        # Import the plain text histories of previous versions (<user>.txt) once. Every worker of a multi-worker server
+        # opens the store: files are imported under a lock shared by the processes, so that the first worker imports
+        # them and the others find them already renamed.
+        from .workers import FileLock # Imported here, since workers imports this module
+        with FileLock(os.path.join(folder, 'import.lock')):
+            for file_path in glob.glob(os.path.join(folder, '*.txt')):
+                with open(file_path) as f:
+                    content = f.read()
+                entries = LEGACY_ENTRY.split(content)[1:]
+                rows = [(user_key(os.path.basename(file_path)[:-4]), datetime.datetime.strptime(t, EXPORT_TIME_FORMAT).strftime(TIME_FORMAT), source, text.rstrip('\n'))
+                        for t, source, text in zip(entries[0::3], entries[1::3], entries[2::3])]
+                with self.pool.connection() as conn:
+                    conn.executemany(INSERT_MESSAGE, rows)
+                os.replace(file_path, file_path + '.imported')
+                logger.info("Imported {} messages from {}".format(len(rows), file_path))
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = HistoryStore(HISTORY_DB_PATH, HISTORY_ARCHIVE_FOLDER, flush_interval=HISTORY_FLUSH_INTERVAL, flush_timeout=HISTORY_FLUSH_TIMEOUT,
+                                      batch_size=HISTORY_BATCH_SIZE, max_messages=HISTORY_MAX_MESSAGES, segment_size=HISTORY_SEGMENT_SIZE)
+    return _store
+
+def close_store():
+    global _store
+    with _store_lock:
+        if _store is not None: _store.close()
+        _store = None
+
+def append_to_history(user_name, text, source):
+    get_store().append(user_name, text, source)
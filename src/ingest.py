@@ -0,0 +1,86 @@
+import os
+import functools
+import collections
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from langchain_core.documents import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from .helper import load_file
+from config import *
+
+
+PARSERS = ('unstructured', 'native')
+
+def iter_qa_pairs(file_path):
+    """
+    Parse a MedQuAD XML file into its question/answer pairs.
+
+    :param file_path: Path to the XML file.
+    :return: A generator of (question, answer, metadata) tuples, in document order.
+    """
+    root = ET.parse(file_path).getroot()
+    focus = (root.findtext('Focus') or '').strip()
+    url = root.get('url', '')
+    for pair in root.iter('QAPair'):
+        question = pair.find('Question')
+        answer = (pair.findtext('Answer') or '').strip()
+        if question is None or answer == '': continue
+        metadata = {'source': file_path, 'focus': focus, 'url': url, 'qtype': question.get('qtype', ''), 'qid': question.get('qid', '')}
+        yield (question.text or '').strip(), answer, metadata
+
+def load_medquad(file_path):
+    # Native parser: one document per question/answer pair, without the unstructured/nltk pipeline
+    return [Document(page_content="Question: {}\nAnswer: {}".format(q, a), metadata=metadata) for q, a, metadata in iter_qa_pairs(file_path)]
+
+
+@functools.lru_cache(maxsize=None)
+def get_splitter(chunk_size, chunk_overlap):
+    # Created once per worker process
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+def load_and_split(file_path, chunk_size, chunk_overlap, parser='unstructured'):
+    data = load_medquad(file_path) if parser == 'native' else load_file(file_path)
+    return get_splitter(chunk_size, chunk_overlap).split_documents(data)
+
+def _load_and_split_task(args):
+    return load_and_split(*args)
+
+def iter_chunks(data_path, files, chunk_size, chunk_overlap, workers=1, parser='unstructured'):
+    """
+    Load and split files, fanning the work out over a pool of worker processes.
+
+    Chunks are yielded file by file, in the same order as the input files, and with the same ids and metadata
+    regardless of the number of workers. At most a few files per worker are in flight at any time, so that parsed
+    chunks do not pile up in memory when the consumer (e.g. embedding) is slower than parsing.
+
+    :param data_path: Root folder of the dataset.
+    :param files: Paths of the files to process, relative to the data path.
+    :param chunk_size: Chunk size for the text splitter.
+    :param chunk_overlap: Chunk overlap for the text splitter.
+    :param workers: Number of worker processes. With 1 worker, files are processed in the current process.
+    :param parser: Either "unstructured" (UnstructuredXMLLoader) or "native" (MedQuAD question/answer pairs).
+    :return: A generator of (relative path, chunks, chunk ids) tuples.
+    """
+    if parser not in PARSERS: raise ValueError("Unknown parser {}, expected one of {}".format(parser, PARSERS))
+    tasks = ((os.path.join(data_path, rel_path), chunk_size, chunk_overlap, parser) for rel_path in files)
+
+    def make_result(rel_path, chunks):
+        return rel_path, chunks, ['{}#{}'.format(rel_path, i) for i in range(len(chunks))]
+
+    if workers <= 1:
+        for rel_path, task in zip(files, tasks):
+            yield make_result(rel_path, _load_and_split_task(task))
+        return
+
+    # Keep a bounded window of pending tasks, consumed in submission order
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+        for rel_path, task in zip(files, tasks):
+            pending.append((rel_path, executor.submit(_load_and_split_task, task)))
+            if len(pending) >= INGEST_QUEUE_FACTOR * workers:
+                rel_path, future = pending.popleft()
+                yield make_result(rel_path, future.result())
+        while len(pending) > 0:
+            rel_path, future = pending.popleft()
+            yield make_result(rel_path, future.result())
@@ -0,0 +1,54 @@
+import os
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+
+
+# Turns take from milliseconds (router, answer cache) to minutes (LLM on constrained hardware), internal stages from
+# microseconds (SQLite) to seconds (reranking)
+TURN_BUCKETS = (.01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60., 120., 300., 600.)
+STAGE_BUCKETS = (.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5.)
+
+
+# Requests, by the path that answered them: 'router', 'answer_cache' or 'agent'
+TURN_SECONDS = Histogram('medassist_turn_seconds', "Duration of conversation turns, by answering path.", ['path'], buckets=TURN_BUCKETS)
+TIME_TO_FIRST_TOKEN_SECONDS = Histogram('medassist_time_to_first_token_seconds', "Time from the start of a turn to the first token generated by the LLM.", buckets=TURN_BUCKETS)
+AGENT_STEPS = Histogram('medassist_agent_steps', "LLM generations per agent turn.", buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15))
+
+# LLM generations and tool calls of the agent
+LLM_GENERATION_SECONDS = Histogram('medassist_llm_generation_seconds', "Duration of each LLM generation.", buckets=TURN_BUCKETS)
+LLM_TOKENS = Counter('medassist_llm_tokens', "Tokens processed by the LLM, by kind (input or output).", ['kind'])
+HISTORY_TOKENS = Histogram('medassist_history_tokens', "Tokens of conversation history and summary sent to the agent with each turn.",
+                           buckets=(64, 128, 256, 512, 768, 1024, 1536, 2048, 4096, 8192))
+TOOL_SECONDS = Histogram('medassist_tool_seconds', "Duration of tool calls, by tool.", ['tool'], buckets=STAGE_BUCKETS + (10., 30.))
+
+# Internal stages: embedding, vector_search, lexical_search, rerank, docstore, sqlite, router, answer_cache, llm_slot
+STAGE_SECONDS = Histogram('medassist_stage_seconds', "Duration of internal stages of a request, by stage.", ['stage'], buckets=STAGE_BUCKETS)
+
+# Semantic answer cache. The hit ratio is hits / (hits + misses) of `medassist_answer_cache_lookups_total`.
+ANSWER_CACHE_LOOKUPS = Counter('medassist_answer_cache_lookups', "Answer cache lookups, by result (hit, miss, or skipped for personal and follow-up questions).", ['result'])
+ANSWER_CACHE_SAVED_SECONDS = Counter('medassist_answer_cache_saved_seconds', "Agent time saved by answer cache hits, in seconds.")
+ANSWER_CACHE_STORES = Counter('medassist_answer_cache_stores', "Answered turns offered to the answer cache, by result (stored or skipped).", ['result'])
+ANSWER_CACHE_ENTRIES = Gauge('medassist_answer_cache_entries', "Number of answers in the answer cache.", multiprocess_mode='livemax')
+
+# Intent router. Requests answered by the agent are counted with intent 'agent'.
+ROUTER_REQUESTS = Counter('medassist_router_requests', "Requests classified by the intent router, by routed intent.", ['intent'])
+
+# Emergencies
+EMERGENCIES_REGISTERED = Counter('medassist_emergencies_registered', "Emergencies registered by the agent, by color-code.", ['code'])
+EMERGENCY_SUBSCRIBERS = Gauge('medassist_emergency_subscribers', "Clients following the live emergency stream.", multiprocess_mode='livesum')
+
+# Startup
+STARTUP_PHASE_SECONDS = Gauge('medassist_startup_phase_seconds', "Duration of each startup phase, in seconds.", ['phase'], multiprocess_mode='max')
+
+
+def render():
+    """
+    Render all metrics in the Prometheus text format.
+
+    :return: A (body, content type) pair.
+    """
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # Metrics of all the workers of a multi-worker server, written to files by each worker (see gunicorn.conf.py)
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,109 @@
+from . import db
+from config import *
+
+
+SUCCESS_RESPONSES = {'reserve': "Reservation successful", 'cancel': "Cancellation successful"}
+ERROR_RESPONSE = "Unable to process request."
+QUERIES = {'reserve': db.RESERVE_APPOINTMENT, 'cancel': db.CANCEL_APPOINTMENT}
+
+
+def retrieve_appointment(slot_id):
+    # Execute query on pooled connection and fetch result
+    return db.get_appointment(slot_id)
+
+def slot_details(user_name, slot_id):
+    """
+    Look up a time slot on behalf of a user.
+
+    :param user_name: The name of the user.
+    :param slot_id: The id of the time slot.
+    :return: A (status, details) pair, where status is 404 if the slot does not exist, 401 if it is reserved by another
+             patient, and 200 otherwise, in which case details is a dict with doctor, time slot, slot status and
+             version.
+    """
+    # Retrieve time slot details
+    row = retrieve_appointment(slot_id)
+
+    # If no results were found, return error
+    if row is None:
+        return 404, None
+
+    # Parse result
+    doctor, time_slot, patient, version = row
+    slot_status = "reserved" if patient is not None else "available"
+
+    # Check that patient is authorized to access the required information
+    if slot_status == "reserved" and patient.lower() != user_name.lower():
+        return 401, None
+
+    return 200, {'slot_id': slot_id, 'doctor': doctor, 'time_slot': time_slot, 'slot_status': slot_status, 'version': version}
+
+def slot_result(action, user_name, slot_id, updated, patient, version):
+    # New state of a slot, as seen by the user: slots of other patients (and missing slots) are only reported as reserved
+    result = {"slot_id": slot_id, "response": SUCCESS_RESPONSES[action] if updated else ERROR_RESPONSE,
+              "slot_status": "reserved" if patient is not None or version is None else "available"}
+    if version is not None and (patient is None or patient.lower() == user_name.lower()): result["version"] = version
+    return result
+
+def update(action, user_name, slots, atomic=False):
+    """
+    Reserve or cancel time slots for a user, each with a single conditional update (see `db.RESERVE_APPOINTMENT`).
+
+    :param action: 'reserve' or 'cancel'.
+    :param user_name: The name of the user.
+    :param slots: A list of (slot id, expected version or None) pairs. A slot whose version differs from the expected
+                  one was changed since the user last saw it, and is not updated.
+    :param atomic: If True, either all slots are updated or none is.
+    :return: A list of dicts with the slot id, response message, new slot status and new version of each slot.
+    """
+    results = db.update_appointments(QUERIES[action], user_name.strip(), slots, atomic=atomic)
+    return [slot_result(action, user_name, *r) for r in results]
+
+def reserve(user_name, slot_id, version=None):
+    """
+    Reserve a time slot for a user.
+
+    :return: A dict with the response message, the new slot status and the new version.
+    """
+    return update('reserve', user_name, [(slot_id, version)])[0]
+
+def cancel(user_name, slot_id, version=None):
+    """
+    Cancel the reservation of a time slot for a user.
+
+    :return: A dict with the response message, the new slot status and the new version.
+    """
+    return update('cancel', user_name, [(slot_id, version)])[0]
+
+def reserve_many(user_name, slot_ids, atomic=False):
+    return update('reserve', user_name, [(slot_id, None) for slot_id in slot_ids], atomic=atomic)
+
+def cancel_many(user_name, slot_ids, atomic=False):
+    return update('cancel', user_name, [(slot_id, None) for slot_id in slot_ids], atomic=atomic)
+
+BATCH_ACTIONS = {'reserve': reserve_many, 'cancel': cancel_many}
+
+def parse_batch(data, max_slots=MAX_BATCH_SLOTS):
+    """
+    Validate the payload of a batch request: {"action": "reserve" | "cancel", "slot_ids": [...], "atomic": false}.
+
+    :return: An (action, slot ids, atomic) tuple.
+    :raise ValueError: If the payload is malformed, a slot id is not an integer, or there are more than `max_slots`
+                       slots.
+    """
+    if not isinstance(data, dict) or data.get('action') not in BATCH_ACTIONS: raise ValueError("Unknown batch action.")
+    slot_ids, atomic = data.get('slot_ids'), data.get('atomic', False)
+    if not isinstance(slot_ids, list) or not isinstance(atomic, bool): raise ValueError("Malformed batch request.")
+    if len(slot_ids) > max_slots: raise ValueError("At most {} time slots per batch.".format(max_slots))
+    # Integers, or strings of digits as in the forms of single reservations
+    if not all((isinstance(i, int) and not isinstance(i, bool)) or (isinstance(i, str) and i.strip().isdigit()) for i in slot_ids):
+        raise ValueError("Time slot ids must be integers.")
+    return data['action'], [int(i) for i in slot_ids], atomic
+
+def update_batch(action, user_name, slot_ids, atomic=False):
+    """
+    Reserve or cancel several time slots for a user (see `reserve_many` and `cancel_many`).
+
+    :return: A list of dicts with the slot id, response message, new slot status and new version of each slot.
+    """
+    return BATCH_ACTIONS[action](user_name, slot_ids, atomic=atomic)
@@ -0,0 +1,156 @@
+import re
+import logging
+import threading
+import collections
+from typing import Any
+import numpy as np
+from langchain_core.retrievers import BaseRetriever
+
+from . import tracing
+from config import *
+
+
+logger = logging.getLogger(__name__)
+
+
+RETRIEVAL_MODES = ('dense', 'lexical', 'hybrid')
+
+# Words too common to tell documents apart: they would not change the BM25 ranking much, but make it read long
+# posting lists
+STOPWORDS = frozenset("""
+    a about am an and any are as at be been but by can could do does did for from had has have how i if in into is it
+    its me my no not of on or our should so some than that the their them then there these they this to was we were
+    what when where which who why will with would you your
+    """.split())
+
+
+def lexical_query(text):
+    """
+    Convert a question to an FTS5 query matching any of its words, e.g. 'What is lupus?' -> '"lupus"'. Words are
+    quoted, so that none is parsed as an operator.
+    """
+    words = [w for w in re.findall(r'\w+', text.lower()) if w not in STOPWORDS]
+    return ' OR '.join('"{}"'.format(w) for w in dict.fromkeys(words))
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Fuse rankings of documents by the sum of their reciprocal ranks, 1 / (k + rank), which only relies on the order of
+    each ranking, so that BM25 and vector scores never need to be calibrated against each other.
+
+    :param rankings: Lists of document positions, best first.
+    :return: The fused list of positions, best first.
+    """
+    scores = collections.defaultdict(float)
+    for ranking in rankings:
+        for rank, pos in enumerate(ranking):
+            scores[pos] += 1. / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class CrossEncoderReranker:
+    """
+    Cross-encoder scoring of (question, document) pairs, in batches, with a bounded number of CPU threads.
+    """
+
+    def __init__(self, model_name, batch_size=16, threads=None, device='cpu'):
+        import torch
+        from sentence_transformers import CrossEncoder
+
+        if threads is not None: torch.set_num_threads(threads)
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model = CrossEncoder(model_name, device=device)
+
+    def rerank(self, query, documents):
+        """
+        :return: The indexes of the documents, most relevant first.
+        """
+        if len(documents) == 0: return []
+        scores = self.model.predict([(query, d.page_content) for d in documents], batch_size=self.batch_size, show_progress_bar=False)
+        return [int(i) for i in np.argsort(-np.asarray(scores), kind='stable')]
+
+
+class HybridSearch:
+    """
+    Retrieval of medical information from the serving index. In 'hybrid' mode, the `candidates` nearest documents in
+    the vector index and the `candidates` best BM25 matches are fused by reciprocal rank fusion, so that rare drug and
+    disease names missed by the embeddings are still found. The fused candidates are optionally reranked by a
+    cross-encoder. Results of the last `cache_size` distinct queries are memoized.
+    """
+
+    def __init__(self, embeddings, index, docstore, mode='hybrid', candidates=20, rrf_k=60, reranker=None, cache_size=1024):
+        if mode not in RETRIEVAL_MODES: raise ValueError("Unknown retrieval mode {}, expected one of {}".format(mode, RETRIEVAL_MODES))
+        if mode != 'dense' and not docstore.has_lexical_index:
+            logger.warning("The docstore has no lexical index (run src/create_index.py to build it), falling back to dense retrieval")
+            mode = 'dense'
+        self.embeddings = embeddings
+        self.index = index
+        self.docstore = docstore
+        self.mode = mode
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.reranker = reranker
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def dense(self, query, n):
+        vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+        with tracing.span('vector_search'):
+            _, positions = self.index.search(vector, n)
+        return [int(pos) for pos in positions[0] if pos >= 0]
+
+    def lexical(self, query, n):
+        fts_query = lexical_query(query)
+        if fts_query == '': return []
+        with tracing.span('lexical_search'):
+            return self.docstore.search_lexical(fts_query, n)
+
+    def rank(self, query, n):
+        # Positions of the n best candidates of the configured mode, best first
+        if self.mode == 'dense': return self.dense(query, n)
+        if self.mode == 'lexical': return self.lexical(query, n)
+        return reciprocal_rank_fusion([self.dense(query, n), self.lexical(query, n)], k=self.rrf_k)[:n]
+
+    def documents(self, positions):
+        with tracing.span('docstore'):
+            return [self.docstore.search(pos) for pos in positions]
+
+    def rerank(self, query, documents, k):
+        with tracing.span('rerank'):
+            return [documents[i] for i in self.reranker.rerank(query, documents)[:k]]
+
+    def search(self, query, k):
+        """
+        Retrieve the k most relevant documents for a query.
+
+        :return: A list of langchain Documents, most relevant first.
+        """
+        key = (' '.join(query.lower().split()), k)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return list(self._cache[key])
+
+        # Without a reranker, only the top k of the fused ranking are read from the docstore
+        if self.reranker is None:
+            documents = self.documents(self.rank(query, max(k, self.candidates))[:k])
+        else:
+            documents = self.rerank(query, self.documents(self.rank(query, max(k, self.candidates))), k)
+
+        with self._lock:
+            self._cache[key] = documents
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size: self._cache.popitem(last=False)
+        return list(documents)
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Langchain retriever over a `HybridSearch`, e.g. for `create_retriever_tool`.
+    """
+    searcher: Any
+    k: int = 2
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return self.searcher.search(query, self.k)
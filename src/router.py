@@ -0,0 +1,200 @@
+import re
+import logging
+import numpy as np
+
+from . import db, metrics
+from .sessions import current_user
+from config import *
+
+
+logger = logging.getLogger(__name__)
+
+
+# Labelled examples of the requests that map to a single tool call (guidelines 1-3 and 6 of the prompt), and of the
+# requests that need the agent: health questions, emergencies, small talk and follow-ups.
+INTENT_EXAMPLES = {
+    'find_doctor': [
+        "I need a cardiologist",
+        "Can you suggest a neurologist?",
+        "Which doctors are specialized in dermatology?",
+        "I am looking for a gastroenterologist",
+        "Find me an endocrinology specialist",
+        "Is there a pneumologist available?",
+        "I would like to see a dermatologist",
+        "Recommend a good cardiology doctor",
+        "List the doctors in neurology",
+    ],
+    'available_slots': [
+        "What are the available time slots with Dr. Lyubor?",
+        "When is Dr. Muller available?",
+        "Show me free appointments with Dr. Amicis",
+        "I would like to book an appointment with Dr. Dubois",
+        "Are there open slots for Dr. Brazov?",
+        "Which time slots can I reserve with Dr. Mirabella?",
+        "When can I see Dr. Lyubor?",
+        "Availability of Dr. Muller",
+    ],
+    'my_appointments': [
+        "What are my scheduled appointments?",
+        "Show me my appointments",
+        "When is my next appointment?",
+        "Do I have any appointment booked?",
+        "List my reservations",
+        "Which appointments do I have with Dr. Lyubor?",
+        "Did I book an appointment with Dr. Muller?",
+        "I would like to see my scheduled doctor appointments",
+    ],
+    'chat_history': [
+        "I want to download my chat history",
+        "Can I get a copy of this conversation?",
+        "Download chat history",
+        "Export our chat",
+        "Send me the history of my messages",
+        "How can I save this conversation?",
+    ],
+    'agent': [
+        "What are the symptoms of diabetes?",
+        "How is asthma treated?",
+        "What causes migraines?",
+        "Is high blood pressure dangerous?",
+        "I have a severe chest pain and cannot breathe",
+        "My child has a high fever since yesterday",
+        "I feel dizzy and my left arm is numb",
+        "Hello, how are you?",
+        "Thank you!",
+        "Yes, please",
+        "What does a cardiologist do?",
+        "Which doctor should I see for my back pain?",
+        "Can you explain what an endocrinologist treats?",
+        "What should I do if I cannot sleep?",
+    ],
+}
+
+# Dates, weekdays, months and relative time expressions: availability requests scoped to a time window are left to the
+# agent, which passes the window to the tool
+DATE_PATTERN = re.compile(r"\b(today|tonight|tomorrow|weekend|week|month|year|morning|afternoon|evening|"
+                          r"monday|tuesday|wednesday|thursday|friday|saturday|sunday|january|february|march|april|june|"
+                          r"july|august|september|october|november|december|in may|may \d+|\d+(st|nd|rd|th))\b|\d+[/.-]\d+", re.IGNORECASE)
+
+# Symptoms and emergencies: requests describing them are always left to the agent, which registers emergencies (e.g. "I
+# need a cardiologist, I have chest pain" must not be answered with a list of doctors)
+EMERGENCY_PATTERN = re.compile(r"\b(emergency|emergencies|urgent|urgently|help|ambulance|pain|painful|ache|aches|hurts?|hurting|"
+                               r"bleed|bleeding|blood|fever|breath|breathe|breathing|chest|dizzy|dizziness|faint|fainted|"
+                               r"numb|numbness|vomit|vomiting|seizure|unconscious|collapsed|injury|injured|burn|burned|"
+                               r"swollen|swelling|cough|coughing|sick|symptoms?|i feel|i am feeling|i felt)\b", re.IGNORECASE)
+
+FIND_DOCTOR_TEMPLATE = "Here are the doctors specialized in {specialization}:\n{doctors}\nWould you like to know the available time slots for appointments with one of them?"
+NO_DOCTORS_TEMPLATE = "There are no doctors specialized in {specialization} available at the moment."
+AVAILABLE_SLOTS_TEMPLATE = "Here are the first available time slots for appointments with {doctor}:\n{slots}"
+NO_SLOTS_TEMPLATE = "There are no time slots currently available for appointments with {doctor}."
+MY_APPOINTMENTS_TEMPLATE = "Here are your scheduled appointments:\n{slots}"
+NO_APPOINTMENTS_TEMPLATE = "There are no time slots currently scheduled for your appointments."
+CHAT_HISTORY_TEMPLATE = 'You can download your chat history here: <a href="history" target="_blank"> Download Chat History </a>'
+SLOT_TEMPLATE = "- {time_slot} with {doctor}: {reservation_link}"
+
+
+class IntentRouter:
+    """
+    Answers requests that map to a single tool call without the agent. Requests are classified by their nearest
+    labelled example of each intent, slots (doctor and specialization) are extracted against the vocabulary of the
+    database, the tool is called directly and its result is rendered with a template. Requests classified with a
+    similarity below `threshold`, within `margin` of another intent, with missing slots, describing symptoms or
+    emergencies, or availability requests scoped to dates are left to the agent.
+    """
+
+    def __init__(self, embeddings, tools, threshold=0.6, margin=0.05, examples=INTENT_EXAMPLES):
+        self.embeddings = embeddings
+        self.tools = tools
+        self.threshold = threshold
+        self.margin = margin
+
+        # Example vectors, and the rows of the examples of each intent
+        texts = [t for intent_examples in examples.values() for t in intent_examples]
+        self.vectors = self._embed(texts)
+        intents = np.array([intent for intent, intent_examples in examples.items() for _ in intent_examples])
+        self.groups = {intent: np.flatnonzero(intents == intent) for intent in examples}
+        self.load_vocabulary()
+
+    def _embed(self, texts):
+        vectors = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def _embed_query(self, text):
+        # Requests are embedded as queries, so that their vectors are only cached in memory, not on disk
+        vector = np.asarray(self.embeddings.embed_query(text), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def load_vocabulary(self):
+        # Doctor name keys and specialization stems, e.g. 'lyubor' -> 'Dr. Lyubor', 'neurolog' -> 'Neurology'
+        rows = db.list_doctors()
+        self.doctors = {name_key: name for name, name_key, _, _ in rows}
+        self.specializations = {db.specialization_prefix(spec): spec for _, _, spec, _ in rows if spec}
+
+    def classify(self, msg):
+        """
+        Classify a request.
+
+        :return: An (intent, similarity) pair, where intent is 'agent' if the request should be answered by the agent.
+        """
+        if EMERGENCY_PATTERN.search(msg) is not None: return 'agent', 1.
+        similarities = self.vectors @ self._embed_query(msg)
+        ranked = sorted(((float(similarities[rows].max()), intent) for intent, rows in self.groups.items()), reverse=True)
+        (best, intent), (second, _) = ranked[0], ranked[1]
+        if best < self.threshold or best - second < self.margin: return 'agent', best
+        return intent, best
+
+    def extract_doctor(self, msg):
+        words = ' '.join(re.findall(r'[a-z0-9]+', msg.lower()))
+        for name_key, name in self.doctors.items():
+            if re.search(r'\b{}\b'.format(re.escape(name_key)), words): return name
+        return None
+
+    def extract_specialization(self, msg):
+        words = re.findall(r'[a-z]+', msg.lower())
+        for stem, specialization in self.specializations.items():
+            if len(stem) >= 4 and any(w.startswith(stem) for w in words): return specialization
+        return None
+
+    def dispatch(self, msg):
+        """
+        Classify a request and answer it directly, if it maps to a single tool call.
+
+        :return: An (intent, response) pair, where intent is 'agent' and response is None if the request should be
+                 answered by the agent.
+        """
+        intent, similarity = self.classify(msg)
+        response = getattr(self, '_' + intent)(msg) if intent != 'agent' else None
+        if response is None: intent = 'agent'
+        else: logger.debug("Routed to {} (similarity {:.2f})".format(intent, similarity))
+        metrics.ROUTER_REQUESTS.labels(intent).inc()
+        return intent, response
+
+    def route(self, msg):
+        """
+        Answer a request directly, if it maps to a single tool call.
+
+        :return: The response, or None if the request should be answered by the agent.
+        """
+        return self.dispatch(msg)[1]
+
+    def _find_doctor(self, msg):
+        specialization = self.extract_specialization(msg)
+        if specialization is None: return None
+        doctors = self.tools['search_doctor_by_specialization'](specialization)[:3]
+        if len(doctors) == 0: return NO_DOCTORS_TEMPLATE.format(specialization=specialization)
+        return FIND_DOCTOR_TEMPLATE.format(specialization=specialization, doctors='\n'.join('- ' + d for d in doctors))
+
+    def _available_slots(self, msg):
+        doctor = self.extract_doctor(msg)
+        if doctor is None or DATE_PATTERN.search(msg) is not None: return None
+        slots = self.tools['search_available_doctor_appointments'](doctor)
+        if len(slots) == 0: return NO_SLOTS_TEMPLATE.format(doctor=doctor)
+        return AVAILABLE_SLOTS_TEMPLATE.format(doctor=doctor, slots='\n'.join(SLOT_TEMPLATE.format(**s) for s in slots))
+
+    def _my_appointments(self, msg):
+        slots = self.tools['search_patient_appointments'](current_user.get(), self.extract_doctor(msg))
+        if len(slots) == 0: return NO_APPOINTMENTS_TEMPLATE
+        return MY_APPOINTMENTS_TEMPLATE.format(slots='\n'.join(SLOT_TEMPLATE.format(**s) for s in slots))
+
+    def _chat_history(self, msg):
+        return CHAT_HISTORY_TEMPLATE
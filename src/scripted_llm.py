@@ -0,0 +1,153 @@
+import re
+import json
+import time
+import threading
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from .context import count_tokens
+
+
+# Requests recognized by the script, checked in this order. Emergencies are matched first, with their color-code.
+EMERGENCY_PATTERNS = [
+    (re.compile(r"chest pain|can'?t breathe|cannot breathe|unconscious|heavy bleeding|stroke|heart attack", re.I), 'RED'),
+    (re.compile(r"high fever|vomit|broken|fracture|burn|faint", re.I), 'YELLOW'),
+    (re.compile(r"emergency|urgent", re.I), 'GREEN'),
+]
+HISTORY_PATTERN = re.compile(r"\b(chat history|download)\b", re.I)
+SMALL_TALK_PATTERN = re.compile(r"^\W*(hi|hello|good (morning|afternoon|evening)|thanks?( you)?|no,? thanks|ok(ay)?|bye)\W*$", re.I)
+MY_APPOINTMENTS_PATTERN = re.compile(r"\bmy (appointments?|visits?|reservations?)\b", re.I)
+DOCTOR_PATTERN = re.compile(r"\bDr\.? ([A-Z][\w-]*)")
+SPECIALIST_PATTERN = re.compile(r"\b([a-z]+)olog(?:ist|y)\b", re.I)
+AVAILABILITY_PATTERN = re.compile(r"\b(available|availability|slots?|free|book)\b", re.I)
+USER_PATTERN = re.compile(r"interacting with the user (\S+?)\.")
+
+HISTORY_ANSWER = "You can download your chat history here: <a href=\"history\" target=\"_blank\"> Download Chat History </a>"
+SMALL_TALK_ANSWER = "Hello! How can I help you with your health questions or your appointments today?"
+EMERGENCY_ANSWER = ("Please stay calm: the medical staff has been notified and will assist you as soon as possible. Meanwhile, rest, "
+                    "avoid any physical effort, and keep your phone at hand. This condition can be handled by medical intervention, "
+                    "so please consult a healthcare professional.")
+
+
+# Generation slots of the stand-in, shared by its instances in the process, like the parallel requests of an Ollama
+# server (OLLAMA_NUM_PARALLEL)
+_slots = {}
+_slots_lock = threading.Lock()
+
+def generation_slots(parallel):
+    with _slots_lock:
+        if parallel not in _slots: _slots[parallel] = threading.BoundedSemaphore(parallel)
+        return _slots[parallel]
+
+def _turn(messages):
+    # Last user message, and the messages that followed it (tool calls and results of the current turn)
+    for i in range(len(messages) - 1, -1, -1):
+        if isinstance(messages[i], HumanMessage): return messages[i].content, messages[i + 1:]
+    return '', []
+
+def _tool_call(name, args, position):
+    # Call ids are unique within a conversation, given by the position of the call
+    return AIMessage(content='', tool_calls=[{'name': name, 'args': args, 'id': 'call_{}'.format(position)}])
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Deterministic stand-in for the Ollama chat model, to run the app and benchmark it without Ollama or a GPU. Requests
+    are mapped by keywords to the tool call the prompt asks for (emergencies, doctors by specialization, time slots of
+    a doctor, the user's appointments, medical information), and answered from the tool results. Generation takes
+    `prompt_latency` seconds per prompt token before the first token, then `token_latency` seconds per generated token,
+    and at most `parallel` generations run at the same time.
+    """
+    token_latency: float = 0.02
+    prompt_latency: float = 0.0005
+    parallel: int = 1
+    max_tokens: int = 512
+    answer_tokens: int = 80
+
+    @property
+    def _llm_type(self):
+        return 'scripted'
+
+    def bind_tools(self, tools, **kwargs):
+        # Tools are called by name, following the script
+        return self
+
+    def _plan(self, text, user_name, position):
+        # Tool call answering a new request, or None if it is answered without tools
+        for pattern, code in EMERGENCY_PATTERNS:
+            if pattern.search(text): return _tool_call('register_emergency', {'patient': user_name, 'question': text, 'code': code}, position)
+        if HISTORY_PATTERN.search(text) or SMALL_TALK_PATTERN.match(text): return None
+        if MY_APPOINTMENTS_PATTERN.search(text): return _tool_call('search_patient_appointments', {'patient': user_name}, position)
+        doctor = DOCTOR_PATTERN.search(text)
+        if doctor is not None: return _tool_call('search_available_doctor_appointments', {'doctor': 'Dr. ' + doctor.group(1)}, position)
+        specialist = SPECIALIST_PATTERN.search(text)
+        if specialist is not None: return _tool_call('search_doctor_by_specialization', {'specialization': specialist.group(1).capitalize() + 'ology'}, position)
+        return _tool_call('search_medical_information', {'query': text}, position)
+
+    def _answer(self, result):
+        # Final answer, quoting the start of the last tool result
+        if result.name == 'register_emergency': return EMERGENCY_ANSWER
+        prefix = "Here is some information that may help:" if result.name == 'search_medical_information' else "Here is what I found:"
+        return ' '.join([prefix] + str(result.content).split()[:self.answer_tokens])
+
+    def decide(self, messages):
+        """
+        :return: The next message of the agent: a tool call, or the answer to the user.
+        """
+        text, turn = _turn(messages)
+        system = next((m.content for m in messages if isinstance(m, SystemMessage)), '')
+        user = USER_PATTERN.search(system)
+        results = [m for m in turn if isinstance(m, ToolMessage)]
+        if len(results) == 0:
+            call = self._plan(text, user.group(1) if user is not None else 'user', len(messages))
+            if call is not None: return call
+            return AIMessage(content=HISTORY_ANSWER if HISTORY_PATTERN.search(text) else SMALL_TALK_ANSWER)
+
+        # Doctors of a specialization, then the time slots of the first one, if the user asked for them
+        last = results[-1]
+        if last.name == 'search_doctor_by_specialization' and AVAILABILITY_PATTERN.search(text):
+            doctors = DOCTOR_PATTERN.findall(str(last.content))
+            if len(doctors) > 0: return _tool_call('search_available_doctor_appointments', {'doctor': 'Dr. ' + doctors[0]}, len(messages))
+        return AIMessage(content=self._answer(last))
+
+    def _tokens(self, message):
+        # Generated tokens: the words of an answer (capped at max_tokens), or the arguments of each tool call
+        if message.tool_calls: return [json.dumps(call['args']) for call in message.tool_calls]
+        return re.findall(r'\S+\s*', message.content)[:self.max_tokens]
+
+    def _usage(self, messages, message, tokens):
+        input_tokens = sum(count_tokens(str(m.content)) for m in messages)
+        output_tokens = sum(count_tokens(t) for t in tokens) if message.tool_calls else len(tokens)
+        return {'input_tokens': input_tokens, 'output_tokens': output_tokens, 'total_tokens': input_tokens + output_tokens}
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self.decide(messages)
+        tokens = self._tokens(message)
+        usage = self._usage(messages, message, tokens)
+        with generation_slots(self.parallel):
+            time.sleep(self.prompt_latency * usage['input_tokens'] + self.token_latency * usage['output_tokens'])
+        if not message.tool_calls: message = AIMessage(content=''.join(tokens))
+        message.usage_metadata = usage
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self.decide(messages)
+        tokens = self._tokens(message)
+        usage = self._usage(messages, message, tokens)
+        with generation_slots(self.parallel):
+            # Prompt processing, before the first token
+            time.sleep(self.prompt_latency * usage['input_tokens'])
+
+            # Tool calls are returned at once, once their arguments are generated
+            if message.tool_calls:
+                time.sleep(self.token_latency * usage['output_tokens'])
+                chunks = [{'name': call['name'], 'args': args, 'id': call['id'], 'index': i} for i, (call, args) in enumerate(zip(message.tool_calls, tokens))]
+                yield ChatGenerationChunk(message=AIMessageChunk(content='', tool_call_chunks=chunks, usage_metadata=usage))
+                return
+
+            for i, token in enumerate(tokens):
+                time.sleep(self.token_latency)
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=token, usage_metadata=usage if i == len(tokens) - 1 else None))
+                if run_manager is not None: run_manager.on_llm_new_token(token, chunk=chunk)
+                yield chunk
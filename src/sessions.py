@@ -0,0 +1,388 @@
+import os
+import time
+import uuid
+import json
+import zlib
+import asyncio
+import threading
+import contextvars
+import collections
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk, ToolMessage, messages_to_dict, messages_from_dict
+
+from . import tracing
+from .db import ConnectionPool
+from .context import ContextWindow
+from .workers import FileLock
+from config import *
+
+
+# User of the request being served. Tools and prompts read it instead of a global user name, so that concurrent
+# sessions of different users do not interfere.
+current_user = contextvars.ContextVar('current_user', default=USER_NAME)
+
+
+class Session:
+    def __init__(self, session_id, user_name):
+        self.id = session_id
+        self.user_name = user_name
+        self.messages = []
+        # Turns folded out of `messages` (see `ContextWindow`)
+        self.summary = ''
+        self.last_access = time.monotonic()
+        # Serializes the turns of a session, e.g. if the user sends a new message before the previous answer arrives
+        self.lock = threading.Lock()
+        self.async_lock = asyncio.Lock()
+
+
+class SessionStore:
+    """
+    Thread-safe, bounded store of conversation sessions. Sessions expire after `ttl` seconds of inactivity, and the
+    least recently used sessions are evicted when more than `max_sessions` are active.
+    """
+
+    def __init__(self, max_sessions=1000, ttl=3600.):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    def _evict(self, now):
+        while len(self._sessions) > 0:
+            oldest = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_sessions and now - oldest.last_access <= self.ttl: break
+            self._sessions.popitem(last=False)
+
+    def get(self, session_id, user_name=USER_NAME):
+        """
+        Return the session with the given id, creating it if it does not exist or has expired.
+        """
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or now - session.last_access > self.ttl:
+                session = Session(session_id, user_name)
+                self._sessions[session_id] = session
+            session.last_access = now
+            self._sessions.move_to_end(session_id)
+            self._evict(now)
+            return session
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+CREATE_SESSIONS = """
+            CREATE TABLE IF NOT EXISTS sessions(
+                id TEXT PRIMARY KEY,
+                user_name TEXT NOT NULL,
+                messages TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """
+
+CREATE_SESSIONS_INDEX = """
+            CREATE INDEX IF NOT EXISTS idx_sessions_access ON sessions(last_access)
+        """
+
+# Touch a session, starting it again if it does not exist or has expired (expressions read the previous row)
+TOUCH_SESSION = """
+            INSERT INTO sessions(id, user_name, messages, summary, last_access) VALUES (:id, :user_name, '[]', '', :now)
+            ON CONFLICT(id) DO UPDATE SET
+                user_name = CASE WHEN last_access < :expired THEN :user_name ELSE user_name END,
+                messages = CASE WHEN last_access < :expired THEN '[]' ELSE messages END,
+                summary = CASE WHEN last_access < :expired THEN '' ELSE summary END,
+                last_access = :now
+            RETURNING user_name
+        """
+
+SELECT_SESSION = """
+            SELECT messages, summary
+            FROM sessions
+            WHERE id = ?
+        """
+
+UPDATE_SESSION = """
+            UPDATE sessions SET messages = ?, summary = ?
+            WHERE id = ?
+        """
+
+DELETE_EXPIRED_SESSIONS = """
+            DELETE FROM sessions
+            WHERE last_access < ?
+        """
+
+# Least recently used sessions beyond the maximum number of sessions
+DELETE_OLDEST_SESSIONS = """
+            DELETE FROM sessions
+            WHERE id IN (SELECT id FROM sessions ORDER BY last_access DESC LIMIT -1 OFFSET ?)
+        """
+
+COUNT_SESSIONS = """
+            SELECT count(*)
+            FROM sessions
+            WHERE last_access >= ?
+        """
+
+
+class SharedSessionLock:
+    """
+    Lock of a session of a `SharedSessionStore`, held across the worker processes. Holding it also loads the state of
+    the session from the store, and releasing it saves the state, so that each turn continues the conversation from
+    the last turn, whichever worker served it.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._lock = FileLock(session.store.lock_path(session.id))
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            self.session.store.load(self.session)
+        except BaseException:
+            self._lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            self.session.store.save(self.session)
+        finally:
+            self._lock.release()
+
+    async def __aenter__(self):
+        return await asyncio.to_thread(self.__enter__)
+
+    async def __aexit__(self, *exc):
+        await asyncio.to_thread(self.__exit__, *exc)
+
+
+class SharedSession(Session):
+    def __init__(self, session_id, user_name, store):
+        super().__init__(session_id, user_name)
+        self.store = store
+        # Used by both the sync and async turns
+        self.lock = self.async_lock = SharedSessionLock(self)
+
+
+class SharedSessionStore:
+    """
+    Store of conversation sessions shared by the worker processes of the server, in SQLite, with the expiry and
+    eviction of `SessionStore`. Each call to `get` returns a new session object, whose state is read from the store
+    while a turn holds its lock (see `SharedSessionLock`). Locks are files, `lock_stripes` of them shared by all sessions.
+    """
+
+    def __init__(self, path, lock_folder, max_sessions=1000, ttl=3600., lock_stripes=256):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.lock_folder = lock_folder
+        self.lock_stripes = lock_stripes
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(lock_folder, exist_ok=True)
+        self.pool = ConnectionPool(path, size=DB_POOL_SIZE, timeout=DB_TIMEOUT, cached_statements=DB_CACHED_STATEMENTS)
+        with self.pool.connection() as conn:
+            conn.execute(CREATE_SESSIONS)
+            conn.execute(CREATE_SESSIONS_INDEX)
+
+    new_id = staticmethod(SessionStore.new_id)
+
+    def lock_path(self, session_id):
+        return os.path.join(self.lock_folder, '{}.lock'.format(zlib.crc32(session_id.encode('utf-8')) % self.lock_stripes))
+
+    def get(self, session_id, user_name=USER_NAME):
+        """
+        Return the session with the given id, creating it if it does not exist or has expired.
+        """
+        now = time.time()
+        with self.pool.connection() as conn:
+            user_name = conn.execute(TOUCH_SESSION, {'id': session_id, 'user_name': user_name, 'now': now, 'expired': now - self.ttl}).fetchone()[0]
+            conn.execute(DELETE_EXPIRED_SESSIONS, (now - self.ttl,))
+            conn.execute(DELETE_OLDEST_SESSIONS, (self.max_sessions,))
+        return SharedSession(session_id, user_name, self)
+
+    def load(self, session):
+        with self.pool.connection() as conn:
+            row = conn.execute(SELECT_SESSION, (session.id,)).fetchone()
+        # A session evicted in the meantime starts again
+        session.messages, session.summary = (messages_from_dict(json.loads(row[0])), row[1]) if row is not None else ([], '')
+
+    def save(self, session):
+        with self.pool.connection() as conn:
+            conn.execute(UPDATE_SESSION, (json.dumps(messages_to_dict(session.messages)), session.summary, session.id))
+
+    def __len__(self):
+        with self.pool.connection() as conn:
+            return conn.execute(COUNT_SESSIONS, (time.time() - self.ttl,)).fetchone()[0]
+
+    def close(self):
+        self.pool.close()
+
+
+# Conversation history kept within the token budget of the LLM
+default_window = ContextWindow()
+
+
+def _start_turn(session, msg, window):
+    session.messages, session.summary = window.fit(session.messages + [HumanMessage(content=msg)], session.summary)
+    return window.prompt(session.messages, session.summary)
+
+def _end_turn(session, messages, window):
+    # Update conversation history with the agent's response, without the summary message
+    session.messages, session.summary = window.fit(messages, session.summary)
+    return messages[-1].content
+
+def _turn_events(mode, payload, messages):
+    # Convert an item of the agent's stream into progress events, collecting the new messages
+    if mode == "messages":
+        chunk, metadata = payload
+        if metadata.get('langgraph_node') == 'agent' and isinstance(chunk, AIMessageChunk) and chunk.content:
+            yield "token", chunk.content
+        return
+    for update in payload.values():
+        new_messages = update.get('messages', []) if isinstance(update, dict) else []
+        messages += new_messages
+        for m in new_messages:
+            if isinstance(m, AIMessage):
+                for call in m.tool_calls: yield "tool_start", call['name']
+            elif isinstance(m, ToolMessage):
+                yield "tool_end", m.name
+
+
+def _has_context(session):
+    # Whether a new message follows earlier turns of the conversation
+    return len(session.messages) > 0 or session.summary != ''
+
+def _direct_answer(msg, router, cache, user_name, context):
+    # Record which path answered the request in its trace
+    response = None
+    if router is not None:
+        with tracing.span('router'): response = router.route(msg)
+        if response is not None: tracing.annotate(path='router')
+    if response is None and cache is not None:
+        with tracing.span('answer_cache'): response = cache.lookup(msg, user_name, context)
+        if response is not None: tracing.annotate(path='answer_cache')
+    return response
+
+def direct_turn(session, msg, window=default_window, router=None, cache=None):
+    """
+    Answer a user message within a session without invoking the agent: requests that map to a single tool call are
+    answered by the intent router, and questions similar to already answered ones by the answer cache.
+
+    :return: The response text, or None if the request needs the agent.
+    """
+    with session.lock:
+        token = current_user.set(session.user_name)
+        try:
+            response = _direct_answer(msg, router, cache, session.user_name, _has_context(session))
+            if response is None: return None
+            return _end_turn(session, session.messages + [HumanMessage(content=msg), AIMessage(content=response)], window)
+        finally:
+            current_user.reset(token)
+
+def run_turn(session, msg, agent, window=default_window, cache=None):
+    """
+    Answer a user message within a session, keeping the conversation history within the token budget of `window`
+    (see `ContextWindow`).
+    If an answer cache is given, the answer is stored in it when the turn is cacheable.
+
+    :return: The agent's response text.
+    """
+    with session.lock:
+        token = current_user.set(session.user_name)
+        try:
+            context = _has_context(session)
+            messages = _start_turn(session, msg, window)
+
+            # Invoke chat agent to answer query, tracing its steps into the request's trace
+            tracing.annotate(path='agent')
+            start = time.perf_counter()
+            result = agent.invoke({"messages": messages}, config=tracing.callbacks())
+            if cache is not None: cache.store_turn(msg, result['messages'][len(messages):], session.user_name, time.perf_counter() - start, context)
+            return _end_turn(session, result['messages'], window)
+        finally:
+            current_user.reset(token)
+
+def stream_turn(session, msg, agent, window=default_window, cache=None):
+    """
+    Answer a user message within a session, like `run_turn`, but stream the agent's progress as it is produced.
+
+    :return: A generator of (event, data) pairs: ("token", text) for each token generated by the LLM, ("tool_start", name)
+             when the agent calls a tool, ("tool_end", name) when the tool returns, and finally ("done", response).
+    """
+    with session.lock:
+        token = current_user.set(session.user_name)
+        try:
+            context = _has_context(session)
+            messages = _start_turn(session, msg, window)
+            n, start = len(messages), time.perf_counter()
+            tracing.annotate(path='agent')
+
+            # Stream LLM tokens, and node updates to follow tool calls and collect the new messages
+            for mode, payload in agent.stream({"messages": list(messages)}, config=tracing.callbacks(), stream_mode=["messages", "updates"]):
+                yield from _turn_events(mode, payload, messages)
+
+            if cache is not None: cache.store_turn(msg, messages[n:], session.user_name, time.perf_counter() - start, context)
+            yield "done", _end_turn(session, messages, window)
+        finally:
+            current_user.reset(token)
+
+async def adirect_turn(session, msg, window=default_window, router=None, cache=None):
+    """
+    Asynchronous version of `direct_turn`, for the ASGI app.
+    """
+    async with session.async_lock:
+        token = current_user.set(session.user_name)
+        try:
+            # Embeddings and tool calls are blocking (the thread inherits the current user)
+            response = await asyncio.to_thread(_direct_answer, msg, router, cache, session.user_name, _has_context(session))
+            if response is None: return None
+            return _end_turn(session, session.messages + [HumanMessage(content=msg), AIMessage(content=response)], window)
+        finally:
+            current_user.reset(token)
+
+async def arun_turn(session, msg, agent, window=default_window, cache=None):
+    """
+    Asynchronous version of `run_turn`, for the ASGI app.
+    """
+    async with session.async_lock:
+        token = current_user.set(session.user_name)
+        try:
+            context = _has_context(session)
+            messages = _start_turn(session, msg, window)
+
+            # Invoke chat agent to answer query, without blocking the event loop
+            tracing.annotate(path='agent')
+            start = time.perf_counter()
+            result = await agent.ainvoke({"messages": messages}, config=tracing.callbacks())
+            if cache is not None: await asyncio.to_thread(cache.store_turn, msg, result['messages'][len(messages):], session.user_name, time.perf_counter() - start, context)
+            return _end_turn(session, result['messages'], window)
+        finally:
+            current_user.reset(token)
+
+async def astream_turn(session, msg, agent, window=default_window, cache=None):
+    """
+    Asynchronous version of `stream_turn`, for the ASGI app.
+    """
+    async with session.async_lock:
+        token = current_user.set(session.user_name)
+        try:
+            context = _has_context(session)
+            messages = _start_turn(session, msg, window)
+            n, start = len(messages), time.perf_counter()
+            tracing.annotate(path='agent')
+
+            # Stream LLM tokens, and node updates to follow tool calls and collect the new messages
+            async for mode, payload in agent.astream({"messages": list(messages)}, config=tracing.callbacks(), stream_mode=["messages", "updates"]):
+                for event in _turn_events(mode, payload, messages):
+                    yield event
+
+            if cache is not None: await asyncio.to_thread(cache.store_turn, msg, messages[n:], session.user_name, time.perf_counter() - start, context)
+            yield "done", _end_turn(session, messages, window)
+        finally:
+            current_user.reset(token)
@@ -0,0 +1,81 @@
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class Startup:
+    """
+    Runs the startup phases of the app in background threads, so that the server can accept requests (e.g. health
+    checks) while components are loading. Phases are given as name -> (function, dependency names), in an order where
+    dependencies come first: each function is called with the results of its dependencies, and independent phases
+    run concurrently. The duration of each phase is reported.
+    """
+
+    def __init__(self, phases):
+        self.phases = phases
+        self.results = {}
+        self.timings = {}
+        self.error = None
+        self.elapsed = None
+        self._futures = {}
+        self._done = threading.Event()
+
+    def start(self):
+        self._start = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=len(self.phases), thread_name_prefix='startup')
+        for name, (function, dependencies) in self.phases.items():
+            self._futures[name] = executor.submit(self._run, name, function, [self._futures[d] for d in dependencies])
+        executor.shutdown(wait=False)
+        threading.Thread(target=self._wait, name='startup', daemon=True).start()
+        return self
+
+    def _run(self, name, function, dependencies):
+        args = [d.result() for d in dependencies]
+        start = time.perf_counter()
+        result = function(*args)
+        self.timings[name] = time.perf_counter() - start
+        metrics.STARTUP_PHASE_SECONDS.labels(name).set(self.timings[name])
+        logger.info("Startup phase '{}' done in {:.2f}s".format(name, self.timings[name]))
+        return result
+
+    def _wait(self):
+        try:
+            for name, future in self._futures.items():
+                self.results[name] = future.result()
+        except Exception as e:
+            self.error = e
+            logger.error("Startup failed: {!r}".format(e))
+        self.elapsed = time.perf_counter() - self._start
+        if self.error is None: logger.info("Startup done in {:.2f}s".format(self.elapsed))
+        self._done.set()
+
+    @property
+    def ready(self):
+        return self._done.is_set() and self.error is None
+
+    def wait(self, timeout=None):
+        """
+        Wait for all phases to complete.
+
+        :return: True if the startup succeeded, False if it failed or is still running after `timeout` seconds.
+        """
+        return self._done.wait(timeout) and self.error is None
+
+    def status(self):
+        # State and duration of each phase, for readiness checks
+        phases = {}
+        for name, future in self._futures.items():
+            if not future.done(): state = 'running'
+            elif future.exception() is not None: state = 'failed'
+            else: state = 'done'
+            phases[name] = {'state': state, 'seconds': self.timings.get(name)}
+        return {'ready': self.ready, 'error': repr(self.error) if self.error is not None else None, 'seconds': self.elapsed, 'phases': phases}
+
+    def __getitem__(self, name):
+        return self.results[name]
@@ -0,0 +1,271 @@
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+import contextlib
+import contextvars
+import collections
+from langchain_core.callbacks import BaseCallbackHandler
+
+from . import metrics
+from config import *
+
+
+logger = logging.getLogger(__name__)
+
+# Trace of the request being served. Spans recorded in threads started from the request (e.g. tools run by langchain,
+# or blocking work run with asyncio.to_thread) inherit it.
+current_trace = contextvars.ContextVar('current_trace', default=None)
+recent_traces = collections.deque(maxlen=TRACE_BUFFER)
+
+
+def configure_logging(level=LOG_LEVEL):
+    logging.basicConfig(level=level, format=LOG_FORMAT)
+
+
+class Trace:
+    """
+    Spans of a request: agent steps, LLM generations, tool calls and internal stages, with offsets and durations in
+    milliseconds from the start of the request, the token counts of the LLM and the time to its first token.
+    """
+
+    def __init__(self, name, **attributes):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attributes = dict(attributes)
+        self.timestamp = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.first_token = None
+        self.generations = 0
+        self.tokens = {'input': 0, 'output': 0}
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add_span(self, name, kind, start, end, **attributes):
+        span = {'name': name, 'kind': kind, 'offset_ms': round((start - self.start) * 1000, 3), 'duration_ms': round((end - start) * 1000, 3)}
+        span.update(attributes)
+        with self._lock:
+            self.spans.append(span)
+
+    def add_generation(self, input_tokens, output_tokens):
+        with self._lock:
+            self.generations += 1
+            self.tokens['input'] += input_tokens
+            self.tokens['output'] += output_tokens
+
+    def mark_first_token(self):
+        """
+        :return: True if this is the first token of the request.
+        """
+        with self._lock:
+            if self.first_token is not None: return False
+            self.first_token = time.perf_counter() - self.start
+            return True
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+        path = self.attributes.get('path')
+        if path is not None: metrics.TURN_SECONDS.labels(path).observe(self.duration)
+        if path == 'agent': metrics.AGENT_STEPS.observe(self.generations)
+
+    def to_dict(self):
+        with self._lock:
+            return {'id': self.id, 'name': self.name, 'timestamp': self.timestamp, 'attributes': dict(self.attributes),
+                    'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+                    'first_token_ms': round(self.first_token * 1000, 3) if self.first_token is not None else None,
+                    'generations': self.generations, 'tokens': dict(self.tokens), 'spans': sorted(self.spans, key=lambda s: s['offset_ms'])}
+
+    def summary(self):
+        # One line per request, with the total time of each kind of span, e.g. "llm 2x 1500.0ms, tool search_... 1x 35.2ms"
+        totals = collections.OrderedDict()
+        with self._lock:
+            for span in self.spans:
+                key = span['name'] if span['kind'] in ('llm', 'stage') else '{} {}'.format(span['kind'], span['name'])
+                count, duration = totals.get(key, (0, 0.))
+                totals[key] = (count + 1, duration + span['duration_ms'])
+        return "Trace {} {} {:.1f}ms path={} ttft={} tokens={}/{}: {}".format(
+            self.id, self.name, self.duration * 1000, self.attributes.get('path'),
+            '{:.1f}ms'.format(self.first_token * 1000) if self.first_token is not None else '-',
+            self.tokens['input'], self.tokens['output'],
+            ', '.join('{} {}x {:.1f}ms'.format(key, count, duration) for key, (count, duration) in totals.items()))
+
+
+@contextlib.contextmanager
+def activate(t):
+    """
+    Record the spans of the `with` block in the given trace, e.g. to continue a request's trace in a streamed response.
+    """
+    token = current_trace.set(t)
+    try:
+        yield t
+    finally:
+        current_trace.reset(token)
+
+def finish(t):
+    # Observe the request's duration, keep the trace for /debug/traces and log it
+    t.finish()
+    recent_traces.append(t)
+    logger.info(t.summary())
+    if logger.isEnabledFor(logging.DEBUG): logger.debug(json.dumps(t.to_dict()))
+
+@contextlib.contextmanager
+def trace(name, **attributes):
+    """
+    Trace a request: spans recorded within the `with` block are added to the trace, which is logged and kept in
+    `recent_traces` when the block exits.
+    """
+    t = Trace(name, **attributes)
+    try:
+        with activate(t):
+            yield t
+    finally:
+        finish(t)
+
+def annotate(**attributes):
+    # Set attributes of the current trace, if any (e.g. the path that answered the request)
+    t = current_trace.get()
+    if t is not None: t.attributes.update(attributes)
+
+@contextlib.contextmanager
+def span(name, kind='stage', **attributes):
+    """
+    Time a stage of a request, recording it in the stage histogram and in the current trace, if any. Can also be used
+    as a decorator.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        if kind == 'stage': metrics.STAGE_SECONDS.labels(name).observe(end - start)
+        t = current_trace.get()
+        if t is not None: t.add_span(name, kind, start, end, **attributes)
+
+def callbacks():
+    """
+    :return: A langchain run config tracing the agent's steps into the current trace, if any.
+    """
+    t = current_trace.get()
+    return {'callbacks': [TraceCallbackHandler(t)]} if t is not None else {}
+
+
+class TraceCallbackHandler(BaseCallbackHandler):
+    """
+    Records the agent's steps (graph nodes), LLM generations and tool calls of a run as spans of a trace, with token
+    counts and time to first token.
+    """
+    # Called in the thread of the run, instead of an executor, since recording a span is cheap
+    run_inline = True
+
+    def __init__(self, trace):
+        self.trace = trace
+        self._runs = {}
+
+    def _start(self, run_id, name, kind):
+        self._runs[run_id] = {'name': name, 'kind': kind, 'start': time.perf_counter(), 'tokens': 0}
+
+    def _end(self, run_id, **attributes):
+        run = self._runs.pop(run_id, None)
+        if run is None: return None
+        end = time.perf_counter()
+        self.trace.add_span(run['name'], run['kind'], run['start'], end, **attributes)
+        return run, end - run['start']
+
+    def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        # Only the runs of the agent's nodes ('agent', 'tools'), not the runnables within them or the graph's own nodes
+        node = (metadata or {}).get('langgraph_node')
+        if node is not None and kwargs.get('name') == node and not node.startswith('__'): self._start(run_id, node, 'step')
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=repr(error))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, 'llm', 'llm')
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, 'llm', 'llm')
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self._runs.get(run_id)
+        if run is not None: run['tokens'] += 1
+        if self.trace.mark_first_token(): metrics.TIME_TO_FIRST_TOKEN_SECONDS.observe(self.trace.first_token)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        # Token counts reported by the model (Ollama reports them), or the number of streamed tokens
+        usage = [getattr(g, 'message', None) for generations in response.generations for g in generations]
+        usage = [m.usage_metadata for m in usage if getattr(m, 'usage_metadata', None)]
+        input_tokens = sum(u.get('input_tokens', 0) for u in usage)
+        run = self._runs.get(run_id)
+        output_tokens = sum(u.get('output_tokens', 0) for u in usage) if len(usage) > 0 else (run['tokens'] if run is not None else 0)
+
+        ended = self._end(run_id, input_tokens=input_tokens, output_tokens=output_tokens)
+        if ended is not None: metrics.LLM_GENERATION_SECONDS.observe(ended[1])
+        metrics.LLM_TOKENS.labels('input').inc(input_tokens)
+        metrics.LLM_TOKENS.labels('output').inc(output_tokens)
+        self.trace.add_generation(input_tokens, output_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=repr(error))
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._start(run_id, (serialized or {}).get('name') or kwargs.get('name') or 'tool', 'tool')
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        ended = self._end(run_id)
+        if ended is not None: metrics.TOOL_SECONDS.labels(ended[0]['name']).observe(ended[1])
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        ended = self._end(run_id, error=repr(error))
+        if ended is not None: metrics.TOOL_SECONDS.labels(ended[0]['name']).observe(ended[1])
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of the whole process: the stacks of all threads are sampled every `interval` seconds, and
+    reported in the collapsed format of flame graph tools (one line per distinct stack, with its number of samples),
+    e.g. for https://www.speedscope.app. It only runs on demand, so that it costs nothing otherwise.
+    """
+
+    def __init__(self, interval=0.005, max_seconds=60.):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stack(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+    def profile(self, seconds):
+        """
+        Sample the stacks of all threads (except the profiler's) for the given number of seconds.
+
+        :return: The collapsed stacks, as text, or None if another profile is running.
+        """
+        if not self._lock.acquire(blocking=False): return None
+        try:
+            counts = collections.Counter()
+            me = threading.get_ident()
+            deadline = time.perf_counter() + min(seconds, self.max_seconds)
+            while time.perf_counter() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident != me: counts['{};{}'.format(names.get(ident, ident), self._stack(frame))] += 1
+                time.sleep(self.interval)
+            return ''.join('{} {}\n'.format(stack, n) for stack, n in counts.most_common())
+        finally:
+            self._lock.release()
+
+
+profiler = SamplingProfiler(PROFILER_INTERVAL, PROFILER_MAX_SECONDS) if PROFILER else None
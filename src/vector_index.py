@@ -0,0 +1,331 @@
+import os
+import json
+import logging
+import sqlite3
+import collections.abc
+import numpy as np
+import faiss
+from langchain_core.documents import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+
+from .db import ConnectionPool
+from config import *
+
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_TYPES = ('flat', 'ivf_flat', 'hnsw', 'ivf_pq', 'fp16', 'sq8', 'ivf_sq8')
+# Docstore shared by the index types in previous versions: exporting one type rewrote the docstore of the others
+LEGACY_DOCSTORE_NAME = 'docstore.db'
+BUILD_DOCSTORE_NAME = 'build_docstore.db'
+
+# Documents of the serving docstore: position in the index, id in the build docstore, content and metadata
+INSERT_DOC = """
+            INSERT INTO docs VALUES(?, ?, ?, ?)
+        """
+
+# Inverted index of the documents for BM25 ranking (SQLite FTS5), stored in the docstore next to the documents it
+# indexes (external content, so that the text is not stored twice). Porter stemming matches e.g. 'infections' with
+# 'infection', and rowids are index positions, like the FAISS index.
+CREATE_LEXICAL_INDEX = """
+            CREATE VIRTUAL TABLE docs_fts USING fts5(content, content='docs', content_rowid='pos', tokenize='porter unicode61')
+        """
+
+BUILD_LEXICAL_INDEX = """
+            INSERT INTO docs_fts(docs_fts) VALUES ('rebuild')
+        """
+
+# Index the documents appended after the given position
+APPEND_LEXICAL_INDEX = """
+            INSERT INTO docs_fts(rowid, content) SELECT pos, content FROM docs WHERE pos >= ?
+        """
+
+# Best matches first: `rank` is the BM25 score of FTS5, lower is better
+SELECT_LEXICAL_MATCHES = """
+            SELECT rowid
+            FROM docs_fts
+            WHERE docs_fts MATCH ?
+            ORDER BY rank
+            LIMIT ?
+        """
+
+
+class SQLiteDocstore(Docstore):
+    """
+    Read-only docstore backed by SQLite, keyed by the position of the document in the FAISS index.
+    Documents are read lazily when a search returns them, instead of unpickling the whole docstore at startup.
+    """
+
+    def __init__(self, path, pool_size=4):
+        self.path = path
+        self.pool = ConnectionPool(path, size=pool_size)
+        with self.pool.connection() as conn:
+            self.size = conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+            self.has_lexical_index = has_lexical_index(conn)
+
+    def search(self, search):
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT id, content, metadata FROM docs WHERE pos = ?", (int(search),)).fetchone()
+        if row is None: return "ID {} not found.".format(search)
+        return Document(id=row[0], page_content=row[1], metadata=json.loads(row[2]))
+
+    def search_lexical(self, query, k):
+        """
+        Rank documents by BM25 against a full-text query (see `retrieval.lexical_query`).
+
+        :return: The positions of the k best matching documents, best first.
+        """
+        with self.pool.connection() as conn:
+            return [r[0] for r in conn.execute(SELECT_LEXICAL_MATCHES, (query, k))]
+
+    def close(self):
+        self.pool.close()
+
+
+class BuildDocstore:
+    """
+    Chunks of the index built by src/create_index.py, backed by SQLite: the document and the vector of each chunk are
+    written to disk as they are added, in the order of their positions in the serving index, so that the build never
+    holds the vectors or the map of chunk ids in memory. Vectors are read back in blocks when the serving index is
+    built (see `build_index`). Changes are only committed by `commit`, at the checkpoints of the build, so that an
+    interrupted build resumes from the chunks of its last checkpoint.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        # `pos` orders the chunks: removing chunks moves the positions of the following ones in the serving index
+        self._conn.execute("CREATE TABLE IF NOT EXISTS docs(pos INTEGER PRIMARY KEY, id TEXT NOT NULL UNIQUE, content TEXT NOT NULL, metadata TEXT NOT NULL, vector BLOB NOT NULL)")
+        self._conn.commit()
+
+    @property
+    def ntotal(self):
+        return self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    @property
+    def d(self):
+        row = self._conn.execute("SELECT length(vector) FROM docs LIMIT 1").fetchone()
+        return row[0] // 4 if row is not None else 0
+
+    def add(self, ids, docs, vectors):
+        # Chunks are appended after the existing ones
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self._conn.executemany("INSERT INTO docs(id, content, metadata, vector) VALUES(?, ?, ?, ?)",
+                               [(i, doc.page_content, json.dumps(doc.metadata), v.tobytes()) for i, doc, v in zip(ids, docs, vectors)])
+
+    def delete(self, ids):
+        """
+        :return: The number of chunks deleted.
+        """
+        return self._conn.executemany("DELETE FROM docs WHERE id = ?", [(i,) for i in ids]).rowcount
+
+    def existing_ids(self, ids):
+        return [i for i in ids if self._conn.execute("SELECT 1 FROM docs WHERE id = ?", (i,)).fetchone() is not None]
+
+    def search(self, search):
+        row = self._conn.execute("SELECT content, metadata FROM docs WHERE id = ?", (search,)).fetchone()
+        if row is None: return "ID {} not found.".format(search)
+        return Document(id=search, page_content=row[0], metadata=json.loads(row[1]))
+
+    def iter_docs(self, start=0):
+        # (id, content, metadata) of the chunks, from position `start`
+        return self._conn.execute("SELECT id, content, metadata FROM docs ORDER BY pos LIMIT -1 OFFSET ?", (start,))
+
+    def iter_vectors(self, start=0, block_size=65536):
+        cur = self._conn.execute("SELECT vector FROM docs ORDER BY pos LIMIT -1 OFFSET ?", (start,))
+        while True:
+            rows = cur.fetchmany(block_size)
+            if len(rows) == 0: return
+            yield np.frombuffer(b''.join(r[0] for r in rows), dtype=np.float32).reshape(len(rows), -1)
+
+    def sample_vectors(self, n):
+        # Evenly strided sample of at most n vectors
+        step = max(1, self.ntotal // n)
+        rows = self._conn.execute("SELECT vector FROM (SELECT vector, row_number() OVER (ORDER BY pos) - 1 AS i FROM docs) WHERE i % ? = 0 LIMIT ?", (step, n)).fetchall()
+        return np.frombuffer(b''.join(r[0] for r in rows), dtype=np.float32).reshape(len(rows), -1)
+
+    def commit(self):
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
+
+
+class PositionMap(collections.abc.Mapping):
+    # Identity mapping from index positions to docstore ids, without materializing a dict of the whole index
+    def __init__(self, size):
+        self.size = size
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.size: raise KeyError(i)
+        return int(i)
+
+    def __iter__(self):
+        return iter(range(self.size))
+
+    def __len__(self):
+        return self.size
+
+
+def index_file(save_path, index_type):
+    return os.path.join(save_path, index_type + '.index')
+
+def docstore_file(save_path, index_type):
+    # Each index type has its own docstore, exported and appended to with its index, so that the positions of an index
+    # always match the documents of its docstore
+    return os.path.join(save_path, index_type + '.docstore.db')
+
+def has_lexical_index(conn):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'docs_fts'").fetchone() is not None
+
+def build_lexical_index(conn):
+    conn.execute(CREATE_LEXICAL_INDEX)
+    conn.execute(BUILD_LEXICAL_INDEX)
+
+def make_index(dim, index_type, n, nlist=INDEX_NLIST, hnsw_m=INDEX_HNSW_M, pq_m=INDEX_PQ_M, pq_bits=INDEX_PQ_BITS):
+    # Faiss recommends at least 39 training points per IVF cell, and PQ needs at least one per centroid
+    nlist = max(1, min(nlist, n // 39))
+    pq_bits = max(1, min(pq_bits, int(np.log2(max(n, 2)))))
+    specs = {'flat': "Flat",
+             'ivf_flat': "IVF{},Flat".format(nlist),
+             'hnsw': "HNSW{},Flat".format(hnsw_m),
+             'ivf_pq': "IVF{},PQ{}x{}".format(nlist, pq_m, pq_bits),
+             # Scalar quantization: each component stored as float16 (2x smaller), or as int8 within its trained range (4x smaller)
+             'fp16': "SQfp16",
+             'sq8': "SQ8",
+             'ivf_sq8': "IVF{},SQ8".format(nlist),}
+    if index_type not in specs: raise ValueError("Unknown index type {}, expected one of {}".format(index_type, INDEX_TYPES))
+    return faiss.index_factory(dim, specs[index_type], faiss.METRIC_L2)
+
+def iter_vectors(source, start=0, block_size=65536):
+    if isinstance(source, BuildDocstore):
+        yield from source.iter_vectors(start, block_size)
+        return
+    for i0 in range(start, source.ntotal, block_size):
+        yield source.reconstruct_n(i0, min(block_size, source.ntotal - i0))
+
+def sample_vectors(source, n):
+    # Evenly strided sample of at most n vectors
+    if isinstance(source, BuildDocstore): return source.sample_vectors(n)
+    positions = np.arange(0, source.ntotal, max(1, source.ntotal // n))[:n]
+    return source.reconstruct_batch(positions)
+
+def build_index(source, index_type, train_size=INDEX_TRAIN_SIZE, **kwargs):
+    """
+    Build an index of the given type from the vectors of a source, reading vectors in blocks.
+
+    :param source: A `BuildDocstore`, or a faiss index supporting reconstruction of its vectors.
+    :param index_type: One of `INDEX_TYPES`.
+    :param train_size: Maximum number of vectors used to train IVF/PQ/SQ indexes.
+    :return: The new faiss index, with vectors in the same order as the source.
+    """
+    index = make_index(source.d, index_type, source.ntotal, **kwargs)
+    if not index.is_trained: index.train(sample_vectors(source, train_size))
+    for vectors in iter_vectors(source):
+        index.add(vectors)
+    return index
+
+def doc_rows(docstore, start=0):
+    # Rows of the serving docstore for the chunks of the build docstore, from position `start`
+    for pos, (doc_id, content, metadata) in enumerate(docstore.iter_docs(start), start):
+        yield pos, doc_id, content, metadata
+
+def export_index(docstore, save_path, index_type=INDEX_TYPE):
+    """
+    Export the chunks of the build docstore to the serving format: a faiss index of the configured type, which can be
+    memory-mapped, and its SQLite docstore keyed by index position, with a BM25 inverted index of the documents.
+    """
+    index = build_index(docstore, index_type)
+    faiss.write_index(index, index_file(save_path, index_type) + '.tmp')
+
+    docstore_path = docstore_file(save_path, index_type)
+    if os.path.exists(docstore_path + '.tmp'): os.remove(docstore_path + '.tmp')
+    conn = sqlite3.connect(docstore_path + '.tmp')
+    conn.execute("CREATE TABLE docs(pos INTEGER PRIMARY KEY, id TEXT NOT NULL, content TEXT NOT NULL, metadata TEXT NOT NULL)")
+    conn.executemany(INSERT_DOC, doc_rows(docstore))
+    build_lexical_index(conn)
+    conn.commit()
+    conn.close()
+
+    # Replace previous files only once both are complete
+    os.replace(index_file(save_path, index_type) + '.tmp', index_file(save_path, index_type))
+    os.replace(docstore_path + '.tmp', docstore_path)
+    return index
+
+def append_index(docstore, save_path, exported, index_type=INDEX_TYPE, max_growth=INDEX_APPEND_MAX_GROWTH):
+    """
+    Update the serving index after chunks were only appended to the build docstore since its last export: the new
+    vectors are added to the exported faiss index of the given type, and the new documents to its docstore and BM25 index, instead of
+    rebuilding them. Indexes that need training keep the quantizers trained at their last export, so they are only
+    appended to while they grow by at most `max_growth` times their exported size.
+
+    :param exported: Number of vectors of the last export, the first ones of the build docstore.
+    :return: The number of vectors appended, or None if the serving index must be exported again.
+    """
+    path, docstore_path = index_file(save_path, index_type), docstore_file(save_path, index_type)
+    total = docstore.ntotal
+    if not os.path.exists(path) or not os.path.exists(docstore_path) or exported > total: return None
+    if total > exported * (1 + max_growth) and not make_index(docstore.d, index_type, exported).is_trained: return None
+    conn = sqlite3.connect(docstore_path)
+    try:
+        # Files of an interrupted export or append do not match the manifest
+        if read_index(path).ntotal != exported or conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0] != exported or not has_lexical_index(conn): return None
+        if total == exported: return 0
+        index = read_index(path, mmap=False)
+        for vectors in iter_vectors(docstore, start=exported):
+            index.add(vectors)
+        faiss.write_index(index, path + '.tmp')
+        # Documents first: positions past the end of the index are never returned by a vector search
+        conn.executemany(INSERT_DOC, doc_rows(docstore, start=exported))
+        conn.execute(APPEND_LEXICAL_INDEX, (exported,))
+        conn.commit()
+        os.replace(path + '.tmp', path)
+        return total - exported
+    finally:
+        conn.close()
+
+def set_search_params(index, nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH):
+    params = faiss.ParameterSpace()
+    if faiss.try_extract_index_ivf(index) is not None: params.set_index_parameter(index, 'nprobe', nprobe)
+    if isinstance(index, faiss.IndexHNSW): params.set_index_parameter(index, 'efSearch', ef_search)
+
+def read_index(path, mmap=True):
+    if mmap:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            logger.warning("Index {} does not support memory mapping, loading it in memory...".format(path))
+    return faiss.read_index(path)
+
+def open_index(save_path, index_type=INDEX_TYPE, nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH, mmap=INDEX_MMAP):
+    """
+    Read the serving index, memory-mapped if supported by the index type, and open its SQLite docstore.
+
+    :return: An (index, docstore) pair.
+    :raise FileNotFoundError: If the index or its docstore is missing.
+    :raise RuntimeError: If the index and its docstore do not have the same number of chunks.
+    """
+    path, docstore_path = index_file(save_path, index_type), docstore_file(save_path, index_type)
+    if not os.path.exists(path) or not os.path.exists(docstore_path):
+        raise FileNotFoundError("Index {} not found, run src/create_index.py to build it.".format(path))
+    index = read_index(path, mmap=mmap)
+    docstore = SQLiteDocstore(docstore_path)
+    # Positions past the end of the docstore, or mapped to other documents, would be served as search results
+    if index.ntotal != docstore.size:
+        docstore.close()
+        raise RuntimeError("Index {} has {} vectors but its docstore has {} documents, run src/create_index.py to build it again.".format(path, index.ntotal, docstore.size))
+    set_search_params(index, nprobe=nprobe, ef_search=ef_search)
+    return index, docstore
+
+def as_vectorstore(embeddings, index, docstore):
+    # Documents are read lazily from the docstore
+    return FAISS(embeddings, index, docstore, PositionMap(docstore.size))
+
+def load_index(save_path, embeddings, index_type=INDEX_TYPE, nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH, mmap=INDEX_MMAP):
+    """
+    Load the serving index as a langchain FAISS vectorstore, with the faiss index memory-mapped (if supported by the
+    index type) and documents read lazily from the SQLite docstore.
+    """
+    return as_vectorstore(embeddings, *open_index(save_path, index_type, nprobe=nprobe, ef_search=ef_search, mmap=mmap))
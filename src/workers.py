@@ -0,0 +1,184 @@
+import os
+import gc
+import sys
+import time
+import fcntl
+import random
+import asyncio
+import logging
+import contextlib
+
+from . import db, tracing
+from .history import close_store as close_history_store
+from config import *
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileLock:
+    """
+    Exclusive lock shared by the processes of the server, held on a file with `flock`. The system releases the lock if
+    its holder dies, so that a crashed worker never leaves it held. Each acquisition opens the file again, so that
+    threads of the same process also exclude each other, but a lock object is held by one caller at a time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking=True):
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        except BaseException:
+            f.close()
+            raise
+        self._file = f
+        return True
+
+    def release(self):
+        f, self._file = self._file, None
+        fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class SharedSlots:
+    """
+    Semaphore shared by the processes of the server: at most `n` callers, in any process, hold a slot at the same time.
+    Slots are file locks (see `FileLock`), polled every `poll_interval` seconds while all of them are taken.
+    """
+
+    def __init__(self, folder, n, poll_interval=0.01):
+        os.makedirs(folder, exist_ok=True)
+        self.paths = [os.path.join(folder, 'slot-{}.lock'.format(i)) for i in range(n)]
+        self.poll_interval = poll_interval
+
+    def try_acquire(self):
+        """
+        :return: The lock of a free slot, or None if all slots are taken.
+        """
+        # Start from a random slot, so that callers do not all contend for the first one
+        start = random.randrange(len(self.paths))
+        for i in range(len(self.paths)):
+            lock = FileLock(self.paths[(start + i) % len(self.paths)])
+            if lock.acquire(blocking=False): return lock
+        return None
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Wait for a free slot, and hold it for the duration of the `with` block.
+        """
+        with tracing.span('llm_slot'):
+            lock = self.try_acquire()
+            while lock is None:
+                time.sleep(self.poll_interval)
+                lock = self.try_acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self):
+        """
+        Asynchronous version of `slot`, waiting without blocking the event loop.
+        """
+        with tracing.span('llm_slot'):
+            lock = self.try_acquire()
+            while lock is None:
+                await asyncio.sleep(self.poll_interval)
+                lock = self.try_acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+
+
+def shared_secret_key(path):
+    """
+    Secret key shared by the processes of the server, so that the session cookies signed by a worker are valid in the
+    others: the first process generates it and saves it to `path` (readable by its owner only), the next ones read it.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with FileLock(path + '.lock'):
+        if not os.path.exists(path):
+            with open(os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                f.write(os.urandom(24).hex())
+            os.replace(path + '.tmp', path)
+        with open(path) as f:
+            return f.read().strip()
+
+
+_llm_slots = None
+
+def llm_slots():
+    global _llm_slots
+    if _llm_slots is None: _llm_slots = SharedSlots(LLM_SLOTS_FOLDER, LLM_CONCURRENCY, poll_interval=LLM_SLOT_POLL_INTERVAL)
+    return _llm_slots
+
+
+class SharedLLMSlots:
+    """
+    Chat model mixin for multi-worker serving: each generation holds one of the `LLM_CONCURRENCY` slots shared by all
+    workers, so that the workers together never send the LLM backend more requests than it serves at once. Generations
+    go through `_generate_with_cache` (or its async version) whether they are streamed or not.
+    """
+
+    def _generate_with_cache(self, *args, **kwargs):
+        with llm_slots().slot():
+            return super()._generate_with_cache(*args, **kwargs)
+
+    async def _agenerate_with_cache(self, *args, **kwargs):
+        async with llm_slots().aslot():
+            return await super()._agenerate_with_cache(*args, **kwargs)
+
+
+_master_pid = None
+
+def prepare_fork(startup, timeout=None):
+    """
+    Prepare the master process of a pre-forking server, before the workers are forked: the components are loaded once,
+    so that the workers share their memory (copy-on-write, and the page cache of the memory-mapped index) instead of
+    loading a copy each, and what must not cross a fork is closed.
+    """
+    global _master_pid
+    _master_pid = os.getpid()
+    if not startup.wait(timeout): logger.error("Components not loaded before forking the workers: {!r}".format(startup.error))
+
+    # The writer thread of the chat history would not run in the workers, which start their own. SQLite connections are
+    # reopened by the workers (see `db.ConnectionPool`).
+    close_history_store()
+    db.close_pool()
+
+    # Objects loaded so far are left alone by the garbage collector of the workers, which would otherwise copy the
+    # memory pages it touches
+    gc.collect()
+    gc.freeze()
+
+def in_master():
+    # True in the master process of a pre-forking server, whose components are copies of the workers' ones
+    return _master_pid == os.getpid()
+
+def after_fork(workers=WORKERS):
+    """
+    Set up a worker process after the fork: the CPU threads of the embedding model and of the vector index are shared
+    between the workers, instead of each worker using all cores. The thread pools of PyTorch are started by the worker,
+    the master having loaded the models with a single thread (see `helper.model_threads`), while ONNX Runtime sessions
+    keep the single thread they were created with.
+    """
+    threads = max(1, (EMBEDDING_THREADS or 1) // workers)
+    if 'torch' in sys.modules: sys.modules['torch'].set_num_threads(threads)
+    if 'faiss' in sys.modules: sys.modules['faiss'].omp_set_num_threads(threads)
+    logger.info("Worker {} started with {} CPU threads".format(os.getpid(), threads))
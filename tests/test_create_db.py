@@ -0,0 +1,38 @@
+import sqlite3
+import datetime
+
+from src import db
+from src.create_db import create_db, insert_calendar, migrate_db
+
+
+def create_legacy_db(path, doctors, appointments):
+	# Untyped schema of the first version, with 'dd-mm-YYYY HH:MM:SS' time slots
+	conn = sqlite3.connect(path)
+	conn.execute("CREATE TABLE doctors(name, specialization)")
+	conn.execute("CREATE TABLE appointments(id, doctor, time_slot, patient)")
+	conn.executemany("INSERT INTO doctors VALUES(?, ?)", doctors)
+	conn.executemany("INSERT INTO appointments VALUES(?, ?, ?, ?)", appointments)
+	conn.commit()
+	conn.close()
+
+def test_migrate_doctors_sharing_lookup_key(tmp_path):
+	path = str(tmp_path / 'medassist.db')
+	create_legacy_db(path, [('Dr. Rossi', 'Cardiology'), ('Rossi', 'Neurology')],
+	                 [('0', 'Dr. Rossi', '10-01-2025 09:00:00', None), ('1', 'Rossi', '10-01-2025 09:00:00', 'Martini')])
+	conn = migrate_db(path)
+	rows = conn.execute("SELECT name FROM doctors WHERE name_key >= ? and name_key < ? ORDER BY name", db.prefix_range('rossi')).fetchall()
+	assert rows == [('Dr. Rossi',), ('Rossi',)]
+	assert conn.execute("SELECT count(*) FROM appointments").fetchone()[0] == 2
+	conn.close()
+
+def test_calendar_is_idempotent(tmp_path):
+	conn = create_db(str(tmp_path / 'medassist.db'))
+	doctor_ids = [r[0] for r in conn.execute("SELECT id FROM doctors ORDER BY id")]
+	# The calendar of the coming week overlaps the demo time slots, which are kept
+	start = datetime.date.today()
+	added = insert_calendar(conn, doctor_ids, start, 2)
+	assert added > 0
+	assert insert_calendar(conn, doctor_ids, start, 2) == 0
+	assert conn.execute("SELECT count(*) FROM (SELECT 1 FROM appointments GROUP BY doctor_id, time_slot HAVING count(*) > 1)").fetchone()[0] == 0
+	assert conn.execute("SELECT patient FROM appointments WHERE id = 1").fetchone()[0] == 'Martini'
+	conn.close()
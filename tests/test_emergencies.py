@@ -0,0 +1,45 @@
+import sqlite3
+
+import pytest
+
+from src import db, emergencies
+from src.create_db import create_schema, EMERGENCIES_SCHEMA
+
+
+@pytest.fixture
+def pool(tmp_path):
+	conn = sqlite3.connect(str(tmp_path / 'medassist.db'))
+	create_schema(conn.cursor(), EMERGENCIES_SCHEMA)
+	conn.commit()
+	conn.close()
+	yield db.open_pool(str(tmp_path / 'medassist.db'))
+	db.close_pool()
+
+def paused_follower(**kwargs):
+	# A follower subscribed to the bus, paused after delivering the first emergency, so that the next ones are queued
+	emergencies.register('user', 'patient', 'question', 'RED')
+	follower = emergencies.follow(('RED',), after=0, keepalive=1., **kwargs)
+	assert [e['id'] for e in next(follower)] == [1]
+	return follower
+
+def follow_ids(follower, n, keepalives=2):
+	# Ids of the next n emergencies delivered, or of the ones delivered before a few idle keep-alive periods
+	ids = []
+	while len(ids) < n and keepalives > 0:
+		events = next(follower)
+		if len(events) == 0: keepalives -= 1
+		ids += [e['id'] for e in events]
+	return ids
+
+def test_lagging_subscriber_catches_up(pool, monkeypatch):
+	monkeypatch.setattr(emergencies.bus, 'max_pending', 3)
+	follower = paused_follower()
+	for _ in range(10): emergencies.register('user', 'patient', 'question', 'RED')
+	assert follow_ids(follower, 10) == list(range(2, 12))
+
+def test_poll_does_not_skip_other_workers(pool):
+	follower = paused_follower(poll=0.01)
+	# Registered by another worker, so not published in this process, before an emergency of this worker
+	db.insert_emergency('other', 'patient', '2025-01-10 09:00:00', 'question', 'RED')
+	emergencies.register('user', 'patient', 'question', 'RED')
+	assert follow_ids(follower, 2) == [2, 3]
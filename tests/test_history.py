@@ -0,0 +1,37 @@
+import threading
+
+from src.history import HistoryStore
+
+
+LEGACY_HISTORY = "[19-09-2024 18:13:31] user: hello\n\n[19-09-2024 18:13:35] bot: Hello! How can I help you?\n\n"
+
+def test_legacy_history_imported_once(tmp_path):
+	# Stores opened at the same time, as by the workers of a multi-worker server, import a legacy file only once
+	(tmp_path / 'martini.txt').write_text(LEGACY_HISTORY * 100)
+	stores = []
+	def open_store():
+		stores.append(HistoryStore(str(tmp_path / 'history.db'), str(tmp_path / 'archive')))
+	threads = [threading.Thread(target=open_store) for _ in range(4)]
+	for t in threads: t.start()
+	for t in threads: t.join()
+	try:
+		assert len(stores[0].read('Martini', limit=1000)) == 200
+		assert (tmp_path / 'martini.txt.imported').exists()
+	finally:
+		for store in stores: store.close()
+
+
+def test_archives_kept_per_user(tmp_path):
+	# Users whose names would map to the same folder name once sanitized export only their own archived messages
+	store = HistoryStore(str(tmp_path / 'history.db'), str(tmp_path / 'archive'), flush_interval=0.01, max_messages=4, segment_size=2)
+	try:
+		for name in ['bob smith', 'bob_smith', 'josé', 'jos_']:
+			for i in range(10): store.append(name, '{} {}'.format(name, i), 'user')
+		assert store.flush(5.)
+		assert len(list((tmp_path / 'archive').iterdir())) == 4
+		for name in ['bob smith', 'bob_smith', 'josé', 'jos_']:
+			exported = ''.join(store.export(name))
+			assert exported.count(': {} '.format(name)) == 10
+			assert exported.count('user: ') == 10
+	finally:
+		store.close()
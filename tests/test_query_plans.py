@@ -0,0 +1,46 @@
+import datetime
+
+import pytest
+
+from src import db
+from src.create_db import create_db, insert_calendar
+
+
+# Queries issued by the application, with representative parameters
+QUERIES = {
+	'doctors_by_specialization': (db.SELECT_DOCTORS_BY_SPECIALIZATION, db.prefix_range(db.specialization_prefix('Neurologist'))),
+	'available_appointments': (db.SELECT_AVAILABLE_APPOINTMENTS, ('2025-01-01', -1, '2025-02-01', 10) + db.prefix_range(db.normalize_key('Dr. Lyubor')) + (10,)),
+	'next_available_appointments': (db.SELECT_NEXT_AVAILABLE_APPOINTMENTS, ('2025-01-01', '2025-02-01', 10) + db.prefix_range(db.specialization_prefix('Neurologist')) + (10,)),
+	'appointment_time': (db.SELECT_APPOINTMENT_TIME, (1,)),
+	'patient_appointments': (db.SELECT_PATIENT_APPOINTMENTS, ('Martini',)),
+	'patient_doctor_appointments': (db.SELECT_PATIENT_DOCTOR_APPOINTMENTS, db.prefix_range(db.normalize_key('Lyubor')) + ('Martini',)),
+	'appointment': (db.SELECT_APPOINTMENT, (1,)),
+	'appointment_state': (db.SELECT_APPOINTMENT_STATE, (1,)),
+	'reserve_appointment': (db.RESERVE_APPOINTMENT, {'id': 1, 'patient': 'Martini', 'version': None}),
+	'cancel_appointment': (db.CANCEL_APPOINTMENT, {'id': 1, 'patient': 'Martini', 'version': 0}),
+	'insert_emergency': (db.INSERT_EMERGENCY, ('Martini', 'Martini', '2025-01-10 09:00:00', 'Chest pain', 'RED')),
+	'emergency_time': (db.SELECT_EMERGENCY_TIME, (1,)),
+	'last_emergency_id': (db.SELECT_LAST_EMERGENCY_ID, ()),
+	'emergencies': (db.SELECT_EMERGENCIES, ('RED', '2025-01-01', 0, '2025-02-01', 100)),
+	'emergencies_after': (db.SELECT_EMERGENCIES_AFTER, (0, 100)),
+}
+
+
+@pytest.fixture(scope='module', params=['demo', 'calendar'])
+def conn(request, tmp_path_factory):
+	# The demo database, and one with generated calendars and statistics, which can change the plans of the planner
+	conn = create_db(str(tmp_path_factory.mktemp(request.param) / 'medassist.db'))
+	if request.param == 'calendar':
+		doctor_ids = [r[0] for r in conn.execute("SELECT id FROM doctors ORDER BY id")]
+		insert_calendar(conn, doctor_ids, datetime.date(2025, 1, 1), 8, booked=0.3)
+		conn.execute("ANALYZE")
+	yield conn
+	conn.close()
+
+@pytest.mark.parametrize('name', QUERIES)
+def test_query_uses_indexes(conn, name):
+	# No application query scans a whole table (e.g. 'SCAN appointments', or 'SCAN d' for an alias of doctors)
+	query, params = QUERIES[name]
+	plan = [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + query, params)]
+	scans = [step for step in plan if step.startswith('SCAN')]
+	assert scans == [], "{} scans a table:\n{}".format(name, '\n'.join(plan))
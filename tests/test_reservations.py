@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+from src import db, reservations
+from src.create_db import create_db
+
+
+@pytest.fixture
+def pool(tmp_path):
+	create_db(str(tmp_path / 'medassist.db')).close()
+	yield db.open_pool(str(tmp_path / 'medassist.db'))
+	db.close_pool()
+
+@pytest.mark.parametrize('data', [
+	None,
+	{'action': 'delete', 'slot_ids': [1]},
+	{'action': 'reserve', 'slot_ids': 1},
+	{'action': 'reserve', 'slot_ids': [1, 'x']},
+	{'action': 'reserve', 'slot_ids': [1.5]},
+	{'action': 'reserve', 'slot_ids': [True]},
+	{'action': 'reserve', 'slot_ids': [1], 'atomic': 'false'},
+	{'action': 'reserve', 'slot_ids': list(range(4))},
+])
+def test_parse_batch_rejects_malformed_requests(data):
+	with pytest.raises(ValueError):
+		reservations.parse_batch(data, max_slots=3)
+
+def test_parse_batch():
+	assert reservations.parse_batch({'action': 'cancel', 'slot_ids': [2, '3']}) == ('cancel', [2, 3], False)
+
+def test_atomic_batch(pool):
+	# Slot 1 is reserved by Martini: an atomic batch including it reserves nothing
+	results = reservations.update_batch('reserve', 'Russel', [0, 1], atomic=True)
+	assert [r['response'] for r in results] == [reservations.ERROR_RESPONSE] * 2
+	assert db.get_appointment(0)[2] is None
+	results = reservations.update_batch('reserve', 'Russel', [0, 2], atomic=True)
+	assert [r['response'] for r in results] == [reservations.SUCCESS_RESPONSES['reserve']] * 2
+	results = reservations.update_batch('cancel', 'Russel', [0, 2])
+	assert [r['slot_status'] for r in results] == ['available'] * 2
+
+def test_concurrent_reservations(pool):
+	# Users reserving the same free slot at the same time: exactly one of them gets it
+	barrier = threading.Barrier(8)
+	results = {}
+	def reserve(user_name):
+		barrier.wait()
+		results[user_name] = reservations.reserve(user_name, 3)['response']
+	threads = [threading.Thread(target=reserve, args=('patient{}'.format(i),)) for i in range(8)]
+	for t in threads: t.start()
+	for t in threads: t.join()
+	winners = [u for u, response in results.items() if response == reservations.SUCCESS_RESPONSES['reserve']]
+	assert len(winners) == 1
+	assert db.get_appointment(3)[2] == winners[0]
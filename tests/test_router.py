@@ -0,0 +1,51 @@
+import zlib
+
+import numpy as np
+import pytest
+
+from src import db
+from src.create_db import create_db
+from src.router import IntentRouter
+
+
+class BagOfWordsEmbeddings:
+	# Deterministic stand-in for the embedding model, recording the texts embedded as documents and as queries
+	def __init__(self, dim=256):
+		self.dim = dim
+		self.documents, self.queries = [], []
+
+	def _embed(self, text):
+		vector = np.zeros(self.dim, dtype=np.float32)
+		for word in text.lower().replace('?', ' ').replace(',', ' ').split(): vector[zlib.crc32(word.encode()) % self.dim] += 1.
+		return vector.tolist()
+
+	def embed_documents(self, texts):
+		self.documents += texts
+		return [self._embed(t) for t in texts]
+
+	def embed_query(self, text):
+		self.queries.append(text)
+		return self._embed(text)
+
+
+@pytest.fixture
+def router(tmp_path):
+	create_db(str(tmp_path / 'medassist.db')).close()
+	db.open_pool(str(tmp_path / 'medassist.db'))
+	tools = {'search_doctor_by_specialization': lambda specialization: db.find_doctors_by_specialization(specialization),
+	         'search_available_doctor_appointments': lambda doctor: [],
+	         'search_patient_appointments': lambda patient, doctor=None: []}
+	yield IntentRouter(BagOfWordsEmbeddings(), tools, threshold=0.6, margin=0.05)
+	db.close_pool()
+
+def test_requests_embedded_as_queries(router):
+	examples = list(router.embeddings.documents)
+	intent, _ = router.dispatch("I need a cardiologist")
+	assert intent == 'find_doctor'
+	# Only the intent examples are embedded as documents, whose vectors are saved on disk
+	assert router.embeddings.documents == examples
+	assert router.embeddings.queries == ["I need a cardiologist"]
+
+@pytest.mark.parametrize('msg', ["I need a cardiologist, I have chest pain", "I feel dizzy, can you suggest a neurologist?"])
+def test_emergencies_left_to_agent(router, msg):
+	assert router.dispatch(msg) == ('agent', None)
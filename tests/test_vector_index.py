@@ -0,0 +1,75 @@
+import zlib
+
+import faiss
+import numpy as np
+import pytest
+
+from src import create_index as create_index_module
+from src.create_index import create_index
+from src.vector_index import open_index, index_file
+
+
+QA_FILE = """<?xml version="1.0" encoding="UTF-8"?>
+<Document id="{0}" source="test" url="https://example.org/{0}">
+<Focus>Topic {0}</Focus>
+<QAPairs>
+<QAPair pid="1"><Question qid="{0}_1" qtype="information">What is topic {0}?</Question><Answer>Topic {0} is condition number {0} alpha{0}.</Answer></QAPair>
+<QAPair pid="2"><Question qid="{0}_2" qtype="treatment">How to treat topic {0}?</Question><Answer>Treatment of topic {0} is therapy beta{0}.</Answer></QAPair>
+</QAPairs>
+</Document>
+"""
+
+
+class BagOfWordsEmbeddings:
+	# Deterministic stand-in for the embedding model
+	fingerprint = {'model': 'bag-of-words'}
+
+	def __init__(self, dim=64):
+		self.dim = dim
+
+	def embed_query(self, text):
+		vector = np.zeros(self.dim, dtype=np.float32)
+		for word in text.lower().replace('?', ' ').replace('.', ' ').split(): vector[zlib.crc32(word.encode()) % self.dim] += 1.
+		return (vector / max(float(np.linalg.norm(vector)), 1e-12)).tolist()
+
+	def embed_documents(self, texts):
+		return [self.embed_query(t) for t in texts]
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+	monkeypatch.setattr(create_index_module, 'load_hf_embeddings', BagOfWordsEmbeddings)
+	data_path = tmp_path / 'data'
+	(data_path / 'topics').mkdir(parents=True)
+	for i in range(100): (data_path / 'topics' / '{:03d}.xml'.format(i)).write_text(QA_FILE.format(i))
+	return data_path, tmp_path / 'index'
+
+def build(data_path, save_path, index_type):
+	return create_index(str(data_path), str(save_path), 1000, 0, batch_size=64, workers=1, parser='native', index_type=index_type)
+
+def test_index_types_keep_their_documents(dataset):
+	# Exporting a type after files were removed does not move the documents under the index of another type
+	data_path, save_path = dataset
+	build(data_path, save_path, 'ivf_sq8')
+	build(data_path, save_path, 'flat')
+	(data_path / 'topics' / '000.xml').unlink()
+	assert build(data_path, save_path, 'flat') == 198
+	for index_type, size in [('ivf_sq8', 200), ('flat', 198)]:
+		index, docstore = open_index(str(save_path), index_type, mmap=False)
+		try:
+			assert index.ntotal == docstore.size == size
+			query = np.array([BagOfWordsEmbeddings().embed_query("Treatment of topic 7 is therapy beta7.")], dtype=np.float32)
+			_, positions = index.search(query, 1)
+			assert 'beta7' in docstore.search(int(positions[0][0])).page_content
+		finally:
+			docstore.close()
+
+def test_open_index_checks_docstore_size(dataset):
+	# An index that does not match its docstore is not served
+	data_path, save_path = dataset
+	build(data_path, save_path, 'flat')
+	index = faiss.read_index(index_file(str(save_path), 'flat'))
+	index.remove_ids(np.arange(10, dtype=np.int64))
+	faiss.write_index(index, index_file(str(save_path), 'flat'))
+	with pytest.raises(RuntimeError, match="run src/create_index.py"):
+		open_index(str(save_path), 'flat')
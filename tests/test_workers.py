@@ -0,0 +1,15 @@
+import threading
+
+from src import workers
+
+
+def test_shared_secret_key(tmp_path):
+	# Callers starting at the same time, as the workers of a multi-worker server, get the same key (the file lock also
+	# excludes the threads of a process)
+	path = str(tmp_path / 'workers' / 'secret_key')
+	keys = []
+	threads = [threading.Thread(target=lambda: keys.append(workers.shared_secret_key(path))) for _ in range(8)]
+	for t in threads: t.start()
+	for t in threads: t.join()
+	assert len(set(keys)) == 1 and len(keys[0]) == 48
+	assert workers.shared_secret_key(path) == keys[0]